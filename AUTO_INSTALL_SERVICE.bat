@@ -423,6 +423,14 @@ if %errorLevel% NEQ 0 (
     )
 )
 
+REM Optional packages: the agent falls back to JSON/gzip without them
+echo [optional] Installing msgpack and zstandard (compact telemetry encoding)...
+"%PYTHON_EXE%" -m pip install msgpack zstandard --quiet
+
+if %errorLevel% NEQ 0 (
+    echo [WARNING] Optional packages not installed - telemetry will use JSON/gzip
+)
+
 REM Verify installation by testing imports
 echo Verifying installation...
 "%PYTHON_EXE%" -c "import requests; import psutil; print('OK')" >nul 2>&1
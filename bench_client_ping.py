@@ -0,0 +1,1687 @@
+"""
+Developer benchmarks for client_ping.py.
+Not deployed to studio PCs (auto-update only ships client_ping.py).
+
+Usage:
+    python bench_client_ping.py                 # run all benchmarks
+    python bench_client_ping.py probe           # run one benchmark
+    BENCH_TARGET=192.168.40.26 python bench_client_ping.py probe
+    BENCH_OUTPUT=results-1018.json python bench_client_ping.py agent   # compare between builds
+"""
+import os, sys, time, json, gzip, hashlib, math, random, socket, threading, tempfile, shutil, subprocess
+import atexit, contextlib, importlib.machinery, importlib.util
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import psutil
+import requests
+
+import client_ping
+
+BENCH_TARGET = os.environ.get("BENCH_TARGET", "127.0.0.1")
+BENCH_OUTPUT = os.environ.get("BENCH_OUTPUT", "bench_results.json")  # machine-readable report
+
+
+def use_runtime_dir(directory):
+    """Point the in-process client_ping's logs, spool and state files at directory, so benches
+    and tests leave nothing next to the source (agent subprocesses get their own copies' dirs)."""
+    client_ping.LOG_DIR = os.path.join(directory, "logs")
+    client_ping.LOG_FILE = os.path.join(client_ping.LOG_DIR, "client_ping.log")
+    client_ping.SPOOL_DIR = client_ping.reporter.spool.directory = os.path.join(directory, "spool")
+    client_ping.IDENTITY_CACHE_FILE = os.path.join(directory, "identity_cache.json")
+    client_ping.UPDATE_STATE_FILE = os.path.join(directory, "update_state.json")
+    client_ping.UPDATE_HANDOFF_FILE = os.path.join(directory, "update_handoff.json")
+
+
+RUNTIME_DIR = tempfile.mkdtemp(prefix="bench_client_ping_")
+use_runtime_dir(RUNTIME_DIR)
+atexit.register(shutil.rmtree, RUNTIME_DIR, ignore_errors=True)
+
+
+def _cpu_seconds():
+    """CPU seconds used by this process and its (reaped) children."""
+    t = psutil.Process().cpu_times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def _run_probes(probe_fn, count):
+    """Run count sequential probes. Returns (probes/sec, CPU ms per probe, success count)."""
+    ok = 0
+    cpu0 = _cpu_seconds()
+    t0 = time.perf_counter()
+    for _ in range(count):
+        success, _, _ = probe_fn(BENCH_TARGET)
+        ok += 1 if success else 0
+    wall = time.perf_counter() - t0
+    cpu = _cpu_seconds() - cpu0
+    return count / wall, cpu * 1000 / count, ok
+
+
+@contextlib.contextmanager
+def patched(module, **attrs):
+    """Set module attributes for the duration of the block, then put the originals back."""
+    saved = {name: getattr(module, name) for name in attrs}
+    for name, value in attrs.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(module, name, value)
+
+
+class FakeProbeEngine:
+    """Native-engine stand-in: answers every probe at once with rtt_ms and sends nothing."""
+    kind = "fake"
+
+    def __init__(self, rtt_ms=12.0):
+        self.rtt_ms = rtt_ms
+
+    def submit(self, ip, timeout):
+        future = Future()
+        future.set_result((True, self.rtt_ms, f"fake reply from {ip}: time={self.rtt_ms}ms"))
+        return future
+
+
+def fake_backends(agent, engine=None, runner=None):
+    """Attributes to patch into a client_ping module so it runs without network probes, a GPU or
+    OBS: a FakeProbeEngine, a synthetic GPU sampler and OBS always running. With runner set,
+    processes the agent spawns itself (update bridge and guard) go through the runner too."""
+    engine = engine or FakeProbeEngine()
+
+    class FakeGpuSampler(agent.GpuSampler):
+        name = "fake"
+
+        def latest(self):
+            self._set(round(50 + 40 * math.sin(time.monotonic() / 10), 1))
+            return self._value
+
+    attrs = {
+        "get_icmp_engine": lambda: engine,
+        "is_obs_running": lambda: True,
+        "gpu_sampler_candidates": lambda: [("fake", FakeGpuSampler)],
+        "_try_install_gputil": lambda: None,
+        "_detect_gpu_name": lambda: "Fake GPU",
+    }
+    if runner:
+        spawn = agent._spawn_detached
+        attrs["_spawn_detached"] = lambda args, kind: spawn([args[0], runner] + list(args[1:]), kind)
+    return attrs
+
+
+AGENT_RUNNER = r"""# Written by bench_client_ping.py: python run_agent.py <client_ping copy> [args]
+# runs the copy as the service would, with the bench's fake backends patched in.
+import importlib.machinery, importlib.util, sys
+sys.path.insert(0, {bench_dir!r})
+script, sys.argv = sys.argv[1], sys.argv[1:]
+loader = importlib.machinery.SourceFileLoader("client_ping", script)
+agent = importlib.util.module_from_spec(importlib.util.spec_from_loader("client_ping", loader))
+sys.modules["client_ping"] = agent
+loader.exec_module(agent)
+import bench_client_ping
+for name, value in bench_client_ping.fake_backends(agent, runner=__file__).items():
+    setattr(agent, name, value)
+main = open(script, encoding="utf-8").read().split('if __name__=="__main__":', 1)[1]
+exec(compile("if True:" + main, script, "exec"), vars(agent))
+"""
+
+def agent_command(script, *args):
+    """Command line running a client_ping.py copy under AGENT_RUNNER (written next to it)."""
+    runner = os.path.join(os.path.dirname(script), "run_agent.py")
+    if not os.path.exists(runner):
+        with open(runner, "w", encoding="utf-8") as f:
+            f.write(AGENT_RUNNER.format(bench_dir=os.path.dirname(os.path.abspath(__file__))))
+    return [sys.executable, runner, script, *args]
+
+
+class StandInCollector:
+    """Local stand-in for the collector server: accepts every POST/GET with 200 and counts requests.
+    legacy=True emulates an older server without /push_batch; compact=False one without the
+    compact session protocol (legacy implies it).
+    Every pushed payload is kept in self.received as (endpoint, payload); compact batches are
+    expanded back to full payloads (raw is None where the agent left it out).
+    self.bytes counts request body bytes per path as sent on the wire.
+    self.delay (s) and self.fail_status (e.g. 503) can be set at any time to make it slow or broken.
+    /get_targets serves targets; /client_version reports build 0 so agents never self-update.
+    targets_protocol: "plain" (old server: full list every time), "etag" (304 when unchanged),
+    "longpoll" (etag + ?wait=N held until set_targets()) or "sse" (etag + /get_targets/stream).
+    self.target_requests / target_bytes / not_modified count what serving the list cost.
+    set_release(script bytes, build) publishes a build on /client_version (sha256, ETag) and /client_script."""
+    def __init__(self, legacy=False, port=0, targets=(), compact=True, targets_protocol="plain"):
+        self.counts = {}
+        self.targets_protocol = targets_protocol
+        self.version = 1
+        self.target_requests = 0
+        self.target_bytes = 0
+        self.not_modified = 0
+        self.closed = False
+        self.release = None  # (build, script bytes, sha256)
+        self._changed = threading.Condition()
+        self.bytes = {}
+        self.received = []
+        self.posts = 0
+        self.targets = list(targets)
+        self.sessions = {}  # session id -> {context id: context dict}
+        self.encoding, self.compression = "msgpack", "gzip"  # preferred, if the agent offers them
+        self.delay = 0.0
+        self.fail_status = None
+        compact = compact and not legacy
+        collector = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, body=b"{}", status=200, headers=None):
+                length = int(self.headers.get("Content-Length") or 0)
+                data = self.rfile.read(length) if length else b""
+                collector.counts[self.path] = collector.counts.get(self.path, 0) + 1
+                collector.bytes[self.path] = collector.bytes.get(self.path, 0) + len(data)
+                collector.posts += self.command == "POST"
+                if collector.delay:
+                    time.sleep(collector.delay)
+                if collector.fail_status:
+                    status, body = collector.fail_status, b"{}"
+                if self.command == "POST" and data and status == 200:
+                    pushed = collector.decode(data, self.headers)
+                    if self.path == "/push_batch":
+                        collector.received.extend((i["endpoint"], i["payload"]) for i in pushed["items"])
+                    elif self.path == "/push_compact" and pushed["session"] not in collector.sessions:
+                        status = 410  # e.g. the collector restarted: the agent registers again
+                    elif self.path == "/push_compact":
+                        collector.received.extend(collector.expand(pushed))
+                    elif self.path == "/register_session":
+                        body = collector.register(pushed)
+                    else:
+                        collector.received.append((self.path, pushed))
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except BrokenPipeError:
+                    pass  # e.g. a long-poll whose agent was stopped
+
+            def _targets(self, query):
+                collector.target_requests += 1
+                body = json.dumps([{"target": t} for t in collector.targets]).encode()
+                if collector.targets_protocol == "plain":
+                    collector.target_bytes += len(body)
+                    self._reply(body)
+                    return
+                headers = {}
+                if collector.targets_protocol == "longpoll" and "wait=" in query:
+                    headers["X-Long-Poll"] = "1"
+                    wait = float(query.split("wait=")[1].split("&")[0])
+                    with collector._changed:
+                        collector._changed.wait_for(
+                            lambda: collector.closed or collector.etag() != self.headers.get("If-None-Match"), wait)
+                    body = json.dumps([{"target": t} for t in collector.targets]).encode()
+                headers["ETag"] = collector.etag()
+                if self.headers.get("If-None-Match") == headers["ETag"]:
+                    collector.not_modified += 1
+                    self._reply(b"", 304, headers)
+                else:
+                    collector.target_bytes += len(body)
+                    self._reply(body, 200, headers)
+
+            def _stream(self):
+                collector.target_requests += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                sent = self.headers.get("Last-Event-ID")
+                try:
+                    while not collector.closed:
+                        with collector._changed:
+                            if collector.etag() == sent:
+                                collector._changed.wait(1.0)
+                        etag = collector.etag()
+                        if etag != sent:
+                            sent = etag
+                            message = f"id: {etag}\ndata: {json.dumps([{'target': t} for t in collector.targets])}\n\n"
+                        else:
+                            message = ": keepalive\n\n"
+                        self.wfile.write(message.encode())
+                        self.wfile.flush()
+                        collector.target_bytes += len(message)
+                except OSError:
+                    pass
+
+            def do_POST(self):
+                if legacy and self.path == "/push_batch":
+                    self._reply(b"{}", 404)
+                elif not compact and self.path in ("/register_session", "/push_compact"):
+                    self._reply(b"{}", 404)
+                else:
+                    self._reply()
+
+            def do_GET(self):
+                path, _, query = self.path.partition("?")
+                if path == "/get_targets":
+                    self._targets(query)
+                elif path == "/get_targets/stream" and collector.targets_protocol == "sse":
+                    self._stream()
+                elif path == "/get_targets/stream":
+                    self._reply(b"{}", 404)
+                elif path == "/client_version" and collector.release:
+                    build, _, sha256 = collector.release
+                    etag = f'"b{build}"'
+                    if self.headers.get("If-None-Match") == etag:
+                        self._reply(b"", 304, {"ETag": etag})
+                    else:
+                        self._reply(json.dumps({"build": build, "sha256": sha256}).encode(), 200, {"ETag": etag})
+                elif path == "/client_script" and collector.release:
+                    self._reply(collector.release[1])
+                elif self.path.startswith("/client_version"):
+                    self._reply(b'{"build": 0}')
+                else:
+                    self._reply()
+
+            def log_message(self, *args):
+                pass
+
+        ThreadingHTTPServer.allow_reuse_address = True
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        with self._changed:
+            self.closed = True
+            self._changed.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def set_release(self, script, build):
+        self.release = (build, script, hashlib.sha256(script).hexdigest())
+
+    def etag(self):
+        return f'"v{self.version}"'
+
+    def set_targets(self, targets):
+        with self._changed:
+            self.targets = list(targets)
+            self.version += 1
+            self._changed.notify_all()
+
+    def decode(self, data, headers):
+        if headers.get("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        if headers.get("Content-Type") == "application/msgpack":
+            return client_ping.msgpack.unpackb(data, raw=False)
+        return json.loads(data)
+
+    def register(self, metadata):
+        session_id = f"s{len(self.sessions) + 1}"
+        self.sessions[session_id] = {}
+        encoding = self.encoding if self.encoding in metadata["encodings"] else "json"
+        compression = self.compression if self.compression in metadata["compressions"] else "identity"
+        return json.dumps({"session_id": session_id, "encoding": encoding, "compression": compression}).encode()
+
+    def expand(self, pushed):
+        contexts = self.sessions[pushed["session"]]
+        contexts.update((context_id, context) for context_id, context in pushed["contexts"])
+        items = [(endpoint, payload) for endpoint, payload in pushed["items"]]
+        for context_id, timestamp, success, rtt_ms, raw, extra in pushed["pings"]:
+            payload = dict(contexts[context_id], timestamp=timestamp, success=success, rtt_ms=rtt_ms, raw=raw)
+            payload.update(extra or {})
+            items.append(("/push_ping", payload))
+        return items
+
+
+# ---------------- Ping output corpus ----------------
+# (ping output, expected parse_ping_output result)
+PING_OUTPUT_CORPUS = [
+    # Linux iputils
+    ("PING 1.1.1.1 (1.1.1.1) 56(84) bytes of data.\n"
+     "64 bytes from 1.1.1.1: icmp_seq=1 ttl=57 time=12.3 ms\n\n"
+     "--- 1.1.1.1 ping statistics ---\n1 packets transmitted, 1 received, 0% packet loss, time 0ms\n"
+     "rtt min/avg/max/mdev = 12.345/12.345/12.345/0.000 ms\n", 12.3),
+    ("PING localhost (127.0.0.1) 56(84) bytes of data.\n"
+     "64 bytes from localhost (127.0.0.1): icmp_seq=1 ttl=64 time=0.045 ms\n", 1.0),
+    ("PING 10.255.255.1 (10.255.255.1) 56(84) bytes of data.\n\n--- 10.255.255.1 ping statistics ---\n"
+     "1 packets transmitted, 0 received, 100% packet loss, time 0ms\n", -10.0),
+    # BusyBox
+    ("PING 8.8.8.8 (8.8.8.8): 56 data bytes\n64 bytes from 8.8.8.8: seq=0 ttl=115 time=38.521 ms\n", 38.521),
+    # macOS
+    ("PING 1.1.1.1 (1.1.1.1): 56 data bytes\n64 bytes from 1.1.1.1: icmp_seq=0 ttl=57 time=21.876 ms\n", 21.876),
+    ("PING 10.255.255.1 (10.255.255.1): 56 data bytes\nRequest timeout for icmp_seq 0\n", -10.0),
+    # Windows (English)
+    ("Pinging 8.8.8.8 with 32 bytes of data:\r\nReply from 8.8.8.8: bytes=32 time=45ms TTL=117\r\n", 45.0),
+    ("Pinging 192.168.40.26 with 32 bytes of data:\r\nReply from 192.168.40.26: bytes=32 time<1ms TTL=128\r\n", 1.0),
+    ("Pinging 10.255.255.1 with 32 bytes of data:\r\nRequest timed out.\r\n", -10.0),
+    ("Pinging 10.0.0.9 with 32 bytes of data:\r\nReply from 10.0.0.5: Destination host unreachable.\r\n", -10.0),
+    # Windows (localized)
+    ("Ping wird ausgeführt für 8.8.8.8 mit 32 Bytes Daten:\r\nAntwort von 8.8.8.8: Bytes=32 Zeit=17ms TTL=117\r\n", 17.0),
+    ("Ping wird ausgeführt für 192.168.1.1 mit 32 Bytes Daten:\r\nAntwort von 192.168.1.1: Bytes=32 Zeit<1ms TTL=64\r\n", 1.0),
+    ("Envoi d'une requête 'Ping'  8.8.8.8 avec 32 octets de données :\r\nRéponse de 8.8.8.8 : octets=32 temps=23 ms TTL=117\r\n", 23.0),
+    ("Haciendo ping a 8.8.8.8 con 32 bytes de datos:\r\nRespuesta desde 8.8.8.8: bytes=32 tiempo=31ms TTL=117\r\n", 31.0),
+    ("Disparando 8.8.8.8 com 32 bytes de dados:\r\nResposta de 8.8.8.8: bytes=32 tempo=29ms TTL=117\r\n", 29.0),
+    ("Esecuzione di Ping 8.8.8.8 con 32 byte di dati:\r\nRisposta da 8.8.8.8: byte=32 durata=27ms TTL=117\r\n", 27.0),
+    ("Pinging 8.8.8.8 met 32 bytes aan gegevens:\r\nAntwoord van 8.8.8.8: bytes=32 tijd=19ms TTL=117\r\n", 19.0),
+    ("Skickar ping-signal till 8.8.8.8 med 32 byte data:\r\nSvar från 8.8.8.8: byte=32 tid=14 ms TTL=117\r\n", 14.0),
+    ("Badanie 8.8.8.8 z 32 bajtami danych:\r\nOdpowiedź z 8.8.8.8: bajtów=32 czas=22ms TTL=117\r\n", 22.0),
+    ("8.8.8.8 ping işlemi 32 bayt veri ile:\r\n8.8.8.8 yanıtı: bayt=32 süre=33ms TTL=117\r\n", 33.0),
+    ("Обмен пакетами с 8.8.8.8 по с 32 байтами данных:\r\nОтвет от 8.8.8.8: число байт=32 время=41мс TTL=117\r\n", 41.0),
+    ("正在 Ping 8.8.8.8 具有 32 字节的数据:\r\n来自 8.8.8.8 的回复: 字节=32 时间=52ms TTL=117\r\n", 52.0),
+    ("8.8.8.8 に ping を送信しています 32 バイトのデータ:\r\n8.8.8.8 からの応答: バイト数 =32 時間 =63ms TTL=117\r\n", 63.0),
+    ("Ping 8.8.8.8 32바이트 데이터 사용:\r\n8.8.8.8의 응답: 바이트=32 시간=48ms TTL=117\r\n", 48.0),
+]
+
+
+# ---------------- Benchmarks ----------------
+def bench_probe(count=200):
+    """Native ICMP engine vs. ping subprocess: probes/sec and CPU per probe."""
+    results = {}
+    if client_ping.get_icmp_engine() is not None:
+        rate, cpu_ms, ok = _run_probes(client_ping.do_ping_once, count)
+        results["native"] = {"probes_per_sec": round(rate, 1), "cpu_ms_per_probe": round(cpu_ms, 3), "ok": ok}
+    else:
+        print("native ICMP engine unavailable on this host - skipping")
+    rate, cpu_ms, ok = _run_probes(client_ping.do_ping_subprocess, max(10, count // 10))
+    results["subprocess"] = {"probes_per_sec": round(rate, 1), "cpu_ms_per_probe": round(cpu_ms, 3), "ok": ok}
+    return results
+
+
+def bench_soak(duration=60, pool=250, interval=0.2):
+    """Churn targets on the probe scheduler; thread count and RSS must stay flat."""
+    collector = StandInCollector()
+    proc = psutil.Process()
+    addresses = [f"127.0.{i // 250}.{i % 250 + 1}" for i in range(pool)]
+    rng = random.Random(1)
+
+    def churn_for(seconds):
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            scheduler.set_targets(rng.sample(addresses, rng.randint(pool // 2, pool)))
+            time.sleep(0.5)
+
+    try:
+        with patched(client_ping, collectors=client_ping.CollectorPool([collector.url]), PING_INTERVAL=interval):
+            scheduler = client_ping.ProbeScheduler()
+            try:
+                churn_for(min(10, duration / 4))  # warm-up: executor threads and allocator settle
+                threads0, rss0 = proc.num_threads(), proc.memory_info().rss
+                churn_for(duration)
+                threads1, rss1 = proc.num_threads(), proc.memory_info().rss
+            finally:
+                scheduler.stop()
+                client_ping.reporter.drain()  # to this collector, before collectors is put back
+    finally:
+        collector.close()
+    return {
+        "threads_start": threads0, "threads_end": threads1,
+        "rss_mb_start": round(rss0 / 2**20, 1), "rss_mb_end": round(rss1 / 2**20, 1),
+        "reporter": client_ping.reporter.stats(),
+    }
+
+
+def bench_outage(rate=50, duration=12, down_at=3, up_at=7):
+    """Collector outage: samples are spooled to disk and replayed with original timestamps, oldest first."""
+    collector = StandInCollector()
+    port = collector.server.server_address[1]
+    spool_dir = tempfile.mkdtemp(prefix="spool-")
+    rep = client_ping.TelemetryReporter(flush_interval=0.2, spool=client_ping.TelemetrySpool(spool_dir))
+    sent = {}
+    try:
+        with patched(client_ping, collectors=client_ping.CollectorPool([collector.url])):
+            t0 = time.monotonic()
+            i = 0
+            while time.monotonic() - t0 < duration:
+                elapsed = time.monotonic() - t0
+                if collector and down_at <= elapsed < up_at:
+                    received_before_outage = collector.received
+                    collector.close()
+                    collector = None
+                elif collector is None and elapsed >= up_at:
+                    collector = StandInCollector(port=port)
+                    up_seq = i  # everything before this that arrives now was replayed from the spool
+                sent[i] = time.time()
+                rep.submit("/push_ping", {"seq": i, "timestamp": sent[i]})
+                i += 1
+                time.sleep(1 / rate)
+            back_online = time.monotonic()
+            while (rep.sent + rep.replayed + rep.failed < rep.enqueued - rep.dropped
+                   and time.monotonic() - back_online < 60):
+                time.sleep(0.2)
+    finally:
+        if collector:
+            collector.close()
+    received = [(e, p) for e, p in received_before_outage + collector.received if "seq" in p]
+    got = {}
+    for _, payload in received:
+        got.setdefault(payload["seq"], payload["timestamp"])
+    replayed = [p["seq"] for _, p in collector.received if p.get("seq", up_seq) < up_seq]
+    result = {
+        "samples": len(sent),
+        "delivered": len(got),
+        "lost": len(set(sent) - set(got)),
+        "duplicates": len(received) - len(got),
+        "timestamps_preserved": all(got[s] == sent[s] for s in got),
+        "replayed": len(replayed),
+        "replay_in_order": replayed == sorted(replayed),
+        "drain_seconds": round(time.monotonic() - back_online, 1),
+        "reporter": rep.stats(),
+    }
+    shutil.rmtree(spool_dir, ignore_errors=True)
+    return result
+
+
+def bench_payload(count=20000):
+    """/push_ping payload build time per sample: cached target context vs. rebuilt every time."""
+    raw = "Reply from 127.0.0.1: bytes=32 time=12ms TTL=57"
+    results = {}
+    try:
+        with patched(client_ping, obs_stream_preview_ostream="https://ostream.example/play?streamName=abc123&x=1",
+                     obs_stream_preview_youtube="https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+                     client_isp_name="Link3 Technologies Limited"):
+            for mode in ("rebuilt", "cached"):
+                t0 = time.perf_counter()
+                for _ in range(count):
+                    if mode == "rebuilt":
+                        client_ping.invalidate_target_contexts()
+                    client_ping.build_ping_payload(BENCH_TARGET, 12.0, True, raw)
+                results[mode] = {"us_per_sample": round((time.perf_counter() - t0) * 1e6 / count, 2)}
+    finally:
+        client_ping.invalidate_target_contexts()  # cached contexts carry the values patched in above
+    return results
+
+
+def bench_parse(rounds=2000):
+    """Ping output parser: correctness over the fixture corpus, then parse throughput."""
+    wrong = [(out.splitlines()[-1], expected, client_ping.parse_ping_output(out))
+             for out, expected in PING_OUTPUT_CORPUS
+             if client_ping.parse_ping_output(out) != expected]
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for out, _ in PING_OUTPUT_CORPUS:
+            client_ping.parse_ping_output(out)
+    elapsed = time.perf_counter() - t0
+    return {
+        "corpus": len(PING_OUTPUT_CORPUS),
+        "wrong": wrong,
+        "parses_per_sec": round(rounds * len(PING_OUTPUT_CORPUS) / elapsed),
+    }
+
+
+def bench_burst(count=10, rounds=50):
+    """Burst of N probes: native engine vs. one ping process vs. N ping processes (CPU per burst)."""
+    import asyncio
+    results = {}
+    scheduler = client_ping.ProbeScheduler()
+
+    def native_burst():  # the way ping_loop runs it: on the scheduler loop
+        return asyncio.run_coroutine_threadsafe(
+            client_ping.async_ping_burst(BENCH_TARGET, scheduler.executor, count, 5), scheduler.loop).result()
+
+    modes = {
+        "native": native_burst,
+        "one_process": lambda: client_ping.do_ping_burst_subprocess(BENCH_TARGET, count, 5),
+        "n_processes": lambda: [client_ping.do_ping_subprocess(BENCH_TARGET) for _ in range(count)],
+    }
+    if client_ping.get_icmp_engine() is None:
+        del modes["native"]
+    try:
+        with patched(client_ping, PROBE_BACKEND="icmp"):  # engine bursts, not the continuous-ping path
+            for mode, fn in modes.items():
+                cpu0, t0 = _cpu_seconds(), time.perf_counter()
+                for _ in range(rounds):
+                    fn()
+                results[mode] = {
+                    "cpu_ms_per_burst": round((_cpu_seconds() - cpu0) * 1000 / rounds, 2),
+                    "wall_ms_per_burst": round((time.perf_counter() - t0) * 1000 / rounds, 1),
+                }
+            results["native_sample"] = native_burst()[3] if "native" in modes else None
+    finally:
+        scheduler.stop()
+    return results
+
+
+def bench_histogram(samples=200000, seed=7):
+    """RttHistogram accuracy vs. exact percentiles, merge equivalence and record cost."""
+    rng = random.Random(seed)
+    # Long-tailed RTTs: lognormal body around 20 ms plus 1% spikes up to 2 s
+    values = [rng.lognormvariate(3.0, 0.4) if rng.random() > 0.01 else rng.uniform(200, 2000)
+              for _ in range(samples)]
+    whole = client_ping.RttHistogram()
+    t0 = time.perf_counter()
+    for v in values:
+        whole.record(v)
+    record_ns = (time.perf_counter() - t0) * 1e9 / samples
+    ordered = sorted(values)
+    errors = {}
+    for p in (50, 90, 99, 99.9):
+        exact = ordered[max(1, math.ceil(p / 100 * samples)) - 1]  # nearest rank
+        errors[f"p{p}"] = round(abs(whole.percentile(p) - exact) / exact * 100, 3)
+    half_a, half_b = client_ping.RttHistogram(), client_ping.RttHistogram()
+    for i, v in enumerate(values):
+        (half_a if i % 2 else half_b).record(v)
+    merged = half_a.merge(half_b)
+    return {
+        "relative_error_pct": errors,
+        "max_error_within_bound": max(errors.values()) <= whole.precision / 2 * 100,
+        "merge_equals_whole": merged.summary() == whole.summary(),
+        "buckets": len(whole.buckets),
+        "record_ns": round(record_ns),
+    }
+
+
+def _cpu_ms_per_call(fn, calls):
+    cpu0 = _cpu_seconds()
+    for _ in range(calls):
+        fn()
+    return round((_cpu_seconds() - cpu0) * 1000 / calls, 3)
+
+
+def bench_obs(calls=50):
+    """OBS detection: CPU per check (subprocess vs. psutil watcher) and start/stop detection latency."""
+    fake_dir = tempfile.mkdtemp(prefix="obs-")
+    fake_obs = os.path.join(fake_dir, "obs")
+    shutil.copy(shutil.which("sleep"), fake_obs)
+    watcher = client_ping.ObsWatcher(interval=0.05)
+    events = []
+    watcher.add_listener(lambda running: events.append((running, time.perf_counter())))
+    results = {
+        "cpu_ms_subprocess_check": _cpu_ms_per_call(client_ping.is_obs_running_subprocess, calls),
+        "cpu_ms_full_scan": _cpu_ms_per_call(watcher.check, calls),  # OBS absent: every check scans
+    }
+    proc = subprocess.Popen([fake_obs, "60"])
+    watcher.check()
+    results["cpu_ms_cached_pid_check"] = _cpu_ms_per_call(watcher.check, calls * 20)
+    proc.kill()
+    proc.wait()
+    watcher.check()
+    events.clear()
+
+    watcher.start()
+    latencies = {"start": [], "stop": []}
+    for _ in range(5):
+        for running, key in ((True, "start"), (False, "stop")):
+            t0 = time.perf_counter()
+            if running:
+                proc = subprocess.Popen([fake_obs, "60"])
+            else:
+                proc.kill()
+                proc.wait()
+            while not events or events[-1][0] != running:
+                time.sleep(0.001)
+            latencies[key].append((events[-1][1] - t0) * 1000)
+    shutil.rmtree(fake_dir, ignore_errors=True)
+    results["watcher_latency_ms"] = {k: round(sum(v) / len(v), 1) for k, v in latencies.items()}
+    # The old path only looked every POLL_INTERVAL seconds: half an interval on average
+    results["poll_latency_ms_expected"] = client_ping.POLL_INTERVAL * 1000 / 2
+    results["full_scans"] = watcher.scans
+    return results
+
+
+def bench_config(rounds=20):
+    """Config snapshot: latency from writing the OBS env file to the subscriber callback, and get() cost."""
+    config_dir = tempfile.mkdtemp(prefix="config-")
+    path = os.path.join(config_dir, "agent.env")
+    source = client_ping.FileConfigSource(path=path)
+    seen = []
+    source.subscribe(lambda changed: seen.append((changed, time.perf_counter())))
+    source.start()
+    latencies = []
+    for i in range(rounds):
+        t0 = time.perf_counter()
+        with open(path + ".tmp", "w") as f:
+            f.write(f"OBS_STREAMING_SERVERS=os-origin-server-{i}.example\n")
+        os.replace(path + ".tmp", path)
+        while not seen or seen[-1][0].get("OBS_STREAMING_SERVERS") != f"os-origin-server-{i}.example":
+            time.sleep(0.0005)
+        latencies.append((seen[-1][1] - t0) * 1000)
+    t0 = time.perf_counter()
+    for _ in range(100000):
+        source.get("OBS_STREAMING_SERVERS")
+    get_ns = (time.perf_counter() - t0) * 1e9 / 100000
+    shutil.rmtree(config_dir, ignore_errors=True)
+    return {
+        "backend": "inotify" if (source._inotify_fd or -1) >= 0 else "mtime polling",
+        "change_latency_ms": {"avg": round(sum(latencies) / rounds, 2), "max": round(max(latencies), 2)},
+        "get_ns": round(get_ns),
+    }
+
+
+def bench_gpu(duration=5):
+    """GPU sampler: one persistent process streaming samples vs. one process per sample; unhealthy after kill."""
+    fake = [sys.executable, "-c",
+            "import sys, time, itertools\n"
+            "for i in itertools.count():\n"
+            "    print(i % 100, flush=True); time.sleep(0.1)"]
+    sampler = client_ping.StreamingCommandSampler("fake", fake, client_ping._parse_single_value, stale_after=1)
+    cpu0, t0 = _cpu_seconds(), time.perf_counter()
+    sampler.start()
+    while sampler.samples == 0:
+        time.sleep(0.01)
+    first_sample_ms = (time.perf_counter() - t0) * 1000
+    time.sleep(duration)
+    streamed = sampler.samples
+    healthy_before = sampler.healthy()
+    sampler.proc.kill()
+    sampler.proc.wait()
+    persistent_cpu = _cpu_seconds() - cpu0  # child is reaped now, so its CPU is included
+    healthy_after = sampler.healthy()
+    sampler.stop()
+
+    # Old model: a fresh interpreter per sample
+    once = [sys.executable, "-c", "print(42)"]
+    cpu0 = _cpu_seconds()
+    for _ in range(10):
+        subprocess.run(once, capture_output=True, text=True, timeout=10)
+    per_spawn_cpu = (_cpu_seconds() - cpu0) / 10
+    return {
+        "first_sample_ms": round(first_sample_ms, 1),
+        "samples_streamed": streamed,
+        "persistent_cpu_ms_per_sample": round(persistent_cpu * 1000 / max(streamed, 1), 3),
+        "spawn_cpu_ms_per_sample": round(per_spawn_cpu * 1000, 3),
+        "healthy_while_running": healthy_before,
+        "healthy_after_kill": healthy_after,
+        "auto_candidates": [name for name, _ in client_ping.gpu_sampler_candidates()],
+    }
+
+
+def bench_client_info(target_counts=(1, 10, 50), duration=6, interval=0.2, info_interval=1):
+    """Probes per target per minute must not grow with target count: client info reads RTTs, never probes."""
+    collector = StandInCollector()
+    engine, probes = FakeProbeEngine(), [0]
+    submit = engine.submit
+
+    def counting_submit(*args, **kwargs):
+        probes[0] += 1
+        return submit(*args, **kwargs)
+
+    engine.submit = counting_submit
+    results = {}
+    # Targets are named like OBS ingest servers so push_client_info walks all of them
+    try:
+        with patched(client_ping, collectors=client_ping.CollectorPool([collector.url]), PING_INTERVAL=interval,
+                     get_icmp_engine=lambda: engine, is_obs_running=lambda: True), \
+             patched(client_ping.dns_cache, lookup=lambda t: t[3:] if t.startswith("os-") else None):
+            for n in target_counts:
+                targets = [f"os-127.0.2.{i + 1}" for i in range(n)]
+                info = client_ping.ClientInfoScheduler(interval=info_interval)
+                scheduler = client_ping.ProbeScheduler()
+                try:
+                    info.start()
+                    probes[0] = 0
+                    scheduler.set_targets(targets)
+                    time.sleep(duration)
+                finally:
+                    scheduler.stop()
+                    info.stop()
+                    client_ping.reporter.drain()
+                total = probes[0]
+                results[n] = {
+                    "probes_per_target_per_min": round(total / n * 60 / duration, 1),
+                    "expected_per_target_per_min": round(60 / interval, 1),
+                    "client_info_pushes": info.pushes,
+                    "client_info_pushes_per_min": round(info.pushes * 60 / duration, 1),
+                    "os_origin_server": next((p["os_origin_server"] for e, p in reversed(collector.received)
+                                              if e == "/push_client_info"), None),
+                }
+    finally:
+        collector.close()
+    return results
+
+
+def _agent_sample(proc, collector):
+    with open(f"/proc/{proc.pid}/io") as f:
+        io = dict(line.split(": ") for line in f.read().splitlines())
+    t = proc.cpu_times()
+    return {
+        "time": time.monotonic(), "cpu": t.user + t.system,
+        "syscalls": int(io["syscr"]) + int(io["syscw"]),
+        "posts": collector.posts, "received": len(collector.received),
+    }
+
+def _cadence_error(samples, interval, start, end):
+    """Per target: |samples stamped in [start, end) - expected| / expected, from the /push_ping payloads."""
+    per_target = {}
+    for endpoint, payload in samples:
+        if endpoint == "/push_ping" and start <= payload["timestamp"] < end:
+            per_target[payload["target"]] = per_target.get(payload["target"], 0) + 1
+    expected = (end - start) / interval
+    errors = [abs(n - expected) / expected * 100 for n in per_target.values()] or [100.0]
+    return {"avg_pct": round(sum(errors) / len(errors), 2), "max_pct": round(max(errors), 2),
+            "targets_reporting": len(per_target)}
+
+def bench_agent(target_counts=(1, 10, 50, 200), duration=30, warmup=10, interval=1.0):
+    """Whole agent as a subprocess against the stand-in collector with fake probe/GPU backends:
+    CPU %, RSS, threads, read/write syscalls/sec, POSTs/sec and probe cadence error per target count."""
+    if not sys.platform.startswith("linux"):
+        return {"skipped": "needs /proc/<pid>/io (Linux)"}
+    results = {}
+    for n in target_counts:
+        targets = [f"10.{i // 250}.{i % 250 + 1}.1" for i in range(n)]
+        collector = StandInCollector(targets=targets)
+        workdir = tempfile.mkdtemp(prefix="bench_agent_")
+        script = os.path.join(workdir, "client_ping.py")  # own SCRIPT_DIR: logs/spool stay out of the tree
+        shutil.copy2(client_ping.__file__, script)
+        env = dict(os.environ, SERVER_URL=collector.url, PING_INTERVAL=str(interval), POLL_INTERVAL="5")
+        proc = psutil.Popen(agent_command(script), env=env, cwd=workdir,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            t0 = time.monotonic()
+            while not any(e == "/push_ping" for e, _ in collector.received[-50:]):
+                if time.monotonic() - t0 > 120 or proc.poll() is not None:
+                    raise RuntimeError(f"agent sent no /push_ping (exit code {proc.poll()})")
+                time.sleep(0.2)
+            startup = time.monotonic() - t0
+            time.sleep(warmup)
+            a = _agent_sample(proc, collector)
+            start = math.ceil(time.time())  # payload timestamps are whole seconds
+            time.sleep(duration)
+            b = _agent_sample(proc, collector)
+            end = math.floor(time.time())
+            window = b["time"] - a["time"]
+            time.sleep(client_ping.REPORT_FLUSH_INTERVAL * 3)  # let samples stamped inside the window arrive
+            results[n] = {
+                "startup_to_first_ping_s": round(startup, 2),
+                "cpu_percent": round((b["cpu"] - a["cpu"]) / window * 100, 2),
+                "rss_mb": round(proc.memory_info().rss / 2**20, 1),
+                "threads": proc.num_threads(),
+                "rw_syscalls_per_sec": round((b["syscalls"] - a["syscalls"]) / window, 1),
+                "posts_per_sec": round((b["posts"] - a["posts"]) / window, 2),
+                "samples_per_sec": round((b["received"] - a["received"]) / window, 1),
+                "cadence_error": _cadence_error(collector.received, interval, start, end),
+            }
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except psutil.TimeoutExpired:
+                proc.kill()
+            collector.close()
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def bench_metrics(calls=200000):
+    """Self metrics: hot-path cost of observe()/inc() and a real /metrics scrape of the agent."""
+    hist = client_ping.MetricHistogram("bench_seconds", "bench", "loop")
+    counter = client_ping.MetricCounter("bench_total", "bench", "endpoint")
+    t0 = time.perf_counter()
+    for i in range(calls):
+        hist.observe(0.0123, "ping_loop")
+    observe_ns = (time.perf_counter() - t0) * 1e9 / calls
+    t0 = time.perf_counter()
+    for i in range(calls):
+        counter.inc("/push_ping")
+    inc_ns = (time.perf_counter() - t0) * 1e9 / calls
+
+    # Scrape a running agent (fake backends) and check the expected series are there
+    collector = StandInCollector(targets=["10.0.0.1", "10.0.0.2"])
+    workdir = tempfile.mkdtemp(prefix="bench_metrics_")
+    script = os.path.join(workdir, "client_ping.py")
+    shutil.copy2(client_ping.__file__, script)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    env = dict(os.environ, SERVER_URL=collector.url, METRICS_PORT=str(port))
+    proc = subprocess.Popen(agent_command(script), env=env, cwd=workdir,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    text, render_ms = "", None
+    try:
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline and "client_ping_schedule_lag_seconds_count{loop=\"ping_loop\"}" not in text:
+            time.sleep(1)
+            try:
+                t0 = time.perf_counter()
+                text = requests.get(f"http://127.0.0.1:{port}/metrics", timeout=2).text
+                render_ms = (time.perf_counter() - t0) * 1000
+            except requests.RequestException:
+                pass
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+        collector.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    expected = ["client_ping_probe_duration_seconds_count", 'client_ping_post_latency_seconds_count{endpoint="/push_compact"}',
+                'loop="ping_loop"', 'loop="system_stats_loop"', 'loop="network_speed_loop"',
+                "client_ping_reporter_queue_depth"]
+    return {
+        "observe_ns": round(observe_ns), "inc_ns": round(inc_ns),
+        "scrape_ms": round(render_ms, 2) if render_ms is not None else None,
+        "series_lines": sum(1 for line in text.splitlines() if line and not line.startswith("#")),
+        "missing": [name for name in expected if name not in text],
+    }
+
+
+class LocalListener:
+    """Local TCP (or TLS, given a certificate) listener that accepts connections and closes them.
+    handler(conn) may talk to each accepted connection first (used for the RTMP responder)."""
+    def __init__(self, certfile=None, keyfile=None, handler=None):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        self.accepted = 0
+        self.handler = handler
+        self.context = None
+        if certfile:
+            import ssl
+            self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.context.load_cert_chain(certfile, keyfile)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.accepted += 1
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # like a real ingest server
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        try:
+            if self.context is not None:
+                conn = self.context.wrap_socket(conn, server_side=True)
+            if self.handler is not None:
+                self.handler(conn)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+
+
+def _self_signed_cert(workdir):
+    """(certfile, keyfile) made with the openssl CLI, or None if it isn't installed."""
+    if not shutil.which("openssl"):
+        return None
+    cert, key = os.path.join(workdir, "cert.pem"), os.path.join(workdir, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+def bench_connect(count=200):
+    """TCP connect / TLS handshake probes against local listeners: correctness, timing split and CPU per probe."""
+    import asyncio
+    workdir = tempfile.mkdtemp(prefix="bench_connect_")
+    with patched(client_ping, TLS_PROBE_VERIFY=False, _tls_probe_context=None):  # self-signed local certificate
+        listeners = {"tcp": LocalListener()}
+        cert = _self_signed_cert(workdir)
+        if cert:
+            listeners["tls"] = LocalListener(*cert)
+        closed = socket.socket()
+        closed.bind(("127.0.0.1", 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()  # nothing listens here: refused connections must fail fast
+
+        async def run(target, n):
+            return [await client_ping.async_connect_probe(target) for _ in range(n)]
+
+        results = {}
+        for kind, listener in listeners.items():
+            target = f"{kind}://127.0.0.1:{listener.port}"
+            cpu0, t0 = _cpu_seconds(), time.perf_counter()
+            probes = asyncio.run(run(target, count))
+            elapsed, cpu = time.perf_counter() - t0, _cpu_seconds() - cpu0
+            ok = [p for p in probes if p[0]]
+            results[kind] = {
+                "success": f"{len(ok)}/{count}",
+                "avg_rtt_ms": round(sum(p[1] for p in ok) / max(len(ok), 1), 3),
+                "avg_tcp_connect_ms": round(sum(p[3]["tcp_connect_ms"] for p in ok) / max(len(ok), 1), 3),
+                "avg_tls_handshake_ms": round(sum(p[3].get("tls_handshake_ms", 0) for p in ok) / max(len(ok), 1), 3),
+                "probes_per_sec": round(count / elapsed),
+                "cpu_ms_per_probe": round(cpu * 1000 / count, 3),
+                "accepted_by_listener": listener.accepted,
+                "sample_raw": probes[0][2],
+            }
+            listener.close()
+        refused = asyncio.run(run(f"tcp://127.0.0.1:{closed_port}", 1))[0]
+        results["refused"] = {"success": refused[0], "raw": refused[2]}
+        if not cert:
+            results["tls"] = {"skipped": "openssl not installed"}
+    shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def _recv_exactly(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise OSError("client closed")
+        data += chunk
+    return data
+
+
+def rtmp_handshake_responder(conn, delay=0.0):
+    """Minimal RTMP server side of the handshake: C0+C1 -> (delay seconds) S0+S1+S2, then wait for C2 and close."""
+    c0c1 = _recv_exactly(conn, 1 + 1536)
+    time.sleep(delay)
+    conn.sendall(b"\x03" + bytes(8) + os.urandom(1528) + c0c1[1:])
+    _recv_exactly(conn, 1536)
+
+
+def bench_rtmp(count=100, delay_ms=50):
+    """RTMP handshake probe against a local responder (RTMP and RTMPS), one answering delay_ms late,
+    a non-RTMP server, and via ping_loop against a server slow to answer the handshake (the
+    handshake must not cost probe slots)."""
+    import asyncio
+    workdir = tempfile.mkdtemp(prefix="bench_rtmp_")
+    with patched(client_ping, TLS_PROBE_VERIFY=False, _tls_probe_context=None):  # self-signed local certificate
+        listeners = {"tcp": LocalListener(handler=rtmp_handshake_responder)}
+        cert = _self_signed_cert(workdir)
+        if cert:
+            listeners["tls"] = LocalListener(*cert, handler=rtmp_handshake_responder)
+        silent = LocalListener()  # accepts and closes without speaking RTMP
+
+        async def run(target, n):
+            return [await client_ping.async_rtmp_handshake_probe(target) for _ in range(n)]
+
+        results = {}
+        for kind, listener in listeners.items():
+            cpu0 = _cpu_seconds()
+            probes = asyncio.run(run(f"{kind}://127.0.0.1:{listener.port}", count))
+            cpu = _cpu_seconds() - cpu0
+            ok = [p["rtmp_handshake_ms"] for p in probes if p["rtmp_handshake_ms"] > 0]
+            results[kind] = {
+                "success": f"{len(ok)}/{count}",
+                "avg_handshake_ms": round(sum(ok) / max(len(ok), 1), 3),
+                "cpu_ms_per_probe": round(cpu * 1000 / count, 3),
+                "errors": sorted({p["rtmp_error"] for p in probes if "rtmp_error" in p}),
+            }
+        delayed = LocalListener(handler=lambda conn: rtmp_handshake_responder(conn, delay_ms / 1000))
+        timings = [p["rtmp_handshake_ms"] for p in asyncio.run(run(f"tcp://127.0.0.1:{delayed.port}", 5))]
+        results["delayed"] = {"server_delay_ms": delay_ms, "min_handshake_ms": min(timings),
+                              "max_handshake_ms": max(timings)}
+        delayed.close()
+        results["not_rtmp"] = asyncio.run(run(f"tcp://127.0.0.1:{silent.port}", 1))[0]
+
+        # End to end: a tcp:// target on the probe scheduler carries rtmp_handshake_ms in its payload
+        collector = StandInCollector()
+        slow = LocalListener(handler=lambda conn: rtmp_handshake_responder(conn, 1.0))
+        target, interval, duration = f"tcp://127.0.0.1:{slow.port}", 0.2, 3
+        with patched(client_ping, collectors=client_ping.CollectorPool([collector.url]), PING_INTERVAL=interval):
+            scheduler = client_ping.ProbeScheduler()
+            scheduler.set_targets([target])
+            time.sleep(duration)
+            scheduler.stop()
+            client_ping.reporter.drain()
+        pings = [p for e, p in collector.received if e == "/push_ping" and p["target"] == target]
+        with_rtmp = [p for p in pings if "rtmp_handshake_ms" in p]
+        results["ping_loop"] = {
+            "samples": len(pings),
+            "expected_samples": round(duration / interval),
+            "with_rtmp_handshake": len(with_rtmp),
+            "first_with_rtmp": {k: with_rtmp[0].get(k) for k in ("probe", "rtt_ms", "tcp_connect_ms", "rtmp_handshake_ms")}
+                               if with_rtmp else None,
+        }
+        slow.close()
+        collector.close()
+        for listener in list(listeners.values()) + [silent]:
+            listener.close()
+        if not cert:
+            results["tls"] = {"skipped": "openssl not installed"}
+    shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+FAKE_PING = r"""#!{python}
+# iputils-style ping stand-in for benchmarks: -c COUNT, -i INTERVAL, last arg is the address.
+# FAKE_PING_DROP_EVERY=k leaves out every k-th reply, FAKE_PING_EXIT_AFTER=n exits after n replies.
+import os, sys, time
+args = sys.argv[1:]
+count = int(args[args.index("-c") + 1]) if "-c" in args else None
+interval = float(args[args.index("-i") + 1]) if "-i" in args else 1.0
+drop_every = int(os.environ.get("FAKE_PING_DROP_EVERY", "0"))
+exit_after = int(os.environ.get("FAKE_PING_EXIT_AFTER", "0"))
+address = args[-1]
+print(f"PING {{address}} ({{address}}) 56(84) bytes of data.", flush=True)
+seq = 0
+while count is None or seq < count:
+    seq += 1
+    if not (drop_every and seq % drop_every == 0):
+        print(f"64 bytes from {{address}}: icmp_seq={{seq}} ttl=64 time=0.{{seq % 90 + 10}} ms", flush=True)
+    if exit_after and seq >= exit_after:
+        sys.exit(0)
+    if count is None or seq < count:
+        time.sleep(interval)
+print(f"--- {{address}} ping statistics ---", flush=True)
+"""
+
+
+def _install_fake_ping(workdir):
+    path = os.path.join(workdir, "ping")
+    with open(path, "w") as f:
+        f.write(FAKE_PING.format(python=sys.executable))
+    os.chmod(path, 0o755)
+    os.environ["PATH"] = workdir + os.pathsep + os.environ["PATH"]
+
+
+def bench_continuous(targets=10, duration=10, interval=0.2):
+    """Ping command fallback: one process per probe vs. one long-running ping per target
+    (process creations, CPU incl. children), plus sequence-gap loss detection and restart on exit."""
+    if sys.platform.startswith("win"):
+        return {"skipped": "fake ping script needs a POSIX shell"}
+    workdir = tempfile.mkdtemp(prefix="bench_continuous_")
+    saved_path = os.environ["PATH"]
+    _install_fake_ping(workdir)
+    collector = StandInCollector()
+    addresses = [f"127.0.3.{i + 1}" for i in range(targets)]
+    results = {}
+    try:
+        with patched(client_ping, collectors=client_ping.CollectorPool([collector.url]), PING_INTERVAL=interval,
+                     PROBE_BACKEND=client_ping.PROBE_BACKEND,
+                     CONTINUOUS_PING_RESTART_DELAY=client_ping.CONTINUOUS_PING_RESTART_DELAY):
+            for mode, spawn_label in (("subprocess", "ping"), ("continuous", "ping-continuous")):
+                client_ping.PROBE_BACKEND = mode
+                spawns0 = client_ping.SUBPROCESS_SPAWNS.value(spawn_label)
+                cpu0 = _cpu_seconds()
+                scheduler = client_ping.ProbeScheduler()
+                scheduler.set_targets(addresses)
+                time.sleep(duration)
+                scheduler.stop()
+                time.sleep(1)  # killed continuous pings are reaped, so their CPU is counted
+                results[mode] = {
+                    "process_creations": client_ping.SUBPROCESS_SPAWNS.value(spawn_label) - spawns0,
+                    "cpu_ms_per_sec": round((_cpu_seconds() - cpu0) * 1000 / duration, 1),
+                }
+            samples = sum(1 for e, p in collector.received if e == "/push_ping")
+            results["push_ping_samples"] = samples
+
+            # Loss by sequence gap (every 5th reply missing) and restart after the process exits
+            os.environ["FAKE_PING_DROP_EVERY"], os.environ["FAKE_PING_EXIT_AFTER"] = "5", "20"
+            client_ping.CONTINUOUS_PING_RESTART_DELAY = 0.1
+            pinger = client_ping.ContinuousPinger("gap-test", "127.0.3.250", 0.2)
+            pinger.start()
+            time.sleep(10)  # ~2 processes of 20 sequence numbers each
+            pinger.stop()
+            got, _ = pinger.take_results()
+            results["gap_detection"] = {
+                "replies": sum(1 for r in got if r[0]),
+                "losses": sum(1 for r in got if not r[0]),
+                # per process: seqs 5, 10, 15 missing out of 19 (seq 20 is dropped and then the process exits)
+                "expected_loss_pct": 15.8,
+                "measured_loss_pct": round(100 * sum(1 for r in got if not r[0]) / max(len(got), 1), 1),
+                "process_starts": pinger.spawns,
+            }
+            client_ping.reporter.drain()
+    finally:
+        os.environ.pop("FAKE_PING_DROP_EVERY", None)
+        os.environ.pop("FAKE_PING_EXIT_AFTER", None)
+        os.environ["PATH"] = saved_path
+        collector.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    results["note"] = "fake ping is a Python script, so per-process CPU is higher than a real ping binary"
+    return results
+
+
+class InjectedHopProber:
+    """Hop prober answering from a scripted path: hops[ttl - 1] = (address, rtt_ms, loss fraction) or None (silent)."""
+    kind = "injected"
+
+    def __init__(self, hops, destination, seed=3):
+        self.hops = hops
+        self.destination = destination
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.max_in_flight = self.in_flight = 0
+
+    async def probe(self, ip, ttl, timeout):
+        import asyncio
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            hop = self.hops[ttl - 1] if ttl <= len(self.hops) else self.hops[-1]
+            if hop is None or self.rng.random() < hop[2]:
+                await asyncio.sleep(timeout)
+                return None, None, False
+            await asyncio.sleep(hop[1] / 1000)
+            return hop[0], hop[1], hop[0] == self.destination
+        finally:
+            self.in_flight -= 1
+
+
+def bench_path(max_hops=30):
+    """Path tracer on an injected 8-hop path (one silent hop, one lossy hop), the degradation trigger and
+    its per-target rate limit through ping_loop, and the real prober against 127.0.0.1."""
+    import asyncio
+    destination = "203.0.113.9"
+    hops = [("192.168.1.1", 1, 0), ("100.64.0.1", 4, 0), None, ("10.20.0.1", 9, 0),
+            ("198.51.100.7", 18, 0.5), ("198.51.100.9", 19, 0), ("203.0.113.1", 20, 0), (destination, 21, 0)]
+    prober = InjectedHopProber(hops, destination)
+    tracer = client_ping.PathTracer(prober, max_hops=max_hops, probes=10, timeout=0.2, spacing=0.01)
+    trace = asyncio.run(tracer.trace(destination))
+    results = {
+        "reached": trace["reached"],
+        "hops": [(h["ttl"], h["ip"], h["loss_pct"], h["rtt_avg_ms"]) for h in trace["hops"]],
+        "duration_ms": trace["duration_ms"],
+        "sequential_estimate_ms": round(sum(10 * (h[1] if h else 200) for h in hops) + 10 * 10 * len(hops)),
+        "max_probes_in_flight": prober.max_in_flight,
+    }
+
+    # Trigger: fake engine at 10 ms, then 80 ms; one trace per PATH_TRACE_MIN_INTERVAL
+    collector = StandInCollector()
+    engine = FakeProbeEngine(rtt_ms=10.0)
+    tracer = client_ping.PathTracer(InjectedHopProber(hops, destination), probes=3, timeout=0.2)
+    try:
+        with patched(client_ping, collectors=client_ping.CollectorPool([collector.url]), PING_INTERVAL=0.05,
+                     PATH_TRACE_MIN_INTERVAL=2, get_icmp_engine=lambda: engine, _path_tracer=tracer):
+            scheduler = client_ping.ProbeScheduler()
+            target = "127.0.4.1"
+            scheduler.set_targets([target])
+            time.sleep(2)
+            engine.rtt_ms = 80.0
+            time.sleep(4)
+            scheduler.stop()
+            client_ping.reporter.drain()
+    finally:
+        collector.close()
+    reports = [p for e, p in collector.received if e == "/push_path"]
+    results["trigger"] = {
+        "path_reports": len(reports),
+        "expected": "2 (at the jump, then once more after PATH_TRACE_MIN_INTERVAL)",
+        "reason": reports[0]["reason"] if reports else None,
+    }
+
+    if sys.platform.startswith("linux"):
+        real = asyncio.run(client_ping.PathTracer(client_ping._RecvErrHopProber(), max_hops=3).trace("127.0.0.1"))
+        results["loopback"] = {"reached": real["reached"], "hops": len(real["hops"])}
+    return results
+
+
+def bench_wire(targets=10, flushes=60, loss_every=25):
+    """Bytes per /push_ping sample on the wire: JSON /push_batch vs. compact session records,
+    for the first batch (contexts go along) and steady state; plus a round trip check."""
+    names = [f"10.0.{i // 250}.{i % 250 + 1}" for i in range(targets)]
+    random.seed(7)
+    batches = []
+    with patched(client_ping, client_isp_name="Link3 Technologies Limited",
+                 obs_stream_preview_ostream="https://ostream.example/play?streamName=abc123&x=1"):
+        for n in range(flushes):  # one flush per second, one sample per target (REPORT_FLUSH_INTERVAL=1)
+            batch = []
+            for t, target in enumerate(names):
+                if (n * targets + t) % loss_every == 0:
+                    payload = client_ping.build_ping_payload(target, -10.0, False, f"Request timeout for icmp_seq {n}")
+                else:
+                    rtt = round(random.uniform(8, 40), 3)
+                    payload = client_ping.build_ping_payload(
+                        target, rtt, True, f"64 bytes from {target}: icmp_seq={n} ttl=57 time={rtt} ms")
+                payload["timestamp"] += n
+                batch.append(("/push_ping", payload, 0.0))
+            batches.append(batch)
+    client_ping.invalidate_target_contexts()  # cached contexts carry the values patched in above
+    modes = [("batch_json", None, None), ("compact_json", "json", "identity"), ("compact_json_gzip", "json", "gzip")]
+    if client_ping.msgpack is not None:
+        modes.append(("compact_msgpack_gzip", "msgpack", "gzip"))
+    if client_ping.zstandard is not None:
+        modes.append(("compact_msgpack_zstd", "msgpack", "zstd"))
+    results = {}
+    http = requests.Session()
+    for mode, encoding, compression in modes:
+        collector = StandInCollector()
+        collector.encoding, collector.compression = encoding, compression
+        wire = client_ping.CompactWireSession()
+        sizes = []
+        cpu0 = _cpu_seconds()
+        with patched(client_ping, collectors=client_ping.CollectorPool([collector.url])):
+            for batch in batches:
+                before = sum(collector.bytes.values())
+                if encoding is None:
+                    body = {"computer_name": client_ping.AGENT_NAME,
+                            "items": [{"endpoint": e, "payload": p} for e, p, _ in batch]}
+                    client_ping.post_json(http, "/push_batch", body)
+                else:
+                    wire.send(http, batch)
+                sizes.append(sum(collector.bytes.values()) - before)
+        cpu_ms = (_cpu_seconds() - cpu0) * 1000
+        sent = [p for batch in batches for _, p, _ in batch]
+        mismatched = sum(1 for (_, got), want in zip(collector.received, sent)
+                         if got != want and dict(got, raw=want["raw"]) != want)
+        failures_kept = all(got["raw"] for _, got in collector.received if not got["success"])
+        results[mode] = {
+            "first_batch_bytes_per_sample": round(sizes[0] / targets, 1),
+            "steady_bytes_per_sample": round(sum(sizes[1:]) / (targets * (flushes - 1)), 1),
+            "cpu_ms_per_flush": round(cpu_ms / flushes, 3),
+            "register_bytes": collector.bytes.get("/register_session", 0),
+            "round_trip_ok": len(collector.received) == len(sent) and mismatched == 0 and failures_kept,
+        }
+        collector.close()
+    base = results["batch_json"]["steady_bytes_per_sample"]
+    for mode in results:
+        results[mode]["vs_batch_json"] = round(results[mode]["steady_bytes_per_sample"] / base, 3)
+    return results
+
+
+def _free_port(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def bench_relay(agents=5, targets=10, duration=20, interval=1.0):
+    """agents + 1 agent subprocesses (fake backends) uploading direct vs. through one of them acting
+    as LAN relay (found by discovery): collector POSTs/sec and bytes/sec, then the relay is
+    killed and the others must fall back to direct upload without losing samples."""
+    results = {}
+    script_dir = tempfile.mkdtemp(prefix="bench_relay_")
+    relay_port, discovery_port = _free_port(), _free_port(socket.SOCK_DGRAM)
+
+    def start(collector, name, **extra):
+        workdir = tempfile.mkdtemp(prefix=name + "_", dir=script_dir)
+        script = os.path.join(workdir, "client_ping.py")  # own SCRIPT_DIR: own logs and spool
+        shutil.copy2(client_ping.__file__, script)
+        env = dict(os.environ, SERVER_URL=collector.url, PING_INTERVAL=str(interval), POLL_INTERVAL="5",
+                   AGENT_NAME=name, RELAY_TOKEN="bench-site", **extra)
+        return psutil.Popen(agent_command(script), env=env, cwd=workdir,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def names_reporting(collector, start_ts):
+        return {p["computer_name"] for e, p in list(collector.received)
+                if e == "/push_ping" and p["timestamp"] >= start_ts}
+
+    def per_agent_loss(collector, start_ts, end_ts, names):
+        expected = (end_ts - start_ts) / interval * targets
+        got = {}
+        for e, p in list(collector.received):
+            if e == "/push_ping" and start_ts <= p["timestamp"] < end_ts:
+                got[p["computer_name"]] = got.get(p["computer_name"], 0) + 1
+        return {n: round(max(0.0, 1 - got.get(n, 0) / expected) * 100, 1) for n in names}
+
+    client_env = dict(RELAY_URL="auto", RELAY_DISCOVERY_ADDRESS="127.0.0.1",
+                      RELAY_DISCOVERY_PORT=str(discovery_port), RELAY_RETRY="5")
+    for mode in ("direct", "relay"):
+        collector = StandInCollector(targets=[f"10.0.{i}.1" for i in range(targets)])
+        procs = {}
+        try:
+            if mode == "relay":
+                procs["relay"] = start(collector, "relay", RELAY_MODE="serve", RELAY_PORT=str(relay_port),
+                                       RELAY_BIND="127.0.0.1", RELAY_DISCOVERY_PORT=str(discovery_port))
+                time.sleep(2)  # relay listening before the others look for it
+            for i in range(agents if mode == "relay" else agents + 1):
+                procs[f"agent{i}"] = start(collector, f"agent{i}", **(client_env if mode == "relay" else {}))
+            t0 = time.monotonic()
+            while len(names_reporting(collector, 0)) < len(procs):
+                if time.monotonic() - t0 > 120:
+                    raise RuntimeError(f"only {sorted(names_reporting(collector, 0))} reporting")
+                time.sleep(0.5)
+            time.sleep(5)
+            posts0, bytes0, start_ts = collector.posts, sum(collector.bytes.values()), math.ceil(time.time())
+            time.sleep(duration)
+            window = time.time() - start_ts
+            posts1, bytes1, end_ts = collector.posts, sum(collector.bytes.values()), math.floor(time.time())
+            time.sleep(3)
+            result = {
+                "agents": len(procs),
+                "collector_posts_per_sec": round((posts1 - posts0) / window, 2),
+                "collector_bytes_per_sec": round((bytes1 - bytes0) / window),
+                "max_loss_pct": max(per_agent_loss(collector, start_ts, end_ts, procs).values()),
+            }
+            if mode == "relay":
+                kill_ts = math.ceil(time.time())
+                procs.pop("relay").kill()
+                time.sleep(duration)
+                end_ts = math.floor(time.time())
+                time.sleep(3)
+                loss = per_agent_loss(collector, kill_ts, end_ts, procs)
+                result["after_relay_killed"] = {"max_loss_pct": max(loss.values()),
+                                                "agents_reporting": len(names_reporting(collector, end_ts - 5))}
+            results[mode] = result
+        finally:
+            for proc in procs.values():
+                proc.terminate()
+            for proc in procs.values():
+                try:
+                    proc.wait(timeout=10)
+                except psutil.TimeoutExpired:
+                    proc.kill()
+            collector.close()
+    shutil.rmtree(script_dir, ignore_errors=True)
+    return results
+
+
+def bench_failover(posts=40):
+    """Collector pool against stand-ins that fail in different ways: refused port, 503s,
+    a blackhole (accepts, never answers), a slow one and healthy ones. Checks every push lands,
+    that failover sticks, and what hedging does to latency."""
+    results = {}
+    http = requests.Session()
+    refused = f"http://127.0.0.1:{_free_port()}"
+    blackhole = socket.socket()
+    blackhole.bind(("127.0.0.1", 0))
+    blackhole.listen(64)
+    blackhole_url = f"http://127.0.0.1:{blackhole.getsockname()[1]}"
+    broken, healthy, standby = StandInCollector(), StandInCollector(), StandInCollector()
+    broken.fail_status = 503
+    servers = [broken, healthy, standby]
+    saved_pool = client_ping.collectors
+    try:
+        # 1. dead primary, 503 and blackhole in front of the healthy one
+        pool = client_ping.collectors = client_ping.CollectorPool([refused, broken.url, blackhole_url, healthy.url])
+        t0 = time.perf_counter()
+        for i in range(posts):
+            client_ping.post_json(http, "/push_ping", {"seq": i}, timeout=2)
+            if i == 0:
+                first = time.perf_counter() - t0
+        seqs = [p["seq"] for _, p in healthy.received]
+        results["dead_primary"] = {
+            "delivered": f"{len(set(seqs))}/{posts}", "duplicates": len(seqs) - len(set(seqs)),
+            "first_post_s": round(first, 2),  # walks refused, 503 and blackhole (2 s timeout) once
+            "total_s": round(time.perf_counter() - t0, 2),
+            "primary": pool.url() == healthy.url,
+            "requests_to_broken": broken.posts,
+        }
+
+        # 2. primary dies mid-run, comes back: stays on the standby (sticky)
+        a, b = healthy, standby
+        a.received.clear()
+        pool = client_ping.collectors = client_ping.CollectorPool([a.url, b.url])
+        for i in range(posts):
+            if i == posts // 3:
+                a.fail_status = 503
+            if i == 2 * posts // 3:
+                a.fail_status = None
+            client_ping.post_json(http, "/push_ping", {"seq": i})
+        seqs = sorted(p["seq"] for _, p in a.received + b.received)
+        results["primary_dies"] = {
+            "delivered": f"{len(seqs)}/{posts}", "duplicates": len(seqs) - len(set(seqs)),
+            "on_a": len(a.received), "on_b": len(b.received), "sticky": pool.url() == b.url,
+        }
+
+        # 3. hedged POSTs with a slow primary
+        slow, fast = standby, healthy
+        slow.delay, fast.fail_status = 1.0, None
+        for hedge in (False, True):
+            pool = client_ping.collectors = client_ping.CollectorPool([slow.url, fast.url])
+            latencies = []
+            for i in range(10):
+                t = time.perf_counter()
+                client_ping.post_json(http, "/push_client_info", {"seq": i}, hedge=hedge)
+                latencies.append((time.perf_counter() - t) * 1000)
+            latencies.sort()
+            results["hedged" if hedge else "not_hedged"] = {
+                "p50_ms": round(latencies[len(latencies) // 2], 1), "max_ms": round(latencies[-1], 1),
+                "hedges_won": client_ping.HEDGED_REQUESTS.value("hedge"),
+            }
+
+        # 4. health checks move a healthy-but-slow primary to a much faster standby
+        slow.delay = 0.3
+        pool = client_ping.collectors = client_ping.CollectorPool([slow.url, fast.url])
+        for i in range(3):
+            client_ping.post_json(http, "/push_ping", {"seq": i})
+        before = pool.url() == slow.url
+        pool.check()
+        results["latency_switch"] = {"primary_before_is_slow": before, "primary_after_is_fast": pool.url() == fast.url,
+                                     "collectors": pool.stats()["collectors"]}
+    finally:
+        client_ping.collectors = saved_pool
+        for server in servers:
+            server.close()
+        blackhole.close()
+    return results
+
+
+def bench_targets(changes=5, idle=30):
+    """Target list delivery per server kind (old plain server, ETag, long-poll, SSE) to an agent
+    subprocess with the default TARGETS_SUBSCRIBE=auto: how fast a server-side change starts
+    probes (until its first /push_ping arrives), and what serving /get_targets costs per minute."""
+    results = {}
+    for protocol in ("plain", "etag", "longpoll", "sse"):
+        collector = StandInCollector(targets=["10.0.0.1", "10.0.0.2"], targets_protocol=protocol)
+        workdir = tempfile.mkdtemp(prefix="bench_targets_")
+        script = os.path.join(workdir, "client_ping.py")
+        shutil.copy2(client_ping.__file__, script)
+        env = dict(os.environ, SERVER_URL=collector.url, POLL_INTERVAL="5", REPORT_FLUSH_INTERVAL="0.1")
+        proc = psutil.Popen(agent_command(script), env=env, cwd=workdir,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        seen = 0
+
+        def wait_for(target, timeout=30):
+            nonlocal seen
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                received = collector.received
+                for _, payload in received[seen:]:
+                    if payload.get("target") == target:
+                        seen = len(received)
+                        return True
+                time.sleep(0.01)
+            return False
+
+        try:
+            if not wait_for("10.0.0.2", 120):
+                raise RuntimeError(f"agent sent no /push_ping (exit code {proc.poll()})")
+            time.sleep(8)  # let the subscription settle
+            delays = []
+            for k in range(changes):
+                time.sleep(random.uniform(2, 6))
+                target = f"10.9.{k}.1"
+                t0 = time.monotonic()
+                collector.set_targets(collector.targets + [target])
+                delays.append((time.monotonic() - t0) * 1000 if wait_for(target) else None)
+            requests0, bytes0 = collector.target_requests, collector.target_bytes
+            time.sleep(idle)
+            got = [d for d in delays if d is not None]
+            results[protocol] = {
+                "changes_seen": f"{len(got)}/{changes}",
+                "avg_change_to_probe_ms": round(sum(got) / len(got)) if got else None,
+                "max_change_to_probe_ms": round(max(got)) if got else None,
+                "idle_target_requests_per_min": round((collector.target_requests - requests0) * 60 / idle, 1),
+                "idle_target_bytes_per_min": round((collector.target_bytes - bytes0) * 60 / idle),
+                "not_modified": collector.not_modified,
+            }
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except psutil.TimeoutExpired:
+                proc.kill()
+            collector.close()
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+class Supervisor:
+    """Restarts the agent script whenever it exits, like NSSM does for the service."""
+    def __init__(self, script, env, restart_delay=1.0):
+        self.script, self.env, self.restart_delay = script, env, restart_delay
+        self.starts = 0
+        self.proc = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.starts += 1
+            self.proc = psutil.Popen(agent_command(self.script), env=self.env, cwd=os.path.dirname(self.script),
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.proc.wait()
+            self._stop.wait(self.restart_delay)
+
+    def stop(self):
+        self._stop.set()
+        for proc in [self.proc] + [p for p in psutil.process_iter(["cmdline"])
+                                   if {"--update-bridge", "--update-guard"} & set(p.info["cmdline"] or [])
+                                   and any(self.script in part for part in p.info["cmdline"])]:
+            try:
+                proc.kill()
+            except psutil.Error:
+                pass
+        self._thread.join(10)
+
+
+def bench_update(settle=15):
+    """Rolling out a new build to an agent under a restart-on-exit supervisor: seconds without a
+    sample per target (and duplicate samples) for exit-and-restart vs. bridge handoff, plus
+    rollback of a build whose bridge fails, of one that crashes after taking over, of one
+    that crashes at import (rolled back by the previous build's guard) and of one that runs but
+    never gets telemetry through (rolled back, but not listed as bad, so it is tried again)."""
+    source = open(client_ping.__file__, "rb").read()
+    source = source.replace(b"UPDATE_GUARD_TIMEOUT = UPDATE_HEALTH_TIMEOUT + 60", b"UPDATE_GUARD_TIMEOUT = 20", 1)
+    source = source.replace(b"UPDATE_HEALTH_TIMEOUT = 120 ", b"UPDATE_HEALTH_TIMEOUT = 10  ", 1)
+    old_build = client_ping.CLIENT_BUILD
+    new_build = old_build + 1
+    new_code = source.replace(f"CLIENT_BUILD = {old_build}".encode(), f"CLIENT_BUILD = {new_build}".encode(), 1)
+    broken = {
+        "bridge_fails": new_code.replace(b'    """--update-bridge: probe', b'    os._exit(3)\n    """--update-bridge: probe', 1),
+        "crashes_after_takeover": new_code.replace(
+            b"    check_update_boot()  # first:", b"    check_update_boot(); os._exit(3)  # first:", 1),
+        "crashes_at_import": new_code.replace(b"import psutil\n", b"import psutil\nraise SystemExit(3)\n", 1),
+        "never_healthy": new_code.replace(b"            if reporter.sent > 0:  # delivered", b"            if False:  # delivered", 1),
+    }
+    targets = ["10.0.0.1", "10.0.0.2", "10.0.0.3"]
+    scenarios = [("restart", new_code, "0"), ("handoff", new_code, "1"),
+                 ("bridge_fails", broken["bridge_fails"], "1"),
+                 ("crashes_after_takeover", broken["crashes_after_takeover"], "1"),
+                 ("crashes_at_import", broken["crashes_at_import"], "0"),
+                 ("never_healthy", broken["never_healthy"], "0")]
+    results = {}
+    for name, release, handoff in scenarios:
+        collector = StandInCollector(targets=targets)
+        workdir = tempfile.mkdtemp(prefix="bench_update_")
+        script = os.path.join(workdir, "client_ping.py")
+        with open(script, "wb") as f:
+            f.write(source)
+        env = dict(os.environ, SERVER_URL=collector.url, UPDATE_HANDOFF=handoff, REPORT_FLUSH_INTERVAL="0.2")
+        supervisor = Supervisor(script, env)
+        try:
+            t0 = time.monotonic()
+            while not any(e == "/push_ping" for e, _ in collector.received[-20:]):
+                if time.monotonic() - t0 > 120:
+                    raise RuntimeError("agent sent no /push_ping")
+                time.sleep(0.2)
+            time.sleep(3)
+            released = time.time()
+            collector.set_release(release, new_build)
+            time.sleep(settle + 10 if name in ("restart", "handoff", "bridge_fails") else 40)
+            end = time.time()
+            time.sleep(1)
+            per_target, duplicates = {}, 0
+            for e, p in list(collector.received):
+                if e == "/push_ping" and released - 3 <= p["timestamp"] <= end - 2:
+                    seen = per_target.setdefault(p["target"], set())
+                    duplicates += p["timestamp"] in seen
+                    seen.add(p["timestamp"])
+            missing = {t: (int(end - 2) - int(released - 3) + 1) - len(seen) for t, seen in per_target.items()}
+            builds = [p["build"] for e, p in collector.received if e == "/push_agent_version"]
+            state = client_ping._read_json(os.path.join(workdir, "update_state.json"), {})
+            with open(script, "rb") as f:
+                on_disk = f.read()
+            results[name] = {
+                "service_starts": supervisor.starts,
+                "running_build": builds[-1] if builds else None,
+                "new_build_starts": builds.count(new_build),
+                "script_on_disk": "new" if on_disk == release else "old" if on_disk == source else "other",
+                "max_missing_seconds_per_target": max(missing.values()) if missing else None,
+                "duplicate_samples": duplicates,
+                "update_state": {k: state.get(k) for k in ("status", "boots", "bad_builds")},
+            }
+        finally:
+            supervisor.stop()
+            collector.close()
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def bench_startup(runs=3):
+    """Startup: import time and what importing leaves on disk, then process start -> first
+    /push_ping with the public IP/ISP lookups hanging (blackhole: accepts, never answers, so
+    each lookup waits out its 10 s timeout), without and with an identity cache from a previous run."""
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="bench_startup_")
+    script = os.path.join(workdir, "client_ping.py")
+    shutil.copy2(client_ping.__file__, script)
+    code = ("import sys, time; t = time.perf_counter(); sys.path.insert(0, '.'); import client_ping; "
+            "print((time.perf_counter() - t) * 1000)")
+    import_ms = [float(subprocess.check_output([sys.executable, "-B", "-c", code], cwd=workdir)) for _ in range(runs)]
+    results["import"] = {"ms": round(sorted(import_ms)[runs // 2], 1),
+                         "files_created": sorted(set(os.listdir(workdir)) - {"client_ping.py"})}
+
+    blackhole = socket.socket()
+    blackhole.bind(("127.0.0.1", 0))
+    blackhole.listen(64)
+    lookup_url = f"http://127.0.0.1:{blackhole.getsockname()[1]}/"
+    cache = {"local_ip": "192.168.40.26", "public_ip": "203.0.113.7", "isp": "Cached ISP", "time": time.time() - 3600}
+    try:
+        for mode in ("cold_cache", "warm_cache"):
+            first_probe, identity, client_info = [], None, []
+            for _ in range(runs):
+                collector = StandInCollector(targets=["10.0.0.1"])
+                for name in os.listdir(workdir):  # logs, spool and cache of the previous run
+                    path = os.path.join(workdir, name)
+                    if name not in ("client_ping.py", "run_agent.py"):
+                        shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+                if mode == "warm_cache":
+                    with open(os.path.join(workdir, "identity_cache.json"), "w") as f:
+                        json.dump(cache, f)
+                env = dict(os.environ, SERVER_URL=collector.url, REPORT_FLUSH_INTERVAL="0.05",
+                           IDENTITY_IP_URL=lookup_url, IDENTITY_ISP_URL=lookup_url)
+                t0 = time.monotonic()
+                proc = psutil.Popen(agent_command(script), env=env, cwd=workdir,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                try:
+                    ping = None
+                    while ping is None and time.monotonic() - t0 < 60:
+                        ping = next((p for e, p in list(collector.received) if e == "/push_ping"), None)
+                        time.sleep(0.01)
+                    first_probe.append(time.monotonic() - t0)
+                    identity = ping and {"isp": ping["isp"], "client_id": ping["client_id"]}
+                    while not any(e == "/push_client_info" for e, _ in list(collector.received)) and time.monotonic() - t0 < 60:
+                        time.sleep(0.05)
+                    client_info.append(time.monotonic() - t0)
+                finally:
+                    proc.terminate()
+                    proc.wait(timeout=10)
+                    collector.close()
+            results[mode] = {
+                "start_to_first_probe_s": round(sorted(first_probe)[runs // 2], 2),
+                "start_to_client_info_push_s": round(sorted(client_info)[runs // 2], 2),
+                "first_probe_identity": identity,
+            }
+    finally:
+        blackhole.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+BENCHMARKS = {
+    "probe": bench_probe,
+    "soak": bench_soak,
+    "outage": bench_outage,
+    "payload": bench_payload,
+    "parse": bench_parse,
+    "burst": bench_burst,
+    "histogram": bench_histogram,
+    "obs": bench_obs,
+    "config": bench_config,
+    "gpu": bench_gpu,
+    "client_info": bench_client_info,
+    "agent": bench_agent,
+    "metrics": bench_metrics,
+    "connect": bench_connect,
+    "rtmp": bench_rtmp,
+    "continuous": bench_continuous,
+    "path": bench_path,
+    "wire": bench_wire,
+    "relay": bench_relay,
+    "failover": bench_failover,
+    "targets": bench_targets,
+    "update": bench_update,
+    "startup": bench_startup,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    report = {}
+    for name in names:
+        print(f"== {name}: {BENCHMARKS[name].__doc__}")
+        report[name] = BENCHMARKS[name]()
+        print(json.dumps(report[name], indent=2))
+    print(json.dumps(report))
+    with open(BENCH_OUTPUT, "w") as f:
+        json.dump({"build": client_ping.CLIENT_BUILD, "python": sys.version.split()[0],
+                   "platform": sys.platform, "time": int(time.time()), "results": report}, f, indent=2)
+    print(f"Results written to {BENCH_OUTPUT}")
@@ -1,7 +1,11 @@
-import time, requests, subprocess, os, threading, platform, socket, sys, json, shutil
+import time, requests, subprocess, os, threading, platform, socket, sys, json, shutil, gzip
+import abc, asyncio, base64, bisect, collections, hashlib, hmac, ipaddress, math, re, select, shlex, ssl, struct
 import logging
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
 from logging.handlers import RotatingFileHandler
 from datetime import datetime
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import psutil
 
 # --------------- Version (Auto-Update) ---------------
@@ -83,6 +87,231 @@ def get_env_from_registry(name, default=""):
     # Strategy 4: Final fallback to os.environ
     return os.environ.get(name, default)
  
+# ---------------- Config Snapshot ----------------
+# Keys OBS (plugin) writes while running; kept in memory and pushed to subscribers on change
+WATCHED_CONFIG_KEYS = ("OBS_STREAMING_SERVERS", "OBS_STREAM_PREVIEW", "OBS_ICR_CODE", "OBS_STREAM_TITLE")
+_HKLM_ENV_PATH = r"SYSTEM\CurrentControlSet\Control\Session Manager\Environment"
+
+def _registry_env_sources():
+    """(root, path) of every Environment key, in get_env_from_registry's lookup order."""
+    sources = [(winreg.HKEY_CURRENT_USER, r"Environment")]
+    sources += [(winreg.HKEY_USERS, f"{sid}\\Environment") for sid in get_all_user_sids()]
+    sources.append((winreg.HKEY_LOCAL_MACHINE, _HKLM_ENV_PATH))
+    return sources
+
+def read_registry_values(names):
+    """Same result as get_env_from_registry(name, "") for each name, with one pass over the keys."""
+    values = {}
+    for root, path in _registry_env_sources():
+        try:
+            with winreg.OpenKey(root, path) as key:
+                for name in names:
+                    if name in values or (root == winreg.HKEY_USERS and not name.startswith("OBS_")):
+                        continue
+                    try:
+                        value, _ = winreg.QueryValueEx(key, name)
+                        if value:
+                            values[name] = value
+                    except (FileNotFoundError, OSError):
+                        pass
+        except (FileNotFoundError, OSError):
+            continue
+    for name in names:
+        values.setdefault(name, os.environ.get(name, ""))
+    return values
+
+class ConfigSource(abc.ABC):
+    """
+    In-memory snapshot of WATCHED_CONFIG_KEYS with change notification.
+    - get() is a dict lookup; the snapshot is refreshed by a watcher thread
+    - subscribe(callback): callback({name: new_value}) runs on the watcher thread
+      with only the keys that changed
+    - backends implement read_all() and wait_for_change(timeout); the default
+      wait_for_change is plain polling
+    """
+    poll_interval = 1.0
+    resync_interval = 30.0  # re-read even without a notification, in case one is missed
+
+    def __init__(self, keys=WATCHED_CONFIG_KEYS):
+        self.keys = tuple(keys)
+        self.snapshot = None
+        self.changes = 0
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @abc.abstractmethod
+    def read_all(self):
+        """{key: value} for every watched key, read from the backend now."""
+
+    def wait_for_change(self, timeout):
+        time.sleep(min(timeout, self.poll_interval))
+
+    def get(self, name, default=""):
+        if name not in self.keys:
+            return get_env_from_registry(name, default)
+        if self._thread is None or self.snapshot is None:
+            self.refresh()  # not watching yet: read live, like get_env_from_registry
+        return self.snapshot.get(name) or default
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def refresh(self):
+        values = self.read_all()
+        with self._lock:
+            old = self.snapshot or {}
+            changed = {k: v for k, v in values.items() if old.get(k) != v} if self.snapshot is not None else {}
+            self.snapshot = values
+        if changed:
+            self.changes += 1
+            for callback in self._subscribers:
+                try:
+                    callback(changed)
+                except Exception as e:
+                    log_print(f"[CONFIG] Subscriber error: {e}")
+        return changed
+
+    def start(self):
+        if self._thread is None:
+            self.refresh()
+            self._thread = threading.Thread(target=self._run, name="config-watch", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.wait_for_change(self.resync_interval)
+                self.refresh()
+            except Exception as e:
+                log_print(f"[CONFIG] Watch error: {e}")
+                time.sleep(self.poll_interval)
+
+class RegistryConfigSource(ConfigSource):
+    """
+    Windows backend: one pass over HKCU, every user SID and HKLM per refresh,
+    woken by RegNotifyChangeKeyValue on all those Environment keys (falls back
+    to cheap 1 s polling if notifications can't be armed).
+    """
+    def read_all(self):
+        return read_registry_values(self.keys)
+
+    def wait_for_change(self, timeout):
+        import ctypes
+        kernel32, advapi32 = ctypes.windll.kernel32, ctypes.windll.advapi32
+        kernel32.CreateEventW.restype = ctypes.c_void_p
+        kernel32.CreateEventW.argtypes = [ctypes.c_void_p, ctypes.c_bool, ctypes.c_bool, ctypes.c_wchar_p]
+        kernel32.WaitForMultipleObjects.argtypes = [ctypes.c_uint32, ctypes.POINTER(ctypes.c_void_p), ctypes.c_bool, ctypes.c_uint32]
+        kernel32.CloseHandle.argtypes = [ctypes.c_void_p]
+        advapi32.RegNotifyChangeKeyValue.argtypes = [ctypes.c_void_p, ctypes.c_bool, ctypes.c_uint32, ctypes.c_void_p, ctypes.c_bool]
+        REG_NOTIFY_CHANGE_LAST_SET = 0x4
+        keys, events = [], []
+        try:
+            for root, path in _registry_env_sources():
+                try:
+                    key = winreg.OpenKey(root, path, 0, winreg.KEY_NOTIFY | winreg.KEY_READ)
+                except OSError:
+                    continue
+                event = kernel32.CreateEventW(None, False, False, None)
+                if advapi32.RegNotifyChangeKeyValue(int(key), False, REG_NOTIFY_CHANGE_LAST_SET, event, True) != 0:
+                    kernel32.CloseHandle(event)
+                    key.Close()
+                    continue
+                keys.append(key)
+                events.append(event)
+            if not events:
+                return super().wait_for_change(timeout)
+            if self.read_all() != self.snapshot:
+                return  # changed before the notifications were armed
+            handles = (ctypes.c_void_p * len(events))(*events)
+            kernel32.WaitForMultipleObjects(len(events), handles, False, int(timeout * 1000))
+        finally:
+            for event in events:
+                kernel32.CloseHandle(event)
+            for key in keys:
+                key.Close()
+
+class FileConfigSource(ConfigSource):
+    """
+    Linux/macOS backend: os.environ overlaid with KEY=VALUE lines from CONFIG_FILE
+    (written by whatever drives OBS on that host). Woken by inotify on the file's
+    directory where available, otherwise polls the file's mtime.
+    """
+    def __init__(self, keys=WATCHED_CONFIG_KEYS, path=None):
+        super().__init__(keys)
+        self.path = path or CONFIG_FILE
+        self._inotify_fd = None
+
+    def read_all(self):
+        values = {name: os.environ.get(name, "") for name in self.keys}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    name, sep, value = line.strip().partition("=")
+                    if sep and name.strip() in values:
+                        values[name.strip()] = value.strip()
+        except FileNotFoundError:
+            pass
+        return values
+
+    def _open_inotify(self):
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x2, 0x8, 0x80, 0x100, 0x200
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        directory = os.path.dirname(os.path.abspath(self.path))
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        if libc.inotify_add_watch(fd, directory.encode(), mask) < 0:
+            os.close(fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+        return fd
+
+    def start(self):
+        # Watch before the first read so no write can fall between the two
+        if self._inotify_fd is None and platform.system().lower() == 'linux':
+            try:
+                self._inotify_fd = self._open_inotify()
+            except OSError as e:
+                log_print(f"[CONFIG] inotify unavailable ({e}) - polling {self.path}")
+                self._inotify_fd = -1
+        super().start()
+
+    def wait_for_change(self, timeout):
+        if self._inotify_fd is None or self._inotify_fd < 0:
+            return self._poll_mtime(timeout)
+        name = os.path.basename(self.path).encode()
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            readable, _, _ = select.select([self._inotify_fd], [], [], remaining)
+            if not readable:
+                return
+            data = os.read(self._inotify_fd, 65536)
+            offset = 0
+            while offset + 16 <= len(data):  # struct inotify_event {int wd; u32 mask, cookie, len; char name[];}
+                _, _, _, length = struct.unpack_from("iIII", data, offset)
+                event_name = data[offset + 16:offset + 16 + length].rstrip(b"\0")
+                offset += 16 + length
+                if event_name == name:
+                    return
+
+    def _poll_mtime(self, timeout):
+        def mtime():
+            try:
+                return os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                return None
+        start = mtime()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            if mtime() != start:
+                return
+
 SERVER_URL = get_env_from_registry("SERVER_URL", "http://ostreamping.ums.team:5010")
 #SERVER_URL = get_env_from_registry("SERVER_URL", "http://182.163.115.242:50100")
 
@@ -110,6 +339,10 @@ def get_agent_name():
  
 AGENT_NAME = get_agent_name()
 
+# Linux/macOS have no registry: OBS_* values can also come from this file (see FileConfigSource)
+CONFIG_FILE = get_env_from_registry("AGENT_ENV_FILE", os.path.join(SCRIPT_DIR, "agent.env"))
+config_source = RegistryConfigSource() if platform.system().lower() == 'windows' else FileConfigSource()
+
 # Global variables to store client info
 client_local_ip = "unknown"
 client_public_ip = "unknown"
@@ -131,16 +364,23 @@ obs_stream_preview_youtube = "unknown"
 
 # Setup logging for service mode
 LOG_DIR = os.path.join(SCRIPT_DIR, "logs")
-if not os.path.exists(LOG_DIR):
-    os.makedirs(LOG_DIR)
 
 # RotatingFileHandler: max 500KB per file, keep 2 backups = 1MB total max
 LOG_FILE = os.path.join(LOG_DIR, "client_ping.log")
 _logger = logging.getLogger("client_ping")
 _logger.setLevel(logging.INFO)
-_handler = RotatingFileHandler(LOG_FILE, maxBytes=500*1024, backupCount=2, encoding="utf-8")
-_handler.setFormatter(logging.Formatter("%(message)s"))
-_logger.addHandler(_handler)
+_handler = None  # opened by the first log_print, so importing the module doesn't touch the disk
+_handler_lock = threading.Lock()
+
+def _open_log_file():
+    global _handler
+    with _handler_lock:
+        if _handler is None:
+            os.makedirs(LOG_DIR, exist_ok=True)
+            handler = RotatingFileHandler(LOG_FILE, maxBytes=500*1024, backupCount=2, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            _logger.addHandler(handler)
+            _handler = handler
 
 def cleanup_old_logs(days=7):
     """Delete any .log files in the logs folder older than `days` days."""
@@ -168,8 +408,173 @@ def log_print(message):
     log_msg = f"[{timestamp}] {message}"
     print(log_msg)
     sys.stdout.flush()  # Important for service mode
+    if _handler is None:
+        _open_log_file()
     _logger.info(log_msg)
 
+# ---------------- Self Metrics ----------------
+# Optional Prometheus text endpoint for the agent's own health: http://127.0.0.1:METRICS_PORT/metrics
+METRICS_PORT = int(get_env_from_registry("METRICS_PORT", "0"))  # 0 = disabled
+METRICS_BIND = get_env_from_registry("METRICS_BIND", "127.0.0.1")
+
+# Seconds; covers sub-ms probes/POSTs up to multi-second stalls
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _metric_label_pair(label, value):
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{label}="{value}"'
+
+def _metric_labels(label, value):
+    return "" if label is None else "{" + _metric_label_pair(label, value) + "}"
+
+class MetricCounter:
+    """Monotonic counter, optionally split by one label. inc() is a dict update under a lock."""
+    kind = "counter"
+
+    def __init__(self, name, help_text, label=None):
+        self.name, self.help, self.label = name, help_text, label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value=None, amount=1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def value(self, label_value=None):
+        return self._values.get(label_value, 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda kv: str(kv[0]))
+        return [f"{self.name}{_metric_labels(self.label, k)} {v}" for k, v in values]
+
+class MetricHistogram:
+    """Fixed-bucket histogram, optionally split by one label. observe() is a bisect plus two adds."""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label=None, buckets=METRICS_LATENCY_BUCKETS):
+        self.name, self.help, self.label = name, help_text, label
+        self.buckets = tuple(buckets)
+        self._series = {}  # label value -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        with self._lock:
+            items = sorted(((k, list(v)) for k, v in self._series.items()), key=lambda kv: str(kv[0]))
+        lines = []
+        for label_value, series in items:
+            prefix = _metric_label_pair(self.label, label_value) + "," if self.label is not None else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            labels = _metric_labels(self.label, label_value)
+            lines.append(f"{self.name}_sum{labels} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class MetricGauge:
+    """Value read from a callback at scrape time, so the hot path pays nothing."""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, read):
+        self.name, self.help, self.read = name, help_text, read
+
+    def render(self):
+        try:
+            return [f"{self.name} {self.read()}"]
+        except Exception:
+            return []
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, label=None):
+        return self._add(MetricCounter(name, help_text, label))
+
+    def histogram(self, name, help_text, label=None, buckets=METRICS_LATENCY_BUCKETS):
+        return self._add(MetricHistogram(name, help_text, label, buckets))
+
+    def gauge(self, name, help_text, read):
+        return self._add(MetricGauge(name, help_text, read))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve GET /metrics from a daemon thread. Returns the server (server_address has the real port)."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+metrics = MetricsRegistry()
+PROBE_DURATION = metrics.histogram(
+    "client_ping_probe_duration_seconds", "Wall time of one probe (or burst) in ping_loop")
+POST_LATENCY = metrics.histogram(
+    "client_ping_post_latency_seconds", "Collector POST latency", "endpoint")
+SCHEDULE_LAG = metrics.histogram(
+    "client_ping_schedule_lag_seconds", "How late a loop iteration started versus its schedule", "loop")
+SUBPROCESS_SPAWNS = metrics.counter(
+    "client_ping_subprocess_spawns_total", "Child processes started", "command")
+ENDPOINT_ERRORS = metrics.counter(
+    "client_ping_errors_total", "Failed collector requests", "endpoint")
+
+# Shortened ISP names for Grafana (both underscore and space versions)
+ISP_DISPLAY_NAMES = {
+    "Link3_Technologies_Limited": "Link3",
+    "Link3 Technologies Limited": "Link3",
+    "Bangladesh_Online_Ltd": "BOL",
+    "Bangladesh Online Ltd": "BOL",
+    "Cloud_Point": "SDNF",
+    "Cloud Point": "SDNF",
+    "Amber_IT_Limited": "AmberIT",
+    "Amber IT Limited": "AmberIT",
+    "Mirnet": "BTS",
+    "Mirnet_Limited": "BTS",
+    "Mirnet Limited": "BTS",
+    "BTS_Communications_(BD)_Ltd": "BTS",
+    "BTS Communications (BD) Ltd": "BTS",
+    "BTS_Communications": "BTS",
+    "BTS Communications": "BTS"
+}
+
 def format_display_name(name, name_type="target"):
     """Format display names for better readability in Grafana.
     
@@ -187,41 +592,189 @@ def format_display_name(name, name_type="target"):
     
     elif name_type == "isp":
         # Shorten ISP names for better display
-        # Handle both underscore and space versions
-        isp_mappings = {
-            "Link3_Technologies_Limited": "Link3",
-            "Link3 Technologies Limited": "Link3",
-            "Bangladesh_Online_Ltd": "BOL",
-            "Bangladesh Online Ltd": "BOL",
-            "Cloud_Point": "SDNF",
-            "Cloud Point": "SDNF",
-            "Amber_IT_Limited": "AmberIT",
-            "Amber IT Limited": "AmberIT",
-            "Mirnet": "BTS",
-            "Mirnet_Limited": "BTS",
-            "Mirnet Limited": "BTS",
-            "BTS_Communications_(BD)_Ltd": "BTS",
-            "BTS Communications (BD) Ltd": "BTS",
-            "BTS_Communications": "BTS",
-            "BTS Communications": "BTS"
-        }
-        return isp_mappings.get(name, name)
+        return ISP_DISPLAY_NAMES.get(name, name)
     
     return name
 
-def resolve_target_to_ip(target):
-    """Resolve hostname/target to IP address."""
+# ---------------- DNS Cache ----------------
+DNS_DEFAULT_TTL = float(get_env_from_registry("DNS_DEFAULT_TTL", "60"))  # used when the resolver reports no TTL
+DNS_MIN_TTL = 5
+DNS_MAX_TTL = 3600
+DNS_REFRESH_AHEAD = 0.8     # refresh in the background after 80% of the TTL
+DNS_RETRY_INTERVAL = 10     # seconds between refresh attempts while the resolver fails
+DNS_IDLE_EVICT = 600        # forget names nobody asked for in 10 minutes
+DNS_EVICT_SWEEP = 60        # seconds between idle-eviction sweeps
+
+def system_resolver(host):
+    """Resolve host to (ip, ttl_seconds). TTL comes from dnspython when installed, else None."""
     try:
-        # Try to resolve hostname to IP
-        ip_address = socket.gethostbyname(target)
-        return ip_address
-    except:
-        # If resolution fails, check if target is already an IP
+        import dns.resolver
+        answer = dns.resolver.resolve(host, "A", lifetime=5)
+        return answer[0].to_text(), answer.rrset.ttl
+    except ImportError:
+        return socket.gethostbyname(host), None
+
+class DnsCache:
+    """
+    TTL-aware resolver cache for probe targets.
+    - resolve() only blocks on the first lookup of a name (or after it went idle)
+    - entries are refreshed by a background thread once DNS_REFRESH_AHEAD of the TTL has passed
+    - when the resolver fails, the last good address keeps being served (stale)
+    - names not looked up for DNS_IDLE_EVICT are dropped by a sweep that lookup() runs
+      every DNS_EVICT_SWEEP seconds (removed targets don't stay cached forever)
+    - resolution latency and hit/miss/failure counts are kept for stats()
+    The resolver is injectable: resolver(host) -> (ip, ttl or None), raising on failure.
+    """
+    def __init__(self, resolver=None, clock=time.monotonic):
+        self.resolver = resolver or system_resolver
+        self.clock = clock
+        self._entries = {}  # host -> {"ip", "expires", "refresh_at", "last_used"}
+        self._lock = threading.Lock()
+        self._refresh_queue = collections.deque()
+        self._refresh_wakeup = threading.Event()
+        self._thread = None
+        self._next_sweep = clock() + DNS_EVICT_SWEEP
+        self.hits = 0
+        self.misses = 0
+        self.stale_served = 0
+        self.failures = 0
+        self.evictions = 0
+        self.resolutions = 0
+        self.last_latency_ms = 0.0
+        self.max_latency_ms = 0.0
+        self.total_latency_ms = 0.0
+
+    def peek(self, host):
+        """Cached address for host without ever blocking (None if unknown)."""
+        if _is_ip_literal(host):
+            return host
+        entry = self._entries.get(host)
+        return entry["ip"] if entry else None
+
+    def lookup(self, host):
+        """Non-blocking: cached address (stale allowed), scheduling a refresh when due; None on a miss."""
+        if _is_ip_literal(host):
+            return host
+        now = self.clock()
+        if now >= self._next_sweep:
+            self._evict_idle(now)
+        entry = self._entries.get(host)
+        if entry is None:
+            return None
+        entry["last_used"] = now
+        if now >= entry["refresh_at"]:
+            self._schedule_refresh(host, entry)
+        if now >= entry["expires"]:
+            self.stale_served += 1
+        else:
+            self.hits += 1
+        return entry["ip"]
+
+    def resolve(self, host):
+        """Address for host, or None if it can't be resolved and nothing is cached."""
+        ip = self.lookup(host)
+        if ip is None:
+            self.misses += 1
+            ip = self._resolve_now(host)
+        return ip
+
+    def _resolve_now(self, host):
+        started = time.perf_counter()
         try:
-            socket.inet_aton(target)
-            return target  # It's already an IP
-        except:
+            ip, ttl = self.resolver(host)
+        except Exception as e:
+            self.failures += 1
+            with self._lock:
+                entry = self._entries.get(host)
+                if entry:
+                    entry["refresh_at"] = self.clock() + DNS_RETRY_INTERVAL
+                    entry.pop("refreshing", None)
+            if entry:
+                log_print(f"[DNS] Refresh failed for {host} ({e}) - serving stale {entry['ip']}")
+                return entry["ip"]
             return None
+        finally:
+            latency_ms = (time.perf_counter() - started) * 1000
+            self.resolutions += 1
+            self.last_latency_ms = latency_ms
+            self.total_latency_ms += latency_ms
+            self.max_latency_ms = max(self.max_latency_ms, latency_ms)
+            if latency_ms > 1000:
+                log_print(f"[DNS] Slow resolution for {host}: {latency_ms:.0f} ms")
+        ttl = min(DNS_MAX_TTL, max(DNS_MIN_TTL, ttl if ttl is not None else DNS_DEFAULT_TTL))
+        now = self.clock()
+        with self._lock:
+            previous = self._entries.get(host)
+            self._entries[host] = {
+                "ip": ip,
+                "expires": now + ttl,
+                "refresh_at": now + ttl * DNS_REFRESH_AHEAD,
+                "last_used": previous["last_used"] if previous else now,
+            }
+        return ip
+
+    def _schedule_refresh(self, host, entry):
+        with self._lock:
+            if entry.get("refreshing"):
+                return
+            entry["refreshing"] = True
+            self._refresh_queue.append(host)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._refresh_loop, name="dns-refresh", daemon=True)
+                self._thread.start()
+        self._refresh_wakeup.set()
+
+    def _refresh_loop(self):
+        while True:
+            self._refresh_wakeup.wait()
+            self._refresh_wakeup.clear()
+            while self._refresh_queue:
+                host = self._refresh_queue.popleft()
+                entry = self._entries.get(host)
+                if entry is None:
+                    continue
+                self._resolve_now(host)
+
+    def _evict_idle(self, now):
+        with self._lock:
+            self._next_sweep = now + DNS_EVICT_SWEEP
+            idle = [h for h, e in self._entries.items() if now - e["last_used"] > DNS_IDLE_EVICT]
+            for host in idle:
+                del self._entries[host]
+            self.evictions += len(idle)
+
+    def forget(self, host):
+        with self._lock:
+            self._entries.pop(host, None)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_served": self.stale_served,
+            "failures": self.failures,
+            "evictions": self.evictions,
+            "last_latency_ms": round(self.last_latency_ms, 1),
+            "max_latency_ms": round(self.max_latency_ms, 1),
+            "avg_latency_ms": round(self.total_latency_ms / self.resolutions, 1) if self.resolutions else 0.0,
+        }
+
+def _is_ip_literal(target):
+    try:
+        socket.inet_aton(target)
+        return target.count(".") == 3
+    except OSError:
+        return False
+
+dns_cache = DnsCache()
+
+def resolve_target_to_ip(target):
+    """Resolve hostname/target (or the host of a tcp:// / tls:// target spec) to IP address (cached, see DnsCache)."""
+    try:
+        return dns_cache.resolve(target_host(target))
+    except Exception:
+        return None
 
 # ---------------- Network Detection ----------------
 def get_local_ip():
@@ -243,16 +796,17 @@ def get_local_ip():
 def detect_obs_streaming_data():
     """Detect OBS streaming data from registry/environment variables."""
     global obs_icr_code, obs_stream_title, obs_stream_preview_ostream, obs_stream_preview_youtube
+    previous = (obs_stream_preview_ostream, obs_stream_preview_youtube)
     
     try:
         # Get OBS ICR Code
-        obs_icr_code = get_env_from_registry("OBS_ICR_CODE", "unknown")
+        obs_icr_code = config_source.get("OBS_ICR_CODE", "unknown")
         
         # Get OBS Stream Title
-        obs_stream_title = get_env_from_registry("OBS_STREAM_TITLE", "unknown")
+        obs_stream_title = config_source.get("OBS_STREAM_TITLE", "unknown")
         
         # Get OBS Stream Preview (contains 2 URLs separated by comma or pipe)
-        obs_stream_preview = get_env_from_registry("OBS_STREAM_PREVIEW", "")
+        obs_stream_preview = config_source.get("OBS_STREAM_PREVIEW", "")
         
         if obs_stream_preview:
             # Split the preview URLs - they might be separated by pipe | or comma
@@ -280,6 +834,9 @@ def detect_obs_streaming_data():
                     elif obs_stream_preview_youtube == "unknown":
                         obs_stream_preview_youtube = url
         
+        if (obs_stream_preview_ostream, obs_stream_preview_youtube) != previous:
+            invalidate_target_contexts()
+        
         log_print(f"OBS Streaming Data Detected: ICR Code={obs_icr_code}, Title={obs_stream_title}")
         log_print(f"  Preview URLs - OStream={obs_stream_preview_ostream}, YouTube={obs_stream_preview_youtube}")
         return True
@@ -287,37 +844,168 @@ def detect_obs_streaming_data():
         log_print(f"Failed to detect OBS streaming data: {e}")
         return False
 
+# Public IP / ISP lookups; ip-api answers for the caller's address when none is appended
+IDENTITY_IP_URL = get_env_from_registry("IDENTITY_IP_URL", "https://api.ipify.org?format=json")
+IDENTITY_ISP_URL = get_env_from_registry("IDENTITY_ISP_URL", "http://ip-api.com/json/")
+# Last detected identity, used from the next start until the lookups answer again
+IDENTITY_CACHE_FILE = os.path.join(SCRIPT_DIR, "identity_cache.json")
+
+def _lookup_json(url):
+    return requests.get(url, timeout=10).json()
+
 def detect_client_info():
-    """Detect local IP, public IP, and ISP name."""
+    """Detect local IP, public IP, and ISP name (both lookups at once). Values a lookup
+    couldn't get keep what we had, e.g. from the identity cache."""
     global client_local_ip, client_public_ip, client_isp_name
+    previous = (client_local_ip, client_isp_name)
     
     # Detect local IP
     client_local_ip = get_local_ip()
     
     try:
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="identity") as pool:
+            ip_lookup = pool.submit(_lookup_json, IDENTITY_IP_URL)
+            isp_lookup = pool.submit(_lookup_json, IDENTITY_ISP_URL)
+        isp_json = isp_lookup.result() if isp_lookup.exception() is None else {}
+        
         # Detect public IP
-        res = requests.get("https://api.ipify.org?format=json", timeout=10)
-        client_public_ip = res.json().get("ip", "unknown")
+        if ip_lookup.exception() is None:
+            client_public_ip = ip_lookup.result().get("ip", "unknown")
+        elif isp_json.get("status") == "success":
+            client_public_ip = isp_json.get("query", client_public_ip)
+        else:
+            raise ip_lookup.exception()
         
         # Detect ISP name
-        isp_res = requests.get(f"http://ip-api.com/json/{client_public_ip}", timeout=10)
-        isp_json = isp_res.json()
         if isp_json.get("status") == "success":
             client_isp_name = isp_json.get("isp", "unknown")
         
         log_print(f"Client Info Detected: Local IP={client_local_ip}, Public IP={client_public_ip}, ISP={client_isp_name}")
+        save_identity_cache()
         return True
     except Exception as e:
         log_print(f"Failed to detect client info: {e}")
         return False
+    finally:
+        if (client_local_ip, client_isp_name) != previous:
+            invalidate_target_contexts()
+
+def save_identity_cache():
+    try:
+        temp = IDENTITY_CACHE_FILE + ".tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            json.dump({"local_ip": client_local_ip, "public_ip": client_public_ip,
+                       "isp": client_isp_name, "time": time.time()}, f)
+        os.replace(temp, IDENTITY_CACHE_FILE)
+    except OSError as e:
+        log_print(f"Could not save identity cache: {e}")
+
+def load_identity_cache():
+    """Start with the last detected identity (True if there was one)."""
+    global client_local_ip, client_public_ip, client_isp_name
+    try:
+        with open(IDENTITY_CACHE_FILE, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return False
+    client_local_ip = cached.get("local_ip", client_local_ip)
+    client_public_ip = cached.get("public_ip", client_public_ip)
+    client_isp_name = cached.get("isp", client_isp_name)
+    age_h = (time.time() - cached.get("time", 0)) / 3600
+    log_print(f"Last known client info ({age_h:.1f} h old): Local IP={client_local_ip}, Public IP={client_public_ip}, ISP={client_isp_name}")
+    invalidate_target_contexts()
+    return True
  
 # ---------------- OBS Process Detection ----------------
+OBS_PROCESS_NAMES = ("obs64.exe", "obs32.exe", "obs.exe", "obs")
+OBS_CHECK_INTERVAL = float(get_env_from_registry("OBS_CHECK_INTERVAL", "1"))  # seconds between checks
+
+class ObsWatcher:
+    """
+    psutil-based OBS process watcher.
+    - While OBS runs only the cached process is checked (is_running() compares PID
+      and creation time, so a reused PID is not mistaken for OBS)
+    - A full process scan happens only while OBS is absent
+    - Listeners are called with True/False from the watcher thread on start/stop
+    """
+    def __init__(self, names=OBS_PROCESS_NAMES, interval=None):
+        self.names = {n.lower() for n in names}
+        self.interval = interval or OBS_CHECK_INTERVAL
+        self.running = None
+        self.pid = None
+        self.scans = 0
+        self._proc = None
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def is_running(self):
+        """Cached state while the watcher thread runs, otherwise a fresh check."""
+        if self._thread is not None and self.running is not None:
+            return self.running
+        return self.check()
+
+    def check(self):
+        """One detection pass; returns True if OBS is running and notifies listeners on change."""
+        with self._lock:
+            proc = self._proc
+            if proc is not None:
+                try:
+                    alive = proc.is_running() and proc.status() != psutil.STATUS_ZOMBIE
+                except psutil.Error:
+                    alive = False
+                if not alive:
+                    proc = self._proc = self.pid = None
+            if proc is None:
+                self.scans += 1
+                for p in psutil.process_iter(["name"]):
+                    if (p.info.get("name") or "").lower() in self.names:
+                        proc = self._proc = p
+                        self.pid = p.pid
+                        break
+            running = proc is not None
+            changed = running != self.running
+            self.running = running
+        if changed:
+            for callback in self._listeners:
+                try:
+                    callback(running)
+                except Exception as e:
+                    log_print(f"[OBS] Listener error: {e}")
+        return running
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="obs-watcher", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                log_print(f"[OBS] Watcher error: {e}")
+            time.sleep(self.interval)
+
+obs_watcher = ObsWatcher()
+
 def is_obs_running():
-    """Check if OBS process is running."""
+    """Check if OBS process is running (cached by obs_watcher once it is started)."""
+    try:
+        return obs_watcher.is_running()
+    except Exception:
+        return is_obs_running_subprocess()
+
+def is_obs_running_subprocess():
+    """Check if OBS process is running (tasklist/pgrep; fallback when psutil fails)."""
     try:
         if platform.system().lower() == 'windows':
             _flags = subprocess.CREATE_NO_WINDOW
             # Check for common OBS process names
+            SUBPROCESS_SPAWNS.inc("tasklist")
             result = subprocess.run(
                 ['tasklist', '/FI', 'IMAGENAME eq obs64.exe', '/NH'],
                 capture_output=True, text=True, timeout=2,
@@ -327,6 +1015,7 @@ def is_obs_running():
                 return True
             
             # Also check for 32-bit OBS
+            SUBPROCESS_SPAWNS.inc("tasklist")
             result = subprocess.run(
                 ['tasklist', '/FI', 'IMAGENAME eq obs32.exe', '/NH'],
                 capture_output=True, text=True, timeout=2,
@@ -336,6 +1025,7 @@ def is_obs_running():
                 return True
             
             # Check for generic obs.exe
+            SUBPROCESS_SPAWNS.inc("tasklist")
             result = subprocess.run(
                 ['tasklist', '/FI', 'IMAGENAME eq obs.exe', '/NH'],
                 capture_output=True, text=True, timeout=2,
@@ -345,6 +1035,7 @@ def is_obs_running():
                 return True
         else:
             # Linux/Mac - check for obs process
+            SUBPROCESS_SPAWNS.inc("pgrep")
             result = subprocess.run(
                 ['pgrep', '-x', 'obs'],
                 capture_output=True,
@@ -358,17 +1049,14 @@ def is_obs_running():
 
 # Auto-detect targets from OBS_STREAMING_SERVERS environment variable
 def get_targets_from_env():
-    """Re-read environment variable from registry (live value from OBS)."""
-    # ONLY read from registry - this ensures real-time detection from OBS plugin
-    # First try registry (most reliable for service and real-time updates)
-    obs_servers = get_env_from_registry("OBS_STREAMING_SERVERS", "")
-    
-    # If not found in registry, try os.environ (for manual run)
-    if not obs_servers:
-        obs_servers = os.environ.get("OBS_STREAMING_SERVERS", "")
+    """Targets from the live config snapshot (registry values written by the OBS plugin)."""
+    # ONLY read from registry (config_source keeps a live snapshot of it, falling back
+    # to os.environ for manual runs) - this ensures real-time detection from OBS plugin
+    obs_servers = config_source.get("OBS_STREAMING_SERVERS", "")
     
-    # DO NOT use file-based fallback - we want real-time detection from OBS only
+    # DO NOT use file-based fallback on Windows - we want real-time detection from OBS only
     # File-based config is removed to prevent detecting old/stale servers
+    # (agent.env is only read on Linux/macOS, which have no registry)
     
     targets = []
     
@@ -378,9 +1066,7 @@ def get_targets_from_env():
         log_print(f"Detected OBS servers: {targets}")
     
     # Also extract YouTube/Facebook from OBS_STREAM_PREVIEW if available
-    obs_preview = get_env_from_registry("OBS_STREAM_PREVIEW", "")
-    if not obs_preview:
-        obs_preview = os.environ.get("OBS_STREAM_PREVIEW", "")
+    obs_preview = config_source.get("OBS_STREAM_PREVIEW", "")
     
     if obs_preview:
         # Split preview URLs (separated by | or ,)
@@ -397,15 +1083,16 @@ def get_targets_from_env():
             try:
                 # Parse URL to extract hostname
                 if 'rtmp://' in url.lower() or 'rtmps://' in url.lower():
-                    # Extract hostname from rtmp://hostname/path format
-                    parts = url.split('/')
-                    if len(parts) >= 3:
-                        hostname = parts[2].strip()
-                        if hostname and hostname not in targets:
-                            # Only add if it's YouTube/Facebook (not OStream)
-                            if 'youtube' in hostname.lower() or 'facebook' in hostname.lower() or 'fb.' in hostname.lower():
-                                targets.append(hostname)
-                                log_print(f"Detected YouTube/Facebook from preview: {hostname}")
+                    # Extract hostname from rtmp://hostname[:port]/path format
+                    kind, hostname, port = parse_target_spec(url.strip())
+                    if hostname:
+                        # Probe the real ingest port (1935 RTMP, 443 RTMPS) unless ICMP is configured
+                        netloc = f"[{hostname}]" if ":" in hostname else hostname  # IPv6 literal
+                        target = f"{kind}://{netloc}:{port}" if PREVIEW_PROBE_TYPE == "connect" else hostname
+                        # Only add if it's YouTube/Facebook (not OStream)
+                        if target not in targets and ('youtube' in hostname.lower() or 'facebook' in hostname.lower() or 'fb.' in hostname.lower()):
+                            targets.append(target)
+                            log_print(f"Detected YouTube/Facebook from preview: {target}")
             except Exception as e:
                 log_print(f"Failed to parse preview URL {url}: {e}")
     
@@ -416,63 +1103,1186 @@ PING_INTERVAL = float(get_env_from_registry("PING_INTERVAL", "1"))
  
 session = requests.Session()
  
+# ---------------- Store-and-Forward Spool ----------------
+SPOOL_DIR = os.path.join(SCRIPT_DIR, "spool")
+SPOOL_MAX_BYTES = int(float(get_env_from_registry("SPOOL_MAX_MB", "50")) * 1024 * 1024)  # 0 disables the spool
+SPOOL_SEGMENT_BYTES = 1024 * 1024
+SPOOL_REPLAY_RATE = float(get_env_from_registry("SPOOL_REPLAY_RATE", "200"))  # samples/sec while catching up
+
+class TelemetrySpool:
+    """
+    Crash-safe on-disk spool for samples the collector could not take.
+    - Append-only segment files spool/seg-<n>.jsonl, one JSON [endpoint, payload] per line,
+      flushed + fsync'd on every append; a new segment is started at each process start
+    - Replay progress is kept in seg-<n>.offset (written atomically); fully replayed
+      segments are deleted. Delivery is at-least-once: a crash between POST and offset
+      write resends that batch
+    - Total size is capped at max_bytes by evicting the oldest segments first
+    - Payloads are stored untouched, so samples keep their original timestamps
+    """
+    def __init__(self, directory=None, max_bytes=None, segment_bytes=None):
+        self.directory = directory or SPOOL_DIR
+        self.max_bytes = SPOOL_MAX_BYTES if max_bytes is None else max_bytes
+        self.segment_bytes = segment_bytes or SPOOL_SEGMENT_BYTES
+        self._lock = threading.Lock()
+        self._active = None        # open file of the segment being appended to
+        self._active_name = None
+        self.spooled = 0
+        self.evicted_segments = 0
+
+    def _segments(self):
+        try:
+            return sorted(f for f in os.listdir(self.directory) if f.startswith("seg-") and f.endswith(".jsonl"))
+        except FileNotFoundError:
+            return []
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def has_data(self):
+        with self._lock:
+            for name in self._segments():
+                if os.path.getsize(self._path(name)) > self._read_offset(name):
+                    return True
+            return False
+
+    def append(self, items):
+        """Persist [(endpoint, payload), ...] durably."""
+        if self.max_bytes <= 0 or not items:
+            return
+        data = "".join(json.dumps([endpoint, payload], separators=(",", ":")) + "\n"
+                       for endpoint, payload in items).encode("utf-8")
+        with self._lock:
+            if self._active is None or self._active.tell() >= self.segment_bytes:
+                self._roll()
+            self._active.write(data)
+            self._active.flush()
+            os.fsync(self._active.fileno())
+            self.spooled += len(items)
+            self._enforce_cap()
+
+    def _roll(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if self._active is not None:
+            self._active.close()
+        segments = self._segments()
+        last = int(segments[-1][4:-6]) if segments else 0
+        self._active_name = f"seg-{last + 1:012d}.jsonl"
+        self._active = open(self._path(self._active_name), "ab")
+
+    def _enforce_cap(self):
+        segments = self._segments()
+        total = sum(os.path.getsize(self._path(s)) for s in segments)
+        for name in segments:
+            if total <= self.max_bytes or name == self._active_name:
+                break
+            total -= os.path.getsize(self._path(name))
+            self._remove(name)
+            self.evicted_segments += 1
+            log_print(f"[SPOOL] Size cap reached - evicted oldest segment {name}")
+
+    def _remove(self, name):
+        for path in (self._path(name), self._path(name[:-6] + ".offset")):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _read_offset(self, name):
+        try:
+            with open(self._path(name[:-6] + ".offset"), "r") as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def read_batch(self, limit):
+        """Oldest unsent items: returns (segment, end_offset, [(endpoint, payload), ...]) or (None, 0, [])."""
+        with self._lock:
+            for name in self._segments():
+                offset = self._read_offset(name)
+                items = []
+                with open(self._path(name), "rb") as f:
+                    f.seek(offset)
+                    while len(items) < limit:
+                        line = f.readline()
+                        if not line.endswith(b"\n"):
+                            break  # end of file, or a torn write from a crash
+                        offset += len(line)
+                        try:
+                            endpoint, payload = json.loads(line)
+                            items.append((endpoint, payload))
+                        except ValueError:
+                            continue
+                    at_end = not f.read(1)
+                if items:
+                    return name, offset, items
+                if name != self._active_name and at_end:
+                    self._remove(name)  # fully replayed (or only torn lines left)
+            return None, 0, []
+
+    def commit(self, name, offset):
+        """Mark everything before offset in segment name as delivered."""
+        with self._lock:
+            if name != self._active_name and offset >= os.path.getsize(self._path(name)):
+                self._remove(name)
+                return
+            tmp = self._path(name[:-6] + ".offset.tmp")
+            with open(tmp, "w") as f:
+                f.write(str(offset))
+            os.replace(tmp, self._path(name[:-6] + ".offset"))
+
+# ---------------- Collector Pool ----------------
+# SERVER_URLS: comma-separated collectors in order of preference (default: just SERVER_URL).
+# Every collector request goes through `collectors`: the sticky primary first, then the others.
+SERVER_URLS = [u.strip() for u in get_env_from_registry("SERVER_URLS", SERVER_URL).split(",") if u.strip()]
+COLLECTOR_HEALTH_INTERVAL = int(get_env_from_registry("COLLECTOR_HEALTH_INTERVAL", "30"))  # s between checks of standby collectors
+COLLECTOR_HEDGE_DELAY_MS = float(get_env_from_registry("COLLECTOR_HEDGE_DELAY_MS", "300"))  # hedged POSTs: wait this long for the primary
+COLLECTOR_SWITCH_MARGIN_MS = float(get_env_from_registry("COLLECTOR_SWITCH_MARGIN_MS", "100"))  # a standby must be this much faster...
+COLLECTOR_SWITCH_FACTOR = 2.0  # ...and this many times faster before it takes over a healthy primary
+COLLECTOR_DOWN_BASE = 5        # s a failed collector sits out, doubled per consecutive failure...
+COLLECTOR_DOWN_MAX = 120       # ...up to this
+COLLECTOR_DEFAULT_LATENCY_MS = 200.0  # score of a collector with no successful request yet
+
+class CollectorHealth:
+    """Health of one collector: latency EWMA of successful requests and consecutive failures.
+    A failure is a connection error, timeout or 5xx; any other answer means it is up."""
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.latency_ms = None
+        self.failures = 0
+        self.down_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.session = requests.Session()  # for hedged requests and health checks
+
+    def record(self, ok, latency_ms):
+        self.requests += 1
+        if ok:
+            self.failures = 0
+            self.down_until = 0.0
+            self.latency_ms = latency_ms if self.latency_ms is None else self.latency_ms * 0.8 + latency_ms * 0.2
+        else:
+            self.errors += 1
+            self.failures += 1
+            self.down_until = time.monotonic() + min(COLLECTOR_DOWN_MAX, COLLECTOR_DOWN_BASE * 2 ** (self.failures - 1))
+
+    def available(self):
+        return time.monotonic() >= self.down_until
+
+    def score(self):
+        """Lower is better."""
+        latency = COLLECTOR_DEFAULT_LATENCY_MS if self.latency_ms is None else self.latency_ms
+        return latency * (1 + self.failures)
+
+    def snapshot(self):
+        return {"url": self.url, "latency_ms": None if self.latency_ms is None else round(self.latency_ms, 1),
+                "failures": self.failures, "available": self.available(),
+                "requests": self.requests, "errors": self.errors}
+
+class CollectorPool:
+    """
+    Routes collector requests over SERVER_URLS.
+    - sticky primary: stays primary until a request to it fails, or a standby is both
+      COLLECTOR_SWITCH_FACTOR times and COLLECTOR_SWITCH_MARGIN_MS faster
+    - request(): primary first, then the other available collectors by score, then the
+      ones sitting out a failure; returns the first non-5xx answer (or the last 5xx),
+      raises the last error if nobody answered
+    - hedged_request(): also asks the next collector if the primary hasn't answered within
+      COLLECTOR_HEDGE_DELAY_MS; first good answer wins (for idempotent, latency-critical pushes)
+    - start_health_checks(): GET /client_version on the standbys every COLLECTOR_HEALTH_INTERVAL
+      so their scores stay current while all traffic goes to the primary
+    """
+    def __init__(self, urls):
+        self.collectors = [CollectorHealth(url) for url in urls]
+        self.primary = self.collectors[0]
+        self._lock = threading.Lock()
+        self._hedge_pool = None
+
+    def url(self):
+        return self.primary.url
+
+    def _order(self):
+        with self._lock:
+            primary = self.primary
+            others = [c for c in self.collectors if c is not primary]
+        up = sorted((c for c in others if c.available()), key=CollectorHealth.score)
+        down = sorted((c for c in others if not c.available()), key=lambda c: c.down_until)
+        return ([primary] + up + down) if primary.available() else (up + [primary] + down)
+
+    def _record(self, collector, ok, latency_ms):
+        with self._lock:
+            collector.record(ok, latency_ms)
+            primary = self.primary
+            if collector is primary and not ok:
+                standby = sorted((c for c in self.collectors if c is not primary and c.available()),
+                                 key=CollectorHealth.score)
+                if standby:
+                    self._switch(standby[0], f"{primary.url} failed")
+            elif collector is not primary and ok and (not primary.available() or (
+                    primary.latency_ms is not None
+                    and collector.latency_ms * COLLECTOR_SWITCH_FACTOR < primary.latency_ms
+                    and primary.latency_ms - collector.latency_ms > COLLECTOR_SWITCH_MARGIN_MS)):
+                self._switch(collector, f"faster than {primary.url}" if primary.available() else f"{primary.url} is down")
+
+    def _switch(self, collector, reason):
+        log_print(f"[COLLECTOR] Primary is now {collector.url} ({reason})")
+        COLLECTOR_SWITCHES.inc(collector.url)
+        self.primary = collector
+
+    def _attempt(self, http, collector, method, endpoint, kwargs):
+        started = time.perf_counter()
+        try:
+            response = http.request(method, collector.url + endpoint, **kwargs)
+        except requests.RequestException:
+            self._record(collector, False, 0.0)
+            raise
+        self._record(collector, response.status_code < 500, (time.perf_counter() - started) * 1000)
+        return response
+
+    def request(self, http, method, endpoint, **kwargs):
+        response, error = None, None
+        for collector in self._order():
+            try:
+                response = self._attempt(http, collector, method, endpoint, kwargs)
+            except requests.RequestException as e:
+                error = e
+                continue
+            if response.status_code < 500:
+                return response
+        if response is not None:
+            return response
+        raise error
+
+    def hedged_request(self, method, endpoint, **kwargs):
+        order = self._order()
+        if len(order) < 2:
+            return self.request(order[0].session, method, endpoint, **kwargs)
+        if self._hedge_pool is None:
+            self._hedge_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hedge")
+        pending = [self._hedge_pool.submit(self._attempt, order[0].session, order[0], method, endpoint, kwargs)]
+        done, _ = wait(pending, timeout=COLLECTOR_HEDGE_DELAY_MS / 1000)
+        if not done or not self._good(pending[0]):
+            pending.append(self._hedge_pool.submit(self._attempt, order[1].session, order[1], method, endpoint, kwargs))
+        for fut in as_completed(pending):
+            if self._good(fut):
+                HEDGED_REQUESTS.inc("primary" if fut is pending[0] else "hedge")
+                return fut.result()
+        # both failed: fall through the rest of the pool like a normal request
+        return self.request(order[0].session, method, endpoint, **kwargs)
+
+    @staticmethod
+    def _good(fut):
+        return fut.exception() is None and fut.result().status_code < 500
+
+    def check(self):
+        """One health check of every standby collector."""
+        for collector in self.collectors:
+            if collector is not self.primary:
+                try:
+                    self._attempt(collector.session, collector, "GET", "/client_version", {"timeout": 5})
+                except requests.RequestException:
+                    pass
+
+    def start_health_checks(self, interval=None):
+        interval = interval or COLLECTOR_HEALTH_INTERVAL
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.check()
+
+        threading.Thread(target=loop, name="collector-health", daemon=True).start()
+
+    def stats(self):
+        return {"primary": self.primary.url, "collectors": [c.snapshot() for c in self.collectors]}
+
+COLLECTOR_SWITCHES = metrics.counter("client_ping_collector_switches_total", "Primary collector changes", "collector")
+HEDGED_REQUESTS = metrics.counter("client_ping_hedged_requests_total", "Hedged requests by which copy answered first", "winner")
+collectors = CollectorPool(SERVER_URLS)
+
+# ---------------- Compact Wire Format ----------------
+# REPORT_WIRE_FORMAT: "compact" (session protocol below, falls back to /push_batch on
+# servers without it) or "batch" (always JSON /push_batch)
+REPORT_WIRE_FORMAT = get_env_from_registry("REPORT_WIRE_FORMAT", "compact").lower()
+
+try:
+    import msgpack  # optional: smaller and faster to encode than JSON
+except ImportError:
+    msgpack = None
+try:
+    import zstandard  # optional: better ratio than gzip at lower CPU
+except ImportError:
+    zstandard = None
+
+# /push_ping fields that only change when the target context does (see build_target_context)
+PING_CONTEXT_FIELDS = ("client_id", "computer_name", "target", "target_display", "target_ip", "stream_id",
+                       "isp", "isp_display", "preview_ostream", "preview_youtube")
+# Layout of one compact ping record; anything else in the payload goes into extra (burst stats, probe, ...)
+PING_RECORD_FIELDS = ("context", "timestamp", "success", "rtt_ms", "raw", "extra")
+_PING_FIXED_FIELDS = frozenset(PING_CONTEXT_FIELDS + ("timestamp", "success", "rtt_ms", "raw"))
+_RAW_NUMBERS_RE = re.compile(r"\d+(?:[.,]\d+)?")
+
+def wire_encodings():
+    return ["msgpack", "json"] if msgpack is not None else ["json"]
+
+def wire_compressions():
+    return (["zstd"] if zstandard is not None else []) + ["gzip", "identity"]
+
+def wire_encode(obj, encoding, compression):
+    """(body bytes, headers) for obj in the negotiated encoding and Content-Encoding."""
+    if encoding == "msgpack":
+        data, content_type = msgpack.packb(obj, use_bin_type=True), "application/msgpack"
+    else:
+        data, content_type = json.dumps(obj, separators=(",", ":")).encode(), "application/json"
+    headers = {"Content-Type": content_type}
+    if compression == "gzip":
+        data = gzip.compress(data, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+    elif compression == "zstd":
+        data = zstandard.ZstdCompressor(level=3).compress(data)
+        headers["Content-Encoding"] = "zstd"
+    return data, headers
+
+class CompactWireSession:
+    """
+    Session protocol for sample batches.
+    - POST /register_session once with the static agent metadata and the encodings and
+      compressions we support; the server answers with a session id and its choices
+    - batches go to POST /push_compact as {"session", "contexts", "pings", "items"}:
+      contexts: [[id, {PING_CONTEXT_FIELDS...}]] for contexts this session hasn't seen yet
+      pings:    [[context id, timestamp, success, rtt_ms, raw, extra]] (PING_RECORD_FIELDS);
+                raw is null unless the probe failed or the reply text changed shape
+      items:    [[endpoint, payload]] for every other endpoint, unchanged
+    - send() returns None when the server has no session protocol (404/405), so the
+      reporter falls back to /push_batch; 409/410 (unknown session) registers again
+    Context ids and raw shapes only count as delivered after a successful POST.
+    """
+    def __init__(self):
+        self.session_id = None
+        self.collector = None     # collector the session was registered with
+        self.encoding = "json"
+        self.compression = "identity"
+        self.bytes_sent = 0
+        self.samples_sent = 0
+        self._context_ids = {}    # context values tuple -> id
+        self._known_contexts = set()  # ids the server has for this session
+        self._raw_shapes = {}     # context id -> raw with the numbers blanked out
+        self._lock = threading.Lock()
+
+    def register(self, http):
+        metadata = {
+            "computer_name": AGENT_NAME,
+            "build": CLIENT_BUILD,
+            "client_id": client_local_ip,
+            "public_ip": client_public_ip,
+            "isp": client_isp_name,
+            "encodings": wire_encodings(),
+            "compressions": wire_compressions(),
+            "records": {"/push_ping": list(PING_RECORD_FIELDS)},
+        }
+        self.collector = collectors.url()
+        r = post_json(http, "/register_session", metadata)
+        if r.status_code in (404, 405):
+            return False
+        _raise_for_server_error(r)
+        r.raise_for_status()
+        answer = r.json()
+        self.session_id = answer["session_id"]
+        self.encoding = answer.get("encoding") if answer.get("encoding") in wire_encodings() else "json"
+        self.compression = answer.get("compression") if answer.get("compression") in wire_compressions() else "identity"
+        self._context_ids.clear()  # ids are per session; drop contexts for targets we no longer probe
+        self._known_contexts.clear()
+        self._raw_shapes.clear()
+        log_print(f"[REPORTER] Compact session {self.session_id} ({self.encoding}, {self.compression})")
+        return True
+
+    def _compact(self, batch, replay):
+        """(body dict, state to commit on success)."""
+        contexts, pings, items = [], [], []
+        new_known, new_shapes = set(), {}
+        for item in batch:
+            endpoint, payload = item[0], item[1]
+            if endpoint != "/push_ping":
+                items.append([endpoint, payload])
+                continue
+            key = tuple(payload.get(f) for f in PING_CONTEXT_FIELDS)
+            context_id = self._context_ids.get(key)
+            if context_id is None:
+                context_id = self._context_ids[key] = len(self._context_ids) + 1
+            if context_id not in self._known_contexts and context_id not in new_known:
+                new_known.add(context_id)
+                contexts.append([context_id, dict(zip(PING_CONTEXT_FIELDS, key))])
+            raw = payload.get("raw") or ""
+            shape = _RAW_NUMBERS_RE.sub("#", raw)
+            last_shape = new_shapes.get(context_id, self._raw_shapes.get(context_id))
+            if payload.get("success") and shape == last_shape:
+                raw = None
+            else:
+                new_shapes[context_id] = shape
+            extra = {k: v for k, v in payload.items() if k not in _PING_FIXED_FIELDS} or None
+            pings.append([context_id, payload.get("timestamp"), payload.get("success"), payload.get("rtt_ms"), raw, extra])
+        body = {"session": self.session_id, "contexts": contexts, "pings": pings, "items": items}
+        if replay:
+            body["replay"] = True
+        return body, (new_known, new_shapes)
+
+    def send(self, http, batch, replay=False):
+        """POST batch; returns the response, or None if the server has no session protocol."""
+        with self._lock:
+            if self.collector != collectors.url():
+                self.session_id = None  # failed over: sessions don't carry across collectors
+            for attempt in range(2):
+                if self.session_id is None and not self.register(http):
+                    return None
+                body, (new_known, new_shapes) = self._compact(batch, replay)
+                data, headers = wire_encode(body, self.encoding, self.compression)
+                r = post_bytes(http, "/push_compact", data, headers)
+                if r.status_code in (404, 405):
+                    self.session_id = None
+                    return None
+                if r.status_code in (409, 410) and attempt == 0:
+                    log_print(f"[REPORTER] Compact session {self.session_id} expired - registering again")
+                    self.session_id = None
+                    continue
+                if r.status_code < 300:
+                    self._known_contexts |= new_known
+                    self._raw_shapes.update(new_shapes)
+                    self.bytes_sent += len(data)
+                    self.samples_sent += len(batch)
+                return r
+            return r
+
+# ---------------- Telemetry Reporter ----------------
+REPORT_QUEUE_SIZE = int(get_env_from_registry("REPORT_QUEUE_SIZE", "10000"))     # max samples held in memory
+REPORT_BATCH_SIZE = int(get_env_from_registry("REPORT_BATCH_SIZE", "200"))       # flush when this many are queued
+REPORT_FLUSH_INTERVAL = float(get_env_from_registry("REPORT_FLUSH_INTERVAL", "1"))  # ...or when the oldest is this old (s)
+REPORT_DROP_POLICY = get_env_from_registry("REPORT_DROP_POLICY", "drop_oldest").lower()  # drop_oldest | drop_newest | block
+REPORT_BATCH_RETRY = 600  # seconds before re-trying /push_batch on a server that doesn't have it
+REPORT_OFFLINE_BACKOFF = 5  # seconds to spool straight to disk after a failed flush
+
+def _raise_for_server_error(response):
+    """5xx means "try again later" (spool it); a 4xx would be rejected again on replay, so it counts as delivered."""
+    if response.status_code >= 500:
+        raise requests.HTTPError(f"HTTP {response.status_code}", response=response)
+
+def post_json(http, endpoint, payload, timeout=5, base=None, hedge=False, headers=None):
+    """POST payload to endpoint on the collector pool (or on base, e.g. a LAN relay),
+    recording latency and errors in the self metrics. hedge=True: see CollectorPool.hedged_request."""
+    return _post(http, endpoint, timeout, base, hedge, json=payload, headers=headers)
+
+def post_bytes(http, endpoint, data, headers, timeout=5):
+    """POST an already encoded body (see wire_encode), with the same metrics as post_json."""
+    return _post(http, endpoint, timeout, None, False, data=data, headers=headers)
+
+def _post(http, endpoint, timeout, base, hedge, **kwargs):
+    started = time.perf_counter()
+    try:
+        if base:
+            response = http.post(base.rstrip("/") + endpoint, timeout=timeout, **kwargs)
+        elif hedge:
+            response = collectors.hedged_request("POST", endpoint, timeout=timeout, **kwargs)
+        else:
+            response = collectors.request(http, "POST", endpoint, timeout=timeout, **kwargs)
+    except Exception:
+        ENDPOINT_ERRORS.inc(endpoint)
+        raise
+    finally:
+        POST_LATENCY.observe(time.perf_counter() - started, endpoint)
+    if response.status_code >= 400:
+        ENDPOINT_ERRORS.inc(endpoint)
+    return response
+
+class TelemetryReporter:
+    """
+    Decouples measurement from reporting.
+    - submit() puts (endpoint, payload) on a bounded in-memory queue and returns at once
+    - one reporter thread drains the queue into a single POST /push_batch,
+      flushed by size (REPORT_BATCH_SIZE) or age (REPORT_FLUSH_INTERVAL)
+    - when the queue is full REPORT_DROP_POLICY decides: drop the oldest sample,
+      drop the new one, or block the producer (bounded wait, then drop)
+    - with a LAN relay (relay_link) batches go to the relay, which forwards the whole site's
+      samples; if the relay fails they go straight to the collector again
+    - servers with the session protocol get compact batches (CompactWireSession)
+    - older servers without /push_batch get the samples posted one by one
+    - batches the collector can't take go to the disk spool and are replayed
+      (rate-limited, oldest first) by a second thread once it answers again
+    """
+    def __init__(self, maxsize=None, batch_size=None, flush_interval=None, drop_policy=None, spool=None):
+        self.maxsize = maxsize or REPORT_QUEUE_SIZE
+        self.batch_size = batch_size or REPORT_BATCH_SIZE
+        self.flush_interval = flush_interval or REPORT_FLUSH_INTERVAL
+        self.drop_policy = drop_policy or REPORT_DROP_POLICY
+        self.session = requests.Session()
+        self.spool = spool if spool is not None else TelemetrySpool()
+        self._replay_session = requests.Session()
+        self._offline_until = 0.0
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._batch_disabled_until = 0.0
+        self.wire = CompactWireSession() if REPORT_WIRE_FORMAT == "compact" else None
+        self._compact_disabled_until = 0.0
+        self._draining = False
+        self._busy = False  # a batch is being flushed
+        self._dropped_logged = 0
+        self._drop_log_time = 0.0
+        # Counters (read with stats())
+        self.enqueued = 0
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+        self.replayed = 0
+        self.flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def submit(self, endpoint, payload):
+        """Queue one sample for endpoint (e.g. "/push_ping"). Returns False if it was dropped."""
+        if self._thread is None:
+            self.start()
+        with self._cond:
+            if len(self._queue) >= self.maxsize:
+                if self.drop_policy == "block":
+                    self._cond.wait_for(lambda: len(self._queue) < self.maxsize, timeout=self.flush_interval)
+                if len(self._queue) >= self.maxsize:
+                    self.dropped += 1
+                    if self.drop_policy != "drop_oldest":
+                        return False
+                    self._queue.popleft()
+            self._queue.append((endpoint, payload, time.monotonic()))
+            self.enqueued += 1
+            if len(self._queue) == 1 or len(self._queue) >= self.batch_size:
+                self._cond.notify_all()  # start the age timer / flush a full batch
+        return True
+
+    def offer(self, items):
+        """Queue [(endpoint, payload)] only if all of them fit, whatever the drop policy (nothing is
+        evicted). Returns False, queueing none, when the queue is too full."""
+        if self._thread is None:
+            self.start()
+        with self._cond:
+            if len(self._queue) + len(items) > self.maxsize:
+                return False
+            now = time.monotonic()
+            self._queue.extend((endpoint, payload, now) for endpoint, payload in items)
+            self.enqueued += len(items)
+            self._cond.notify_all()
+        return True
+
+    def record_dropped(self, n=1):
+        """Count samples a producer gave up on before they reached submit()."""
+        with self._cond:
+            self.dropped += n
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="reporter", daemon=True)
+                self._thread.start()
+                if self.spool.max_bytes > 0:
+                    threading.Thread(target=self._replay_loop, name="spool-replay", daemon=True).start()
+
+    def stats(self):
+        return {
+            "queue_depth": len(self._queue),
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "sent": self.sent,
+            "failed": self.failed,
+            "spooled": self.spool.spooled,
+            "replayed": self.replayed,
+            "flushes": self.flushes,
+            "last_flush_ms": round(self.last_flush_ms, 1),
+            "max_flush_ms": round(self.max_flush_ms, 1),
+            "avg_flush_ms": round(self.total_flush_ms / self.flushes, 1) if self.flushes else 0.0,
+        }
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if self._queue:
+                    age = time.monotonic() - self._queue[0][2]
+                    if len(self._queue) >= self.batch_size or age >= self.flush_interval or self._draining:
+                        break
+                    self._cond.wait(self.flush_interval - age)
+                else:
+                    self._cond.wait()
+            count = min(self.batch_size, len(self._queue))
+            batch = [self._queue.popleft() for _ in range(count)]
+            self._busy = True
+            self._cond.notify_all()  # wake producers blocked on a full queue
+            return batch
+
+    def drain(self, timeout=5):
+        """Flush everything queued right now (e.g. before the process exits). True if it all went out
+        (or to the spool) within timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._draining = True
+            self._cond.notify_all()
+            while (self._queue or self._busy) and time.monotonic() < deadline:
+                self._cond.wait(0.05)
+            self._draining = False
+            return not self._queue and not self._busy
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            started = time.perf_counter()
+            try:
+                if time.monotonic() < self._offline_until:
+                    raise ConnectionError("collector offline")
+                self._flush(self.session, batch)
+                self.sent += len(batch)
+            except Exception as e:
+                if time.monotonic() >= self._offline_until:
+                    log_print(f"Telemetry send error ({len(batch)} samples): {e}")
+                self._offline_until = time.monotonic() + REPORT_OFFLINE_BACKOFF
+                try:
+                    self.spool.append([(endpoint, payload) for endpoint, payload, _ in batch])
+                    if self.spool.max_bytes <= 0:
+                        self.failed += len(batch)
+                except Exception as spool_error:
+                    self.failed += len(batch)
+                    log_print(f"[SPOOL] Write error: {spool_error}")
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.flushes += 1
+            self.last_flush_ms = elapsed_ms
+            self.total_flush_ms += elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+            if self.dropped != self._dropped_logged and time.monotonic() - self._drop_log_time >= 60:
+                self._dropped_logged, self._drop_log_time = self.dropped, time.monotonic()
+                log_print(f"[REPORTER] Queue full ({self.drop_policy}) - {self.stats()}")
+
+    def _replay_loop(self):
+        """Drain the disk spool at SPOOL_REPLAY_RATE once the collector is reachable again."""
+        backoff = REPORT_OFFLINE_BACKOFF
+        while True:
+            try:
+                name, offset, items = self.spool.read_batch(self.batch_size)
+                if not items:
+                    time.sleep(1)
+                    continue
+                self._flush(self._replay_session, items, replay=True)
+                self.spool.commit(name, offset)
+                self.replayed += len(items)
+                self._offline_until = 0.0
+                backoff = REPORT_OFFLINE_BACKOFF
+                time.sleep(len(items) / SPOOL_REPLAY_RATE)
+            except Exception:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+
+    def _flush(self, session, batch, replay=False):
+        relay = relay_link.url()
+        if relay is not None:
+            body = {
+                "computer_name": AGENT_NAME,
+                "items": [{"endpoint": item[0], "payload": item[1]} for item in batch],
+            }
+            try:
+                r = post_json(session, "/push_batch", body, base=relay, headers=relay_link.headers())
+                if r.status_code < 300:
+                    return
+                raise requests.HTTPError(f"HTTP {r.status_code}", response=r)
+            except Exception as e:
+                relay_link.failed(e)  # this batch (and the next RELAY_RETRY seconds) go direct
+        if self.wire is not None and time.monotonic() >= self._compact_disabled_until:
+            r = self.wire.send(session, batch, replay)
+            if r is not None:
+                _raise_for_server_error(r)
+                return
+            log_print("[REPORTER] Server has no compact session protocol - using /push_batch")
+            self._compact_disabled_until = time.monotonic() + REPORT_BATCH_RETRY
+        if time.monotonic() >= self._batch_disabled_until:
+            body = {
+                "computer_name": AGENT_NAME,
+                "items": [{"endpoint": item[0], "payload": item[1]} for item in batch],
+            }
+            if replay:
+                body["replay"] = True
+            r = post_json(session, "/push_batch", body)
+            if r.status_code not in (404, 405):
+                _raise_for_server_error(r)
+                return
+            log_print(f"[REPORTER] Server has no /push_batch (HTTP {r.status_code}) - posting samples individually")
+            self._batch_disabled_until = time.monotonic() + REPORT_BATCH_RETRY
+        for item in batch:
+            _raise_for_server_error(post_json(session, item[0], item[1]))
+
+reporter = TelemetryReporter()
+metrics.gauge("client_ping_reporter_queue_depth", "Samples waiting in the reporter queue", lambda: len(reporter._queue))
+metrics.gauge("client_ping_reporter_dropped", "Samples dropped because the reporter queue was full", lambda: reporter.dropped)
+
+# ---------------- LAN Relay ----------------
+# One agent per site can act as relay: the other agents post their batches to it over the LAN
+# and it forwards everything through its own reporter (compact batches, one keep-alive session).
+RELAY_MODE = get_env_from_registry("RELAY_MODE", "off").lower()  # off | serve (this agent is the site's relay)
+RELAY_PORT = int(get_env_from_registry("RELAY_PORT", "8765"))
+RELAY_BIND = get_env_from_registry("RELAY_BIND", "0.0.0.0")
+RELAY_URL = get_env_from_registry("RELAY_URL", "")  # "" = upload direct | auto = discover on the LAN | http://host:port
+RELAY_DISCOVERY_PORT = int(get_env_from_registry("RELAY_DISCOVERY_PORT", "8766"))  # UDP
+RELAY_DISCOVERY_ADDRESS = get_env_from_registry("RELAY_DISCOVERY_ADDRESS", "255.255.255.255")
+RELAY_DISCOVERY_TIMEOUT = 0.5
+RELAY_RETRY = int(get_env_from_registry("RELAY_RETRY", "60"))  # seconds of direct upload after a relay failure
+RELAY_TOKEN = get_env_from_registry("RELAY_TOKEN", "")  # shared secret: agents send it, the relay requires it
+RELAY_ALLOW = get_env_from_registry("RELAY_ALLOW", "private")  # private (LAN/loopback addresses) | comma-separated CIDRs
+_RELAY_PROBE = b"CLIENT_PING_RELAY?"
+
+class RelayLink:
+    """
+    Which relay (if any) this agent's reporter posts to.
+    - RELAY_URL fixed: that relay; auto: ask the LAN by UDP broadcast and use whoever answers
+    - after a failure (connection error, 5xx, or relay queue full) url() returns None for
+      RELAY_RETRY seconds so the reporter uploads direct; auto mode then discovers again
+    - the relay itself never uses a relay
+    - posts carry RELAY_TOKEN as X-Relay-Token when it is set
+    """
+    def __init__(self, setting):
+        self.setting = setting.strip()
+        self._url = None if self.setting.lower() in ("", "auto") else self.setting
+        self._down_until = 0.0
+        self._lock = threading.Lock()
+
+    def url(self):
+        if not self.setting or RELAY_MODE == "serve" or time.monotonic() < self._down_until:
+            return None
+        with self._lock:
+            if self._url is None:
+                self._url = self.discover()
+                if self._url is None:
+                    self._down_until = time.monotonic() + RELAY_RETRY
+                else:
+                    log_print(f"[RELAY] Uploading through relay {self._url}")
+            return self._url
+
+    def failed(self, error):
+        with self._lock:
+            if time.monotonic() >= self._down_until:
+                log_print(f"[RELAY] Relay {self._url} failed ({error}) - uploading direct for {RELAY_RETRY}s")
+            self._down_until = time.monotonic() + RELAY_RETRY
+            if self.setting.lower() == "auto":
+                self._url = None
+
+    def headers(self):
+        return {"X-Relay-Token": RELAY_TOKEN} if RELAY_TOKEN else None
+
+    def discover(self):
+        """Broadcast a relay query; the first answer's source address + advertised port is the relay."""
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                s.settimeout(RELAY_DISCOVERY_TIMEOUT)
+                s.sendto(_RELAY_PROBE, (RELAY_DISCOVERY_ADDRESS, RELAY_DISCOVERY_PORT))
+                data, (address, _) = s.recvfrom(512)
+                return f"http://{address}:{int(json.loads(data)['port'])}"
+        except (OSError, ValueError, KeyError):
+            return None
+
+relay_link = RelayLink(RELAY_URL)
+
+class RelayServer:
+    """
+    Relay side: accepts the agents' /push_batch and single /push_* posts (same bodies the
+    collector takes) and queues every item in this agent's reporter, so the site's samples
+    leave in shared batches. Timestamps come from the agents' payloads and stay as they were.
+    Replies 503 when the reporter queue is full; the agent then uploads direct.
+    Only sources in RELAY_ALLOW are served (403 otherwise), and with RELAY_TOKEN set a push
+    without the matching X-Relay-Token is refused with 401.
+    Answers discovery queries on UDP RELAY_DISCOVERY_PORT with {"port", "name"}.
+    """
+    def __init__(self, reporter, token=None, allow=None):
+        self.reporter = reporter
+        self.token = RELAY_TOKEN if token is None else token
+        allow = RELAY_ALLOW if allow is None else allow
+        self.allow = None if allow.strip().lower() == "private" else [
+            ipaddress.ip_network(net.strip(), strict=False) for net in allow.split(",") if net.strip()]
+        self.agents = {}  # computer_name -> last push (monotonic)
+
+    def allowed(self, address):
+        """Whether a source address may use the relay."""
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        if getattr(ip, "ipv4_mapped", None):
+            ip = ip.ipv4_mapped
+        if self.allow is None:
+            return ip.is_private or ip.is_loopback or ip.is_link_local
+        return any(ip in net for net in self.allow)
+
+    def authorized(self, token):
+        return not self.token or hmac.compare_digest((token or "").encode(), self.token.encode())
+
+    def accept(self, endpoint, body):
+        """Queue a pushed body; False (nothing queued, the agent keeps it) if the queue has no room."""
+        if endpoint == "/push_batch":
+            items = [(item["endpoint"], item["payload"]) for item in body["items"]]
+        else:
+            items = [(endpoint, body)]
+        if body.get("computer_name"):
+            self.agents[body["computer_name"]] = time.monotonic()
+        items = [(e, p) for e, p in items if e.startswith("/push")]
+        if not self.reporter.offer(items):
+            RELAY_SAMPLES.inc("rejected", len(items))
+            return False
+        RELAY_SAMPLES.inc("accepted", len(items))
+        return True
+
+    def active_agents(self, within=300):
+        now = time.monotonic()
+        return sum(1 for seen in list(self.agents.values()) if now - seen < within)
+
+    def serve(self, port, host="0.0.0.0", discovery_port=None):
+        """Serve the relay endpoints (and discovery) from daemon threads. Returns the HTTP server."""
+        relay = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive for the agents' sessions
+
+            def _reply(self, status, body=b"{}"):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                data = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if not relay.allowed(self.client_address[0]):
+                    self._reply(403)
+                    return
+                if not relay.authorized(self.headers.get("X-Relay-Token")):
+                    self._reply(401)
+                    return
+                if not self.path.startswith("/push"):
+                    self._reply(404)
+                    return
+                try:
+                    body = json.loads(data)
+                    ok = relay.accept(self.path, body)
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    self._reply(400)
+                    return
+                self._reply(200 if ok else 503)
+
+            def do_GET(self):
+                if not relay.allowed(self.client_address[0]):
+                    self._reply(403)
+                    return
+                if self.path.split("?")[0] != "/relay":
+                    self._reply(404)
+                    return
+                self._reply(200, json.dumps({"name": AGENT_NAME, "build": CLIENT_BUILD,
+                                             "agents": relay.active_agents()}).encode())
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="relay", daemon=True).start()
+        if discovery_port:
+            answer = json.dumps({"port": server.server_address[1], "name": AGENT_NAME}).encode()
+            udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            udp.bind(("" if host == "0.0.0.0" else host, discovery_port))
+            threading.Thread(target=self._answer_discovery, args=(udp, answer),
+                             name="relay-discovery", daemon=True).start()
+        return server
+
+    def _answer_discovery(self, udp, answer):
+        while True:
+            try:
+                data, address = udp.recvfrom(512)
+                if data == _RELAY_PROBE and self.allowed(address[0]):
+                    udp.sendto(answer, address)
+            except OSError as e:
+                log_print(f"[RELAY] Discovery error: {e}")
+                time.sleep(1)
+
+relay_server = RelayServer(reporter)
+metrics.gauge("client_ping_relay_agents", "Agents that pushed through this relay in the last 5 minutes",
+              relay_server.active_agents)
+RELAY_SAMPLES = metrics.counter("client_ping_relay_samples_total", "Samples other agents pushed to this relay", "result")
+ 
 # ---------------- Parse ping ----------------
-def parse_ping_windows(output):
+# One pattern for every reply line we know:
+#   Linux iputils  "64 bytes from 1.1.1.1: icmp_seq=1 ttl=57 time=12.3 ms"
+#   BusyBox        "64 bytes from 1.1.1.1: seq=0 ttl=57 time=12.345 ms"
+#   macOS          "64 bytes from 1.1.1.1: icmp_seq=0 ttl=57 time=12.345 ms"
+#   Windows        "Reply from 1.1.1.1: bytes=32 time=12ms TTL=57" / "time<1ms"
+#   ...and localized Windows: Zeit (de), temps (fr), tiempo (es), tempo (pt), durata (it),
+#   tijd (nl), tid (sv/da/no), czas (pl), čas (cs/sk), idő (hu), aika (fi), süre (tr),
+#   время (ru), χρόνος (el), 時間 (ja), 时间 (zh-CN), 時間 (zh-TW), 시간 (ko)
+_RTT_RE = re.compile(
+    r"(?<![^\W\d_])(?:time|zeit|temps|tiempo|tempo|durata|tijd|tid|czas|čas|idő|aika|süre|"
+    r"время|χρόνος|時間|时间|시간)\s*([=<])\s*(\d+(?:[.,]\d+)?)\s*(?:ms|мс)",
+    re.IGNORECASE,
+)
+_SEQ_RE = re.compile(r"(?:icmp_seq|seq)=(\d+)")
+
+def parse_ping_replies(output):
+    """All replies in ping output as [(seq or None, rtt_ms)], in order. "time<1ms" counts as 1.0 ms."""
+    out = output.decode(errors='ignore') if isinstance(output, bytes) else str(output)
+    replies = []
+    for line in out.splitlines():
+        m = _RTT_RE.search(line)
+        if m is None:
+            continue
+        rtt = 1.0 if m.group(1) == "<" else float(m.group(2).replace(",", "."))
+        seq = _SEQ_RE.search(line)
+        replies.append((int(seq.group(1)) if seq else None, rtt))
+    return replies
+
+def parse_ping_output(output):
     """
-    Parse Windows ping output and return RTT in ms.
+    RTT in ms of the first reply in ping output (any platform/locale).
     - If RTT < 1ms → return 1.0
     - If parsing fails → return -10.0 for Grafana
     """
-def parse_ping_windows(output):
-    """
-    Optimized Windows ping output parser for 99% accuracy
-    - Uses regex for faster parsing
-    - Handles edge cases (time<1ms, timeouts)
-    - Returns accurate RTT in milliseconds
-    """
     out = output.decode(errors='ignore') if isinstance(output, bytes) else str(output)
-    
-    # Quick check for success indicators
-    if "time=" not in out and "time<" not in out:
+    m = _RTT_RE.search(out)
+    if m is None:
         return -10.0
-    
-    try:
-        # Handle sub-millisecond pings (time<1ms)
-        if "time<" in out:
-            return 1.0  # minimum measurable RTT = 1ms
-        
-        # Optimized parsing: find "time=" and extract number
-        time_idx = out.find("time=")
-        if time_idx == -1:
-            return -10.0
-        
-        # Extract numeric part after "time="
-        start = time_idx + 5  # Length of "time="
-        num_str = ''
-        
-        for i in range(start, min(start + 10, len(out))):
-            ch = out[i]
-            if ch.isdigit() or ch == '.':
-                num_str += ch
-            elif num_str:  # Stop at first non-numeric after finding digits
-                break
-        
-        if not num_str:
-            return -10.0
-        
-        rtt = float(num_str)
-        
-        # Validate RTT
-        if rtt == 0:
-            return -10.0
-        
-        # Return RTT (minimum 1ms for sub-millisecond values)
-        return rtt if rtt >= 1.0 else 1.0
-        
-    except (ValueError, IndexError):
+    if m.group(1) == "<":
+        return 1.0  # minimum measurable RTT = 1ms
+    rtt = float(m.group(2).replace(",", "."))
+    if rtt == 0:
         return -10.0
- 
+    return rtt if rtt >= 1.0 else 1.0
+
+# ---------------- Native ICMP Probe Engine ----------------
+# PROBE_BACKEND: "auto" (native ICMP, fall back to the ping command),
+#                "icmp" (native only), "subprocess" (always fork ping per probe),
+#                or "continuous" (always one long-running ping per target, see ContinuousPinger)
+PROBE_BACKEND = get_env_from_registry("PROBE_BACKEND", "auto").lower()
+# How "auto" pings when the native engine is unavailable: "continuous" or "oneshot" (ping per probe)
+PING_FALLBACK = get_env_from_registry("PING_FALLBACK", "continuous").lower()
+_PING_COMMAND_BACKENDS = ("subprocess", "continuous")  # backends that never use the native engine
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMP_PAYLOAD = b"client_ping-probe-0123456789abcdef"  # 34 bytes, same for every probe
+
+def _icmp_checksum(data):
+    """RFC 1071 internet checksum."""
+    if len(data) % 2:
+        data += b"\x00"
+    total = sum(struct.unpack("!%dH" % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+class _IcmpSocketEngine:
+    """
+    Shared in-process ICMP echo engine (Linux/macOS).
+    - One socket for all targets: unprivileged SOCK_DGRAM ICMP where the kernel
+      allows it (net.ipv4.ping_group_range), otherwise SOCK_RAW (root/CAP_NET_RAW)
+    - A single receiver thread matches echo replies to probes by id/sequence
+    - Send and receive are timestamped with time.perf_counter_ns
+    - submit() returns a Future resolving to (success, rtt_ms, raw) like do_ping_once,
+      with the unrounded-to-1ms RTT (see _min_rtt)
+    """
+    def __init__(self):
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self.kind = "dgram"
+            self.sock.bind(("", 0))
+            # Kernel rewrites the echo id to the socket's "port"
+            self.ident = self.sock.getsockname()[1]
+        except OSError:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self.kind = "raw"
+            self.ident = os.getpid() & 0xFFFF
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._pending = {}  # seq -> [future, ip, send_ns, deadline_ns]
+        self._wait_until_ns = 0  # when the receiver's select() will time out
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        threading.Thread(target=self._receiver_loop, daemon=True).start()
+
+    def submit(self, ip, timeout):
+        fut = Future()
+        fut.set_running_or_notify_cancel()  # a cancelled waiter must not break the receiver
+        with self._lock:
+            self._seq = (self._seq + 1) & 0xFFFF
+            while self._seq in self._pending:
+                self._seq = (self._seq + 1) & 0xFFFF
+            seq = self._seq
+            header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, self.ident, seq)
+            checksum = _icmp_checksum(header + ICMP_PAYLOAD)
+            packet = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, checksum, self.ident, seq) + ICMP_PAYLOAD
+            entry = [fut, ip, 0, 0]
+            self._pending[seq] = entry
+            send_ns = time.perf_counter_ns()
+            entry[2] = send_ns
+            entry[3] = send_ns + int(timeout * 1e9)
+            try:
+                self.sock.sendto(packet, (ip, 0))
+            except OSError as e:
+                self._pending.pop(seq, None)
+                fut.set_result((False, -10.0, f"Send failed: {e}"))
+                return fut
+            wake = entry[3] < self._wait_until_ns
+        if wake:
+            self._wakeup_w.send(b"\x00")  # receiver is sleeping past this probe's deadline
+        return fut
+
+    def _receiver_loop(self):
+        while True:
+            try:
+                with self._lock:
+                    now_ns = time.perf_counter_ns()
+                    self._wait_until_ns = min((e[3] for e in self._pending.values()), default=now_ns + 10**9)
+                wait = max(0.0, (self._wait_until_ns - now_ns) / 1e9)
+                readable, _, _ = select.select([self.sock, self._wakeup_r], [], [], wait)
+                if self._wakeup_r in readable:
+                    try:
+                        self._wakeup_r.recv(4096)
+                    except OSError:
+                        pass
+                if self.sock in readable:
+                    data, addr = self.sock.recvfrom(2048)
+                    recv_ns = time.perf_counter_ns()
+                    self._handle_packet(data, addr[0], recv_ns)
+                self._expire(time.perf_counter_ns())
+            except Exception as e:
+                log_print(f"[ICMP] Receiver error: {e}")
+                time.sleep(0.1)
+
+    def _handle_packet(self, data, src_ip, recv_ns):
+        ttl = None
+        if len(data) >= 20 and data[0] >> 4 == 4:  # IPv4 header: raw sockets, and macOS datagram sockets too
+            ihl = (data[0] & 0x0F) * 4
+            ttl = data[8]
+            data = data[ihl:]
+        if len(data) < 8:
+            return
+        icmp_type, _, _, ident, seq = struct.unpack("!BBHHH", data[:8])
+        if icmp_type != ICMP_ECHO_REPLY or (self.kind == "raw" and ident != self.ident):
+            return
+        with self._lock:
+            entry = self._pending.get(seq)
+            if entry is None or entry[1] != src_ip:
+                return
+            del self._pending[seq]
+        fut, ip, send_ns, _ = entry
+        rtt = (recv_ns - send_ns) / 1e6
+        raw = f"Reply from {ip}: icmp_seq={seq} time={rtt:.3f}ms" + (f" TTL={ttl}" if ttl else "")
+        fut.set_result((True, round(rtt, 3), raw))
+
+    def _expire(self, now_ns):
+        with self._lock:
+            expired = [seq for seq, e in self._pending.items() if e[3] <= now_ns]
+            entries = [self._pending.pop(seq) for seq in expired]
+        for fut, ip, _, _ in entries:
+            fut.set_result((False, -10.0, "Request timed out."))
+
+class _IcmpWindowsEngine:
+    """
+    Windows in-process ICMP via iphlpapi IcmpSendEcho (no admin rights needed).
+    IcmpSendEcho blocks, so calls run on a small shared thread pool;
+    RTT is measured around the call with time.perf_counter_ns.
+    """
+    def __init__(self):
+        import ctypes
+        self._ctypes = ctypes
+        self._iphlpapi = ctypes.windll.iphlpapi
+        self._iphlpapi.IcmpCreateFile.restype = ctypes.c_void_p
+        self._iphlpapi.IcmpSendEcho.argtypes = [
+            ctypes.c_void_p, ctypes.c_uint32, ctypes.c_void_p, ctypes.c_uint16,
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint32, ctypes.c_uint32,
+        ]
+        self._handle = self._iphlpapi.IcmpCreateFile()
+        if not self._handle or self._handle == ctypes.c_void_p(-1).value:
+            raise OSError("IcmpCreateFile failed")
+        self.kind = "iphlpapi"
+        self._pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="icmp")
+
+    def submit(self, ip, timeout):
+        return self._pool.submit(self._echo, ip, timeout)
+
+    def _echo(self, ip, timeout):
+        ctypes = self._ctypes
+        addr = struct.unpack("<I", socket.inet_aton(ip))[0]
+        reply_buf = ctypes.create_string_buffer(256 + len(ICMP_PAYLOAD))
+        send_ns = time.perf_counter_ns()
+        count = self._iphlpapi.IcmpSendEcho(
+            self._handle, addr, ICMP_PAYLOAD, len(ICMP_PAYLOAD),
+            None, reply_buf, len(reply_buf), int(timeout * 1000)
+        )
+        recv_ns = time.perf_counter_ns()
+        # ICMP_ECHO_REPLY: Address (ULONG), Status (ULONG), RoundTripTime (ULONG), ...
+        status = struct.unpack_from("<I", reply_buf.raw, 4)[0]
+        if count == 0 or status != 0:
+            return False, -10.0, "Request timed out." if count == 0 else f"IP_STATUS {status}"
+        rtt = (recv_ns - send_ns) / 1e6
+        return True, round(rtt, 3), f"Reply from {ip}: time={rtt:.3f}ms"
+
+_icmp_engine = None
+_icmp_engine_failed = False
+_icmp_engine_lock = threading.Lock()
+
+def get_icmp_engine():
+    """Return the shared native ICMP engine, or None if this host doesn't allow one."""
+    global _icmp_engine, _icmp_engine_failed
+    if _icmp_engine is not None or _icmp_engine_failed:
+        return _icmp_engine
+    with _icmp_engine_lock:
+        if _icmp_engine is None and not _icmp_engine_failed:
+            try:
+                if platform.system().lower() == 'windows':
+                    _icmp_engine = _IcmpWindowsEngine()
+                else:
+                    _icmp_engine = _IcmpSocketEngine()
+                log_print(f"[ICMP] Native probe engine ready ({_icmp_engine.kind})")
+            except Exception as e:
+                _icmp_engine_failed = True
+                log_print(f"[ICMP] Native probe engine unavailable ({e}) - using ping command")
+    return _icmp_engine
+
+def _probe_timeouts(target):
+    """Adaptive timeout: YouTube needs more time due to distance. Returns (timeout_ms, timeout_sec)."""
+    if 'youtube' in target.lower() or 'rtmp' in target.lower() or 'facebook' in target.lower():
+        return 1500, 3  # 1.5 seconds for international servers
+    return 1000, 2      # 1 second for local servers (increased from 500ms to handle concurrent load)
+
+def _min_rtt(result):
+    """Apply the reporting convention to an engine result: minimum measurable RTT = 1ms."""
+    success, rtt, raw = result
+    return success, (rtt if rtt >= 1.0 or not success else 1.0), raw
+
 def do_ping_once(target):
+    """
+    Single probe to target. Returns (success, rtt_ms, raw).
+    - Uses the native ICMP engine when available (no process per probe)
+    - Falls back to the ping command (PROBE_BACKEND=subprocess forces it)
+    - ICMP only: tcp:// and tls:// targets are measured by async_connect_probe on the scheduler loop
+    """
+    if "://" in target and parse_target_spec(target)[0] != "icmp":
+        return False, -10.0, f"{target} is not an ICMP target (use async_connect_probe)"
+    if PROBE_BACKEND not in _PING_COMMAND_BACKENDS:
+        engine = get_icmp_engine()
+        if engine is not None:
+            timeout_ms, timeout_sec = _probe_timeouts(target)
+            ip = resolve_target_to_ip(target)
+            if not ip:
+                return False, -10.0, f"Could not resolve {target}"
+            try:
+                return _min_rtt(engine.submit(ip, timeout_ms / 1000).result(timeout=timeout_sec))
+            except Exception as e:
+                return False, -10.0, str(e)
+        if PROBE_BACKEND == "icmp":
+            return False, -10.0, "Native ICMP unavailable"
+    return do_ping_subprocess(target)
+
+def do_ping_subprocess(target):
     """
     Optimized ping function for 99% accuracy
     - Uses high-resolution timer (time.perf_counter)
@@ -483,24 +2293,23 @@ def do_ping_once(target):
     system = platform.system().lower()
     
     # Adaptive timeout: YouTube needs more time due to distance
-    if 'youtube' in target.lower() or 'rtmp' in target.lower() or 'facebook' in target.lower():
-        timeout_ms = "1500"  # 1.5 seconds for international servers
-        timeout_sec = 3
-    else:
-        timeout_ms = "1000"  # 1 second for local servers (increased from 500ms to handle concurrent load)
-        timeout_sec = 2
+    timeout_ms, timeout_sec = _probe_timeouts(target)
+    
+    # Ping the cached address so the ping command doesn't resolve the name again
+    address = resolve_target_to_ip(target) or str(target)
     
     # Optimized command
     if system == 'windows':
-        cmd = ["ping", "-n", "1", "-w", timeout_ms, str(target)]
+        cmd = ["ping", "-n", "1", "-w", str(timeout_ms), address]
     else:
-        cmd = ["ping", "-c", "1", "-W", "1", str(target)]
+        cmd = ["ping", "-c", "1", "-W", "1", address]
     
     try:
         # High-resolution timer for accurate measurement
         start_time = time.perf_counter()
         
         # Run ping with minimal overhead
+        SUBPROCESS_SPAWNS.inc("ping")
         p = subprocess.run(
             cmd, 
             stdout=subprocess.PIPE, 
@@ -508,37 +2317,771 @@ def do_ping_once(target):
             timeout=timeout_sec,  # Adaptive timeout based on target
             creationflags=subprocess.CREATE_NO_WINDOW if system == 'windows' else 0
         )
-        
-        end_time = time.perf_counter()
-        
-        # Decode output
+        
+        end_time = time.perf_counter()
+        
+        # Decode output
+        out = p.stdout.decode(errors='ignore')
+        
+        if p.returncode == 0:
+            # Parse RTT from output (Linux, BusyBox, macOS, localized Windows)
+            rtt = parse_ping_output(out)
+            
+            if rtt < 0:
+                if system == 'windows':
+                    # Windows exits 0 for "Destination host unreachable" replies too
+                    return False, -10.0, out
+                # Unknown output format: fall back to the measured time (includes process overhead)
+                measured_time = (end_time - start_time) * 1000  # Convert to ms
+                rtt = max(1.0, round(measured_time, 3))
+            
+            return True, rtt, out
+        else:
+            return False, -10.0, out
+            
+    except subprocess.TimeoutExpired:
+        return False, -10.0, "Timeout"
+    except Exception as e:
+        return False, -10.0, str(e)
+ 
+# ---------------- Continuous Ping Readers ----------------
+CONTINUOUS_PING_RESTART_DELAY = 1.0  # seconds before restarting a ping that exited (doubles up to 30)
+
+def use_continuous_ping():
+    """True if probes without the native engine should read a long-running ping instead of forking one per probe."""
+    return PROBE_BACKEND == "continuous" or (PROBE_BACKEND == "auto" and PING_FALLBACK == "continuous")
+
+class ContinuousPinger:
+    """
+    One long-running ping per target ("ping -i" on Linux/macOS, "ping -t" on Windows).
+    - A reader thread parses stdout line by line as replies arrive
+    - Replies with a gap in icmp_seq produce one loss per missing sequence number;
+      losses already reported by take_results() timing out are not counted twice
+    - The process is restarted (with backoff) whenever it exits
+    """
+    def __init__(self, target, address, interval):
+        self.target = target
+        self.address = address
+        self.interval = max(0.2, interval)  # iputils needs root below 0.2 s
+        self.spawns = 0
+        self.gaps = 0
+        self.proc = None
+        self._results = collections.deque(maxlen=600)
+        self._waiter = None
+        self._last_seq = None
+        self._timeouts_since_reply = 0
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._thread = None
+
+    def command(self):
+        if platform.system().lower() == 'windows':
+            timeout_ms, _ = _probe_timeouts(self.target)
+            return ["ping", "-t", "-w", str(timeout_ms), self.address]  # Windows sends one echo per second
+        return ["ping", "-n", "-i", f"{self.interval:g}", self.address]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"ping-{self.address}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        proc = self.proc
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+
+    def take_results(self):
+        """(results since the last call, Future resolved by the next result if there were none)."""
+        with self._lock:
+            results = list(self._results)
+            self._results.clear()
+            waiter = None
+            if not results:
+                waiter = self._waiter = Future()
+        return results, waiter
+
+    def record_timeout(self, raw):
+        """No reply within interval + timeout: report a loss now (a later seq gap won't repeat it)."""
+        with self._lock:
+            self._timeouts_since_reply += 1
+        return False, -10.0, raw
+
+    def _push(self, results):
+        with self._lock:
+            self._results.extend(results)
+            waiter, self._waiter = self._waiter, None
+        if waiter is not None and waiter.set_running_or_notify_cancel():
+            waiter.set_result(None)
+
+    def _handle_line(self, line):
+        replies = parse_ping_replies(line)
+        if not replies:
+            return
+        results = []
+        for seq, rtt in replies:
+            if seq is not None and self._last_seq is not None:
+                missing = seq - self._last_seq - 1
+                if missing < 0 and self._last_seq - seq < 32768:
+                    continue  # duplicate or late reply
+                if missing < 0:
+                    missing = seq + 65536 - self._last_seq - 1  # icmp_seq wrapped around
+                with self._lock:
+                    unreported = max(0, missing - self._timeouts_since_reply)
+                self.gaps += missing
+                results.extend([(False, -10.0, f"no reply for {self.address} (sequence gap)")] * unreported)
+            if seq is not None:
+                self._last_seq = seq
+            with self._lock:
+                self._timeouts_since_reply = 0
+            results.append((True, rtt if rtt >= 1.0 else 1.0, line.strip()))
+        self._push(results)
+
+    def _run(self):
+        delay = CONTINUOUS_PING_RESTART_DELAY
+        while not self._stopped:
+            started = time.monotonic()
+            try:
+                SUBPROCESS_SPAWNS.inc("ping-continuous")
+                self.spawns += 1
+                self.proc = subprocess.Popen(
+                    self.command(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL,
+                    text=True, errors="ignore", bufsize=1,
+                    creationflags=subprocess.CREATE_NO_WINDOW if platform.system().lower() == 'windows' else 0
+                )
+                self._last_seq = None  # a new process starts a new sequence
+                for line in self.proc.stdout:
+                    self._handle_line(line)
+                self.proc.wait()
+            except Exception as e:
+                log_print(f"[PING] Continuous ping for {self.address} failed: {e}")
+            if self._stopped:
+                break
+            # Exited on its own: restart, backing off while it keeps dying at once
+            delay = CONTINUOUS_PING_RESTART_DELAY if time.monotonic() - started > 30 else min(delay * 2, 30)
+            time.sleep(delay)
+
+_continuous_pingers = {}
+_continuous_pingers_lock = threading.Lock()
+
+def get_continuous_pinger(target, address):
+    """Running pinger for target; restarted when its address changed (DNS)."""
+    with _continuous_pingers_lock:
+        pinger = _continuous_pingers.get(target)
+        if pinger is not None and pinger.address != address:
+            pinger.stop()
+            pinger = None
+        if pinger is None:
+            pinger = _continuous_pingers[target] = ContinuousPinger(target, address, PING_INTERVAL)
+            pinger.start()
+        return pinger
+
+def stop_continuous_pinger(target):
+    with _continuous_pingers_lock:
+        pinger = _continuous_pingers.pop(target, None)
+    if pinger is not None:
+        pinger.stop()
+
+async def async_ping_continuous(target, executor=None):
+    """
+    Results read from target's continuous ping since the last call, as a list of
+    (success, rtt, raw); waits up to one interval + timeout for the next reply and
+    reports a loss if none arrives.
+    """
+    loop = asyncio.get_running_loop()
+    address = dns_cache.lookup(target_host(target)) or await loop.run_in_executor(executor, resolve_target_to_ip, target)
+    if not address:
+        return [(False, -10.0, f"Could not resolve {target}")]
+    pinger = get_continuous_pinger(target, address)
+    results, waiter = pinger.take_results()
+    if waiter is not None:
+        timeout_ms, _ = _probe_timeouts(target)
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(waiter), pinger.interval + timeout_ms / 1000)
+        except asyncio.TimeoutError:
+            pass
+        results, _ = pinger.take_results()
+        if not results:
+            results = [pinger.record_timeout(f"No reply from {address} within {timeout_ms}ms")]
+    return results
+ 
+# ---------------- TCP/TLS Connect Probes ----------------
+# Each target declares its probe type:
+#   "host" / "icmp://host"        ICMP echo (do_ping_once)
+#   "tcp://host:1935"             TCP connect time (RTMP ingest)
+#   "tls://host:443"              TCP connect + TLS handshake time (RTMPS ingest)
+# rtmp:// and rtmps:// are accepted as aliases of tcp:// and tls://.
+TARGET_PROBE_PORTS = {"tcp": 1935, "tls": 443}
+TARGET_SCHEME_ALIASES = {"rtmp": "tcp", "rtmps": "tls"}
+TLS_PROBE_VERIFY = get_env_from_registry("TLS_PROBE_VERIFY", "1") != "0"  # 0 = accept any certificate
+# Probe type for ingest servers taken from OBS_STREAM_PREVIEW: "connect" (tcp/tls to the
+# real ingest port) or "icmp" (plain ping of the hostname, the old behaviour)
+PREVIEW_PROBE_TYPE = get_env_from_registry("PREVIEW_PROBE_TYPE", "connect").lower()
+
+def parse_target_spec(target):
+    """(kind, host, port) for a target spec; kind is "icmp", "tcp" or "tls" (port is None for icmp)."""
+    if "://" not in target:
+        return "icmp", target, None
+    parts = urlsplit(target)
+    kind = TARGET_SCHEME_ALIASES.get(parts.scheme.lower(), parts.scheme.lower())
+    host = parts.hostname or ""
+    if kind not in TARGET_PROBE_PORTS:
+        return "icmp", host, None
+    try:
+        port = parts.port
+    except ValueError:  # malformed port: use the protocol default
+        port = None
+    return kind, host, port or TARGET_PROBE_PORTS[kind]
+
+def target_host(target):
+    """Hostname/IP part of a target spec (what DNS resolves and ICMP pings)."""
+    return target if "://" not in target else parse_target_spec(target)[1]
+
+_tls_probe_context = None
+
+def _get_tls_probe_context():
+    global _tls_probe_context
+    if _tls_probe_context is None:
+        context = ssl.create_default_context()
+        if not TLS_PROBE_VERIFY:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        _tls_probe_context = context
+    return _tls_probe_context
+
+async def async_connect_probe(target, executor=None):
+    """
+    One TCP connect (tcp://) or TCP connect + TLS handshake (tls://) to target.
+    Returns (success, rtt_ms, raw, stats): rtt_ms is the time until the connection
+    is usable, stats splits it into tcp_connect_ms / tls_handshake_ms.
+    Nothing is sent on the connection; it is closed right after.
+    """
+    loop = asyncio.get_running_loop()
+    kind, host, port = parse_target_spec(target)
+    timeout_ms, _ = _probe_timeouts(target)
+    ip = dns_cache.lookup(host) or await loop.run_in_executor(executor, resolve_target_to_ip, host)
+    if not ip:
+        return False, -10.0, f"Could not resolve {host}", None
+    sock = socket.socket(socket.AF_INET6 if ":" in ip else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    transport = None
+    deadline = loop.time() + timeout_ms / 1000
+    started = time.perf_counter_ns()
+    try:
+        await asyncio.wait_for(loop.sock_connect(sock, (ip, port)), timeout_ms / 1000)
+        connected = time.perf_counter_ns()
+        stats = {"probe": kind, "tcp_connect_ms": round((connected - started) / 1e6, 3)}
+        raw = f"{kind} connect to {ip}:{port}: time={stats['tcp_connect_ms']}ms"
+        if kind == "tls":
+            transport, _ = await asyncio.wait_for(
+                loop.create_connection(asyncio.Protocol, sock=sock, ssl=_get_tls_probe_context(),
+                                       server_hostname=host),
+                max(deadline - loop.time(), 0.001))
+            stats["tls_handshake_ms"] = round((time.perf_counter_ns() - connected) / 1e6, 3)
+            raw += f" tls_handshake={stats['tls_handshake_ms']}ms ({transport.get_extra_info('ssl_object').version()})"
+        success, rtt, raw = _min_rtt((True, round((time.perf_counter_ns() - started) / 1e6, 3), raw))
+        return success, rtt, raw, stats
+    except asyncio.TimeoutError:
+        return False, -10.0, f"{kind} connect to {ip}:{port} timed out after {timeout_ms}ms", None
+    except (OSError, ssl.SSLError) as e:
+        return False, -10.0, f"{kind} connect to {ip}:{port} failed: {e}", None
+    finally:
+        if transport is not None:
+            transport.abort()
+        else:
+            sock.close()
+ 
+# ---------------- RTMP Handshake Probe ----------------
+# Full RTMP handshake (C0+C1 -> S0+S1+S2 -> C2) on tcp:// / tls:// ingest targets: the time
+# OBS waits before it can publish again after a reconnect. Runs at most once per
+# RTMP_PROBE_INTERVAL seconds per target (0 disables) and never publishes anything.
+RTMP_PROBE_INTERVAL = float(get_env_from_registry("RTMP_PROBE_INTERVAL", "30"))
+RTMP_VERSION = 3
+RTMP_HANDSHAKE_SIZE = 1536
+
+async def async_rtmp_handshake_probe(target, executor=None):
+    """
+    Connect to a tcp:// (RTMP) or tls:// (RTMPS) target and run the RTMP handshake.
+    Returns payload fields: {"rtmp_handshake_ms": ms} measured from sending C0+C1 until
+    S2 has arrived, or {"rtmp_handshake_ms": -10.0, "rtmp_error": reason}.
+    """
+    loop = asyncio.get_running_loop()
+    kind, host, port = parse_target_spec(target)
+    timeout_ms, _ = _probe_timeouts(target)
+    timeout = timeout_ms / 1000 * 2  # connect (+ TLS) plus two round trips
+    ip = dns_cache.lookup(host) or await loop.run_in_executor(executor, resolve_target_to_ip, host)
+    if not ip:
+        return {"rtmp_handshake_ms": -10.0, "rtmp_error": f"Could not resolve {host}"}
+    streams = []
+
+    async def handshake():
+        reader, writer = await asyncio.open_connection(
+            ip, port, ssl=_get_tls_probe_context() if kind == "tls" else None,
+            server_hostname=host if kind == "tls" else None)
+        streams.append(writer)
+        c1 = struct.pack(">II", int(time.monotonic() * 1000) & 0xFFFFFFFF, 0) + os.urandom(RTMP_HANDSHAKE_SIZE - 8)
+        started = time.perf_counter_ns()
+        writer.write(bytes([RTMP_VERSION]) + c1)
+        s0 = await reader.readexactly(1)
+        if s0[0] != RTMP_VERSION:
+            raise ValueError(f"unexpected RTMP version {s0[0]}")
+        s1 = await reader.readexactly(RTMP_HANDSHAKE_SIZE)
+        await reader.readexactly(RTMP_HANDSHAKE_SIZE)  # S2 (echo of C1; not checked, servers differ)
+        elapsed_ms = (time.perf_counter_ns() - started) / 1e6
+        writer.write(s1)  # C2 completes the handshake so the server sees a clean client
+        await writer.drain()
+        return elapsed_ms
+
+    try:
+        elapsed_ms = await asyncio.wait_for(handshake(), timeout)
+        return {"rtmp_handshake_ms": round(max(elapsed_ms, 1.0), 3)}
+    except asyncio.TimeoutError:
+        return {"rtmp_handshake_ms": -10.0, "rtmp_error": f"timed out after {timeout * 1000:.0f}ms"}
+    except asyncio.IncompleteReadError as e:
+        return {"rtmp_handshake_ms": -10.0, "rtmp_error": f"connection closed after {len(e.partial)} bytes"}
+    except (OSError, ssl.SSLError, ValueError) as e:
+        return {"rtmp_handshake_ms": -10.0, "rtmp_error": str(e)}
+    finally:
+        for writer in streams:
+            writer.close()  # FIN (close_notify on RTMPS); nothing was published
+
+# ---------------- Burst Probes ----------------
+PING_BURST_COUNT = int(get_env_from_registry("PING_BURST_COUNT", "1"))                # probes per PING_INTERVAL (1 = single ping)
+PING_BURST_SPACING_MS = float(get_env_from_registry("PING_BURST_SPACING_MS", "20"))  # gap between probes in a burst
+
+def burst_stats(received, sent):
+    """
+    Loss/latency stats for one burst (same meaning as ping's summary line).
+    - received: RTTs (ms) of the replies, in send order; sent: probes sent
+    - mdev: population standard deviation, like iputils
+    - jitter: RFC 3550 interarrival jitter, J += (|D| - J) / 16 over consecutive replies
+    """
+    stats = {
+        "burst_count": sent,
+        "loss_pct": round(100.0 * (sent - len(received)) / sent, 1) if sent else 100.0,
+    }
+    if not received:
+        stats.update(rtt_min_ms=-10.0, rtt_avg_ms=-10.0, rtt_max_ms=-10.0, rtt_mdev_ms=0.0, jitter_ms=0.0)
+        return stats
+    avg = sum(received) / len(received)
+    mdev = math.sqrt(max(0.0, sum(r * r for r in received) / len(received) - avg * avg))
+    jitter = 0.0
+    for prev, cur in zip(received, received[1:]):
+        jitter += (abs(cur - prev) - jitter) / 16
+    stats.update(
+        rtt_min_ms=round(min(received), 3),
+        rtt_avg_ms=round(avg, 3),
+        rtt_max_ms=round(max(received), 3),
+        rtt_mdev_ms=round(mdev, 3),
+        jitter_ms=round(jitter, 3),
+    )
+    return stats
+
+def _burst_result(address, results):
+    """Combine per-probe (success, rtt, raw) results into (success, rtt, raw, stats); rtt is the average."""
+    received = [rtt for success, rtt, _ in results if success]
+    stats = burst_stats(received, len(results))
+    raw = (f"{address}: {len(results)} packets transmitted, {len(received)} received, "
+           f"{stats['loss_pct']}% packet loss\n"
+           f"rtt min/avg/max/mdev = {stats['rtt_min_ms']}/{stats['rtt_avg_ms']}/{stats['rtt_max_ms']}/"
+           f"{stats['rtt_mdev_ms']} ms, jitter {stats['jitter_ms']} ms")
+    if not received:
+        raw += "\n" + results[-1][2]
+        return False, -10.0, raw, stats
+    return True, max(1.0, stats["rtt_avg_ms"]), raw, stats
+
+def do_ping_burst_subprocess(target, count, spacing_ms, histogram=None):
+    """Burst through a single ping process (-c/-i on Linux/macOS, -n on Windows)."""
+    system = platform.system().lower()
+    timeout_ms, timeout_sec = _probe_timeouts(target)
+    address = resolve_target_to_ip(target) or str(target)
+    if system == 'windows':
+        # Windows ping has a fixed ~1 s spacing
+        cmd = ["ping", "-n", str(count), "-w", str(timeout_ms), address]
+        timeout_sec += count
+    else:
+        # Unprivileged iputils refuses intervals below 0.2 s
+        interval = max(0.2, spacing_ms / 1000)
+        cmd = ["ping", "-c", str(count), "-i", f"{interval:.3f}", "-W", "1", address]
+        timeout_sec += count * interval
+    try:
+        SUBPROCESS_SPAWNS.inc("ping")
+        p = subprocess.run(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout_sec,
+            creationflags=subprocess.CREATE_NO_WINDOW if system == 'windows' else 0
+        )
         out = p.stdout.decode(errors='ignore')
-        
-        if p.returncode == 0:
-            # Parse RTT from output (optimized parsing)
-            rtt = parse_ping_windows(out) if system == 'windows' else None
-            
-            if rtt is None or rtt < 1.0:
-                rtt = 1.0
-            
-            # Validate RTT against measured time
-            measured_time = (end_time - start_time) * 1000  # Convert to ms
-            
-            # If RTT is 0, use measured time or set to -10
-            if rtt == 0:
-                rtt = -10.0
-            
-            return True, rtt, out
-        else:
-            return False, -10.0, out
-            
     except subprocess.TimeoutExpired:
-        return False, -10.0, "Timeout"
+        return False, -10.0, "Timeout", burst_stats([], count)
     except Exception as e:
-        return False, -10.0, str(e)
+        return False, -10.0, str(e), burst_stats([], count)
+    received = [rtt for _, rtt in parse_ping_replies(out)][:count]
+    if histogram is not None:
+        for rtt in received:
+            histogram.record(rtt)
+        histogram.record_loss(count - len(received))
+    stats = burst_stats(received, count)
+    return bool(received), (max(1.0, stats["rtt_avg_ms"]) if received else -10.0), out, stats
+
+# ---------------- RTT Histograms ----------------
+# PING_REPORT_MODE: "raw" (one /push_ping per interval, default), "summary" (only
+# percentile rollups every PING_SUMMARY_WINDOW seconds) or "both" (debugging)
+PING_REPORT_MODE = get_env_from_registry("PING_REPORT_MODE", "raw").lower()
+PING_SUMMARY_WINDOW = float(get_env_from_registry("PING_SUMMARY_WINDOW", "10"))
+
+class RttHistogram:
+    """
+    Mergeable streaming RTT histogram (HDR-style log buckets).
+    - Bucket i covers [RTT_MIN * (1+precision)^i, RTT_MIN * (1+precision)^(i+1)),
+      so any percentile is within precision/2 relative error; min/max are exact
+    - Memory is one counter per occupied bucket (a few hundred at most)
+    - merge() adds another histogram in place (e.g. per-target -> per-site)
+    """
+    RTT_MIN = 0.001  # ms; smaller values land in bucket 0
+
+    def __init__(self, precision=0.01):
+        self.precision = precision
+        self._log_base = math.log1p(precision)
+        self.reset()
+
+    def reset(self):
+        self.buckets = {}
+        self.count = 0
+        self.lost = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, rtt_ms):
+        index = int(math.log(rtt_ms / self.RTT_MIN) / self._log_base) if rtt_ms > self.RTT_MIN else 0
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += rtt_ms
+        if self.min is None or rtt_ms < self.min:
+            self.min = rtt_ms
+        if self.max is None or rtt_ms > self.max:
+            self.max = rtt_ms
+
+    def record_loss(self, lost=1):
+        self.lost += lost
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("cannot merge histograms with different precision")
+        for index, n in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + n
+        self.count += other.count
+        self.lost += other.lost
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        return self
+
+    def percentile(self, p):
+        """Nearest-rank percentile (0 < p <= 100) in ms, or None if empty."""
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(p / 100.0 * self.count))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                value = self.RTT_MIN * math.exp((index + 0.5) * self._log_base)
+                return min(self.max, max(self.min, value))
+        return self.max
+
+    def summary(self):
+        sent = self.count + self.lost
+        def ms(v):
+            return round(v, 3) if v is not None else -10.0
+        return {
+            "count": self.count,
+            "lost": self.lost,
+            "loss_pct": round(100.0 * self.lost / sent, 1) if sent else 0.0,
+            "rtt_min_ms": ms(self.min),
+            "rtt_avg_ms": ms(self.total / self.count if self.count else None),
+            "rtt_p50_ms": ms(self.percentile(50)),
+            "rtt_p90_ms": ms(self.percentile(90)),
+            "rtt_p99_ms": ms(self.percentile(99)),
+            "rtt_max_ms": ms(self.max),
+        }
+
+def _record_results(histogram, results):
+    """Record per-probe (success, rtt, raw) results."""
+    if histogram is None:
+        return
+    for success, rtt, _ in results:
+        if success:
+            histogram.record(rtt)
+        else:
+            histogram.record_loss()
+
+# ---------------- Path Tracing ----------------
+# MTR-style path analysis, triggered when a target degrades: TTL-limited probes to
+# every hop at once (not hop after hop like traceroute), reported to /push_path.
+PATH_TRACE = get_env_from_registry("PATH_TRACE", "1") != "0"
+PATH_TRACE_MIN_INTERVAL = float(get_env_from_registry("PATH_TRACE_MIN_INTERVAL", "300"))  # per target (seconds)
+PATH_TRACE_RTT_FACTOR = float(get_env_from_registry("PATH_TRACE_RTT_FACTOR", "2"))        # RTT > baseline * factor...
+PATH_TRACE_RTT_DELTA_MS = float(get_env_from_registry("PATH_TRACE_RTT_DELTA_MS", "30"))   # ...and > baseline + delta
+PATH_TRACE_LOSS_PCT = float(get_env_from_registry("PATH_TRACE_LOSS_PCT", "10"))           # loss over the last window
+PATH_TRACE_WINDOW = 20     # samples: loss window, and warm-up before the RTT baseline is trusted
+PATH_TRACE_MAX_HOPS = 30
+PATH_TRACE_PROBES = 3      # probes per hop
+PATH_TRACE_TIMEOUT = 1.0   # seconds per probe
+
+IP_RECVERR = 11            # Linux <linux/in.h>; not exported by the socket module
+SO_EE_ORIGIN_ICMP = 2
+ICMP_DEST_UNREACH = 3
+
+class DegradationDetector:
+    """
+    Per-target trigger for path tracing. observe() returns a reason string when
+    - the RTT is above both baseline * PATH_TRACE_RTT_FACTOR and baseline + PATH_TRACE_RTT_DELTA_MS
+      (baseline = EWMA of successful RTTs), or
+    - loss over the last PATH_TRACE_WINDOW samples reaches PATH_TRACE_LOSS_PCT
+    """
+    def __init__(self, window=PATH_TRACE_WINDOW):
+        self.baseline = None
+        self.samples = 0
+        self.recent = collections.deque(maxlen=window)
+
+    def observe(self, success, rtt):
+        self.samples += 1
+        self.recent.append(success)
+        reason = None
+        if len(self.recent) == self.recent.maxlen:
+            loss = 100.0 * self.recent.count(False) / len(self.recent)
+            if loss >= PATH_TRACE_LOSS_PCT:
+                reason = f"loss {loss:.0f}% over the last {len(self.recent)} samples"
+        if success:
+            degraded = (self.baseline is not None and self.samples > self.recent.maxlen
+                        and rtt > max(self.baseline * PATH_TRACE_RTT_FACTOR, self.baseline + PATH_TRACE_RTT_DELTA_MS))
+            if degraded and reason is None:
+                reason = f"rtt {rtt:.1f}ms vs baseline {self.baseline:.1f}ms"
+            # Degraded samples barely move the baseline, so a lasting route change adapts slowly
+            alpha = 0.01 if degraded else 0.1
+            self.baseline = rtt if self.baseline is None else self.baseline + alpha * (rtt - self.baseline)
+        return reason
+
+class _RecvErrHopProber:
+    """
+    Linux hop prober without root: TTL-limited datagrams on a fresh socket per probe,
+    ICMP time-exceeded / unreachable read from the socket error queue (IP_RECVERR).
+    Uses unprivileged ICMP echo sockets when allowed, otherwise UDP to the traceroute ports.
+    """
+    def __init__(self):
+        try:
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP).close()
+            self.kind = "icmp"
+        except OSError:
+            self.kind = "udp"
+
+    async def probe(self, ip, ttl, timeout):
+        """(hop address or None, rtt_ms or None, final hop: destination answered or path unreachable)."""
+        loop = asyncio.get_running_loop()
+        if self.kind == "icmp":
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, 0, ttl)
+            packet = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, _icmp_checksum(header + ICMP_PAYLOAD), 0, ttl) + ICMP_PAYLOAD
+            address = (ip, 0)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            packet, address = ICMP_PAYLOAD, (ip, 33434 + ttl - 1)
+        done = loop.create_future()
+
+        def on_readable():
+            try:
+                _, ancdata, _, _ = sock.recvmsg(512, 512, socket.MSG_ERRQUEUE)
+                for level, kind, data in ancdata:
+                    if level == socket.SOL_IP and kind == IP_RECVERR and len(data) >= 24:
+                        _, origin, icmp_type, _, _, _, _ = struct.unpack_from("=IBBBBII", data)
+                        offender = socket.inet_ntoa(data[20:24])  # SO_EE_OFFENDER: sockaddr_in after the 16-byte header
+                        if origin == SO_EE_ORIGIN_ICMP and not done.done():
+                            done.set_result((offender, offender == ip or icmp_type == ICMP_DEST_UNREACH))
+                return
+            except (BlockingIOError, InterruptedError):
+                pass
+            try:
+                _, (src, _) = sock.recvfrom(2048)  # echo reply: the destination itself answered
+                if not done.done():
+                    done.set_result((src, True))
+            except (BlockingIOError, InterruptedError):
+                pass
+
+        try:
+            sock.setblocking(False)
+            sock.setsockopt(socket.SOL_IP, socket.IP_TTL, ttl)
+            sock.setsockopt(socket.SOL_IP, IP_RECVERR, 1)
+            loop.add_reader(sock.fileno(), on_readable)
+            started = time.perf_counter_ns()
+            sock.sendto(packet, address)
+            hop, reached = await asyncio.wait_for(done, timeout)
+            return hop, round((time.perf_counter_ns() - started) / 1e6, 3), reached
+        except (asyncio.TimeoutError, OSError):
+            return None, None, False
+        finally:
+            loop.remove_reader(sock.fileno())
+            sock.close()
+
+class _WindowsHopProber:
+    """Windows hop prober: IcmpSendEcho with IP_OPTION_INFORMATION.Ttl (no admin rights), on the executor."""
+    IP_SUCCESS = 0
+    IP_TTL_EXPIRED_TRANSIT = 11013
+
+    def __init__(self):
+        import ctypes
+        self._ctypes = ctypes
+
+        class IpOptionInformation(ctypes.Structure):
+            _fields_ = [("Ttl", ctypes.c_ubyte), ("Tos", ctypes.c_ubyte), ("Flags", ctypes.c_ubyte),
+                        ("OptionsSize", ctypes.c_ubyte), ("OptionsData", ctypes.c_void_p)]
+
+        self._options_type = IpOptionInformation
+        self._iphlpapi = ctypes.windll.iphlpapi
+        self._iphlpapi.IcmpCreateFile.restype = ctypes.c_void_p
+        self._iphlpapi.IcmpSendEcho.argtypes = [
+            ctypes.c_void_p, ctypes.c_uint32, ctypes.c_void_p, ctypes.c_uint16,
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint32, ctypes.c_uint32,
+        ]
+        self._handle = self._iphlpapi.IcmpCreateFile()
+        if not self._handle or self._handle == ctypes.c_void_p(-1).value:
+            raise OSError("IcmpCreateFile failed")
+        self.kind = "iphlpapi"
+        self._pool = ThreadPoolExecutor(max_workers=PATH_TRACE_MAX_HOPS, thread_name_prefix="trace")
+
+    async def probe(self, ip, ttl, timeout):
+        return await asyncio.wrap_future(self._pool.submit(self._echo, ip, ttl, timeout))
+
+    def _echo(self, ip, ttl, timeout):
+        ctypes = self._ctypes
+        options = self._options_type(Ttl=ttl)
+        reply_buf = ctypes.create_string_buffer(256 + len(ICMP_PAYLOAD))
+        started = time.perf_counter_ns()
+        count = self._iphlpapi.IcmpSendEcho(
+            self._handle, struct.unpack("<I", socket.inet_aton(ip))[0], ICMP_PAYLOAD, len(ICMP_PAYLOAD),
+            ctypes.byref(options), reply_buf, len(reply_buf), int(timeout * 1000)
+        )
+        rtt = round((time.perf_counter_ns() - started) / 1e6, 3)
+        if count == 0:
+            return None, None, False
+        address, status = struct.unpack_from("<II", reply_buf.raw, 0)
+        hop = socket.inet_ntoa(struct.pack("<I", address))
+        if status == self.IP_SUCCESS:
+            return hop, rtt, True
+        if status == self.IP_TTL_EXPIRED_TRANSIT:
+            return hop, rtt, False
+        return hop, rtt, True  # destination/network unreachable: no later hop will answer
+
+class PathTracer:
+    """
+    Concurrent path trace: PATH_TRACE_PROBES rounds of probes to TTL 1..max_hops, all
+    TTLs in parallel. prober must provide `async probe(ip, ttl, timeout) ->
+    (hop address or None, rtt_ms or None, final)`, final meaning no later hop can
+    answer (destination reached or unreachable); tests and benchmarks inject their own.
+    """
+    def __init__(self, prober, max_hops=PATH_TRACE_MAX_HOPS, probes=PATH_TRACE_PROBES,
+                 timeout=PATH_TRACE_TIMEOUT, spacing=0.05):
+        self.prober = prober
+        self.max_hops = max_hops
+        self.probes = probes
+        self.timeout = timeout
+        self.spacing = spacing
+
+    async def trace(self, ip):
+        """{"reached", "hops": [{ttl, ip, sent, received, loss_pct, rtt_min/avg/max_ms}], "duration_ms"}."""
+        started = time.perf_counter()
+
+        async def probe_hop(ttl):
+            results = []
+            for i in range(self.probes):
+                if i:
+                    await asyncio.sleep(self.spacing)
+                results.append(await self.prober.probe(ip, ttl, self.timeout))
+            return results
+
+        per_ttl = await asyncio.gather(*(probe_hop(ttl) for ttl in range(1, self.max_hops + 1)))
+        hops, reached = [], False
+        for ttl, results in enumerate(per_ttl, 1):
+            answered = [r for r in results if r[0] is not None]
+            rtts = [r[1] for r in answered]
+            addresses = [r[0] for r in answered]
+            hops.append({
+                "ttl": ttl,
+                "ip": max(set(addresses), key=addresses.count) if addresses else "*",
+                "sent": len(results),
+                "received": len(answered),
+                "loss_pct": round(100.0 * (len(results) - len(answered)) / len(results), 1),
+                "rtt_min_ms": min(rtts) if rtts else None,
+                "rtt_avg_ms": round(sum(rtts) / len(rtts), 3) if rtts else None,
+                "rtt_max_ms": max(rtts) if rtts else None,
+            })
+            if any(r[2] for r in results):
+                reached = ip in addresses  # otherwise a router reported the destination unreachable
+                break
+        if not reached:
+            # Drop the silent tail past the last hop that answered
+            while len(hops) > 1 and hops[-1]["received"] == 0 and hops[-2]["received"] == 0:
+                hops.pop()
+        return {"reached": reached, "hops": hops, "duration_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+_path_tracer = None
+_path_tracer_failed = False
+
+def get_path_tracer():
+    """Shared PathTracer for this host, or None if no hop prober works here."""
+    global _path_tracer, _path_tracer_failed
+    if _path_tracer is None and not _path_tracer_failed:
+        try:
+            if platform.system().lower() == 'windows':
+                prober = _WindowsHopProber()
+            elif platform.system().lower() == 'linux':
+                prober = _RecvErrHopProber()
+            else:
+                raise OSError("no IP_RECVERR on this platform")
+            _path_tracer = PathTracer(prober)
+            log_print(f"[PATH] Path tracer ready ({prober.kind})")
+        except Exception as e:
+            _path_tracer_failed = True
+            log_print(f"[PATH] Path tracing unavailable: {e}")
+    return _path_tracer
+
+def send_path_report(target, reason, trace):
+    payload = dict(get_target_context(target))
+    payload["timestamp"] = int(time.time())
+    payload["reason"] = reason
+    payload.update(trace)
+    reporter.submit("/push_path", payload)
+
+async def run_path_trace(target, reason, executor=None):
+    """Trace the path to target and queue the result for /push_path."""
+    tracer = get_path_tracer()
+    if tracer is None:
+        return
+    loop = asyncio.get_running_loop()
+    ip = dns_cache.lookup(target_host(target)) or await loop.run_in_executor(executor, resolve_target_to_ip, target)
+    if not ip:
+        return
+    log_print(f"[PATH] {target} degraded ({reason}) - tracing path to {ip}")
+    trace = await tracer.trace(ip)
+    await loop.run_in_executor(executor, send_path_report, target, reason, trace)
+    worst = max(trace["hops"], key=lambda h: h["loss_pct"], default=None)
+    log_print(f"[PATH] {target}: {len(trace['hops'])} hops, reached={trace['reached']}, "
+              f"worst loss {worst['loss_pct'] if worst else 0}% at hop {worst['ttl'] if worst else '-'} "
+              f"({trace['duration_ms']}ms)")
  
 # ---------------- Send ping ----------------
-def send_ping(target, rtt, success, raw):
+# Static per-target payload fields, rebuilt only when OBS/client info changes
+_context_generation = 0
+_target_contexts = {}  # target -> (generation, fields)
+
+def invalidate_target_contexts():
+    """Called when detect_obs_streaming_data / detect_client_info see a change."""
+    global _context_generation
+    _context_generation += 1
+
+def build_target_context(target):
+    """Fields of the /push_ping payload that don't change from sample to sample."""
     # Resolve target to IP (server will do the mapping)
     target_ip = resolve_target_to_ip(target)
     stream_id = ""  # Stream ID for preview URL
@@ -564,30 +3107,48 @@ def send_ping(target, rtt, success, raw):
         except:
             pass
     
-    # Format display names for Grafana
-    target_display = format_display_name(target, "target")
-    isp_display = format_display_name(client_isp_name, "isp")
-    
-    payload = {
+    return {
         "client_id": client_local_ip,  # Use local IP as client ID
         "computer_name": AGENT_NAME,  # Add computer name
         "target": target,
-        "target_display": target_display,  # Shortened display name
+        "target_display": format_display_name(target, "target"),  # Shortened display name
         "target_ip": target_ip if target_ip else "",  # Server will map this IP to server_name/type
         "stream_id": stream_id,  # Stream ID for URL generation
         "isp": client_isp_name,  # Include ISP name
-        "isp_display": isp_display,  # Shortened ISP display name
+        "isp_display": format_display_name(client_isp_name, "isp"),  # Shortened ISP display name
         "preview_ostream": obs_stream_preview_ostream,  # OBS OStream preview URL
         "preview_youtube": obs_stream_preview_youtube,  # OBS YouTube preview URL
-        "timestamp": int(time.time()),
-        "success": success,
-        "rtt_ms": rtt,
-        "raw": raw[:2000]
     }
-    try:
-        session.post(SERVER_URL.rstrip("/") + "/push_ping", json=payload, timeout=5)
-    except Exception as e:
-        log_print(f"Ping send error for {target}: {e}")
+
+def get_target_context(target):
+    cached = _target_contexts.get(target)
+    if cached is None or cached[0] != _context_generation or cached[1]["target_ip"] != dns_cache.peek(target_host(target)):
+        cached = (_context_generation, build_target_context(target))
+        if cached[1]["target_ip"]:  # unresolved targets are retried on the next sample
+            _target_contexts[target] = cached
+    return cached[1]
+
+def build_ping_payload(target, rtt, success, raw, stats=None):
+    payload = dict(get_target_context(target))
+    payload["timestamp"] = int(time.time())
+    payload["success"] = success
+    payload["rtt_ms"] = rtt
+    payload["raw"] = raw[:2000]
+    if stats:
+        payload.update(stats)  # burst mode: loss %, min/avg/max/mdev, jitter
+    return payload
+
+def send_ping(target, rtt, success, raw, stats=None):
+    reporter.submit("/push_ping", build_ping_payload(target, rtt, success, raw, stats))
+
+def send_ping_summary(target, histogram, window_start, window_seconds):
+    """Percentile rollup of one window for target (PING_REPORT_MODE summary/both)."""
+    payload = dict(get_target_context(target))
+    payload["timestamp"] = int(window_start + window_seconds)
+    payload["window_start"] = int(window_start)
+    payload["window_seconds"] = round(window_seconds, 1)
+    payload.update(histogram.summary())
+    reporter.submit("/push_ping_summary", payload)
  
 # ---------------- Network Speed Monitoring ----------------
 def push_agent_version():
@@ -601,66 +3162,357 @@ def push_agent_version():
             "isp":           client_isp_name,
             "gpu_name":      _gpu_name,
         }
-        session.post(SERVER_URL.rstrip("/") + "/push_agent_version", json=payload, timeout=5)
+        post_json(session, "/push_agent_version", payload)
     except Exception:
         pass
 
 
+# ---------------- Auto-Update ----------------
+# /client_version answers {"build", "sha256", "signature"}: sha256 (hex) of the /client_script bytes,
+# signature = base64 Ed25519 signature of those bytes (checked when UPDATE_PUBLIC_KEY is set).
+# A server that sends no sha256 is refused unless UPDATE_REQUIRE_SHA256=0.
+# Rollout without a monitoring gap:
+#   1. stream /client_script to <script>.update, check sha256/signature/build number/syntax
+#   2. start <script>.update --update-bridge: the new build probes our current targets (from the
+#      handoff file) while we're still running; it is ready once it has delivered a batch
+#   3. swap the files (previous build kept as <script>.backup), mark the boot pending, start
+#      <script>.backup --update-guard, drain, exit
+#   4. the service manager starts the new build, which takes over the identity from the handoff
+#      file, stops the bridge as soon as its own probes run, and marks the build ok once its
+#      reporter has delivered a batch; crashing UPDATE_MAX_BOOTS times or staying unhealthy for
+#      UPDATE_HEALTH_TIMEOUT rolls back to <script>.backup. Only crashes put the build on the
+#      PC's bad_builds list; one rolled back for lack of delivered telemetry is offered again
+#   5. the guard is the previous build's code: if the new build never marks itself ok within
+#      UPDATE_GUARD_TIMEOUT (it crashes at import or hangs before it can count its boots), the
+#      guard puts <script>.backup back and stops the new build's process
+# A bridge that never gets ready fails the update before anything is replaced.
+# Under NSSM, AppKillProcessTree must be 0, or the bridge is killed together with the old build.
+UPDATE_HANDOFF = get_env_from_registry("UPDATE_HANDOFF", "1") != "0"  # 0 = exit and let the service restart us
+UPDATE_REQUIRE_SHA256 = get_env_from_registry("UPDATE_REQUIRE_SHA256", "1") != "0"  # 0 = also accept servers that send no hash
+UPDATE_PUBLIC_KEY = get_env_from_registry("UPDATE_PUBLIC_KEY", "")  # base64 raw Ed25519 key; set = signature required
+UPDATE_BRIDGE_READY_TIMEOUT = 60  # s for the bridge to deliver its first batch
+UPDATE_BRIDGE_MAX = 180           # s a bridge runs at most (nobody took over)
+UPDATE_HANDOFF_MAX_AGE = 300      # s a handoff file stays valid
+UPDATE_HEALTH_TIMEOUT = 120       # s for a new build to deliver its first batch
+UPDATE_MAX_BOOTS = 3              # starts of a pending build before it is rolled back
+UPDATE_GUARD_TIMEOUT = UPDATE_HEALTH_TIMEOUT + 60  # s the previous build waits for the new one to be ok
+UPDATE_STATE_FILE = os.path.join(SCRIPT_DIR, "update_state.json")
+UPDATE_HANDOFF_FILE = os.path.join(SCRIPT_DIR, "update_handoff.json")
+
+try:
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey  # only for UPDATE_PUBLIC_KEY
+except ImportError:
+    Ed25519PublicKey = None
+
+_version_etag = None
+_adopted_handoff = False  # this process took over from a bridge it still has to stop
+
+def _read_json(path, default):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def _write_json(path, data):
+    temp = path + ".tmp"
+    with open(temp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(temp, path)
+
+def _remove(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def fetch_version_info():
+    """Conditional GET /client_version. Returns the answer, or None if unchanged (304) or failed."""
+    global _version_etag
+    headers = {"If-None-Match": _version_etag} if _version_etag else {}
+    resp = collectors.request(session, "GET", "/client_version", timeout=10, headers=headers)
+    if resp.status_code == 304:
+        return None
+    if resp.status_code != 200:
+        ENDPOINT_ERRORS.inc("/client_version")
+        return None
+    info = resp.json()
+    _version_etag = resp.headers.get("ETag")
+    return info
+
+def download_update(build, info):
+    """Stream /client_script to <script>.update and verify it. Returns the path, or None."""
+    temp_file = os.path.abspath(__file__) + ".update"
+    digest = hashlib.sha256()
+    size = 0
+    with collectors.request(session, "GET", "/client_script", timeout=30, stream=True) as dl:
+        if dl.status_code != 200:
+            log_print(f"[AUTO-UPDATE] Download failed: HTTP {dl.status_code}")
+            return None
+        with open(temp_file, "wb") as f:
+            for chunk in dl.iter_content(65536):
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+    problem = verify_update(temp_file, build, info, digest.hexdigest())
+    if problem:
+        log_print(f"[AUTO-UPDATE] Verification failed - {problem}")
+        _remove(temp_file)
+        return None
+    log_print(f"[AUTO-UPDATE] Downloaded {size} bytes OK (sha256 {digest.hexdigest()[:12]})")
+    return temp_file
+
+def verify_update(path, build, info, sha256):
+    """None if the downloaded script is the build the server announced, else what is wrong."""
+    expected = (info.get("sha256") or "").lower()
+    if expected and sha256 != expected:
+        return f"sha256 {sha256} != {expected}"
+    if not expected and UPDATE_REQUIRE_SHA256:
+        return "server sent no sha256 (UPDATE_REQUIRE_SHA256=0 accepts unhashed builds)"
+    with open(path, "rb") as f:
+        code = f.read()
+    if UPDATE_PUBLIC_KEY:
+        if Ed25519PublicKey is None:
+            return "UPDATE_PUBLIC_KEY is set but the cryptography module is not installed"
+        try:
+            key = Ed25519PublicKey.from_public_bytes(base64.b64decode(UPDATE_PUBLIC_KEY))
+            key.verify(base64.b64decode(info.get("signature") or ""), code)
+        except Exception:
+            return "bad or missing signature"
+    if f"CLIENT_BUILD = {build}".encode() not in code:
+        return "BUILD number mismatch in downloaded file"
+    try:
+        compile(code, path, "exec")
+    except (SyntaxError, ValueError) as e:
+        return f"does not compile ({e})"
+    return None
+
+def _spawn_detached(args, kind):
+    SUBPROCESS_SPAWNS.inc(kind)
+    if platform.system().lower() == "windows":
+        flags = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+        return subprocess.Popen(args, cwd=SCRIPT_DIR, creationflags=flags, close_fds=True,
+                                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return subprocess.Popen(args, cwd=SCRIPT_DIR, start_new_session=True, close_fds=True,
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def start_update_bridge(new_script, build):
+    """Run the new build as bridge on our current targets. Returns the bridge process once it has
+    delivered a batch, or None (it is killed) if it didn't in time."""
+    _remove(UPDATE_HANDOFF_FILE + ".ready", UPDATE_HANDOFF_FILE + ".stop")
+    _write_json(UPDATE_HANDOFF_FILE, {
+        "time": time.time(), "from_build": CLIENT_BUILD, "to_build": build,
+        "targets": sorted(latest_rtts.targets()),
+        "identity": {"local_ip": client_local_ip, "public_ip": client_public_ip, "isp": client_isp_name},
+    })
+    proc = _spawn_detached([sys.executable, new_script, "--update-bridge"], "update-bridge")
+    deadline = time.monotonic() + UPDATE_BRIDGE_READY_TIMEOUT
+    while time.monotonic() < deadline:
+        if os.path.exists(UPDATE_HANDOFF_FILE + ".ready"):
+            return proc
+        if proc.poll() is not None:
+            log_print(f"[AUTO-UPDATE] Bridge exited with code {proc.returncode}")
+            break
+        time.sleep(0.1)
+    else:
+        log_print("[AUTO-UPDATE] Bridge did not deliver any samples in time")
+    if proc.poll() is None:
+        proc.kill()
+    _remove(UPDATE_HANDOFF_FILE, UPDATE_HANDOFF_FILE + ".ready")
+    return None
+
+def _mark_bad_build(build):
+    state = _read_json(UPDATE_STATE_FILE, {})
+    state["bad_builds"] = sorted(set(state.get("bad_builds", [])) | {build})
+    _write_json(UPDATE_STATE_FILE, state)
+
 def check_and_apply_update():
     """
     Check server for a newer build of client_ping.py.
-    If found: download → verify → replace current script → exit.
-    NSSM auto-restarts the service, loading the new code.
+    If found: download → verify → bridge → replace current script → start guard → exit.
+    The service manager restarts us on the new code; the guard (this build, from <script>.backup)
+    rolls it back if it never reports healthy.
     """
     try:
-        resp = session.get(SERVER_URL.rstrip("/") + "/client_version", timeout=10)
-        if resp.status_code != 200:
+        info = fetch_version_info()
+        if info is None:
             return
 
-        server_build = int(resp.json().get("build", 0))
+        server_build = int(info.get("build", 0))
 
         if server_build <= CLIENT_BUILD:
             return  # Up-to-date, no log needed
+        if server_build in _read_json(UPDATE_STATE_FILE, {}).get("bad_builds", []):
+            return  # failed here before
 
         log_print(f"[AUTO-UPDATE] New version available! server={server_build}, current={CLIENT_BUILD}")
         log_print(f"[AUTO-UPDATE] Downloading...")
 
-        dl = session.get(SERVER_URL.rstrip("/") + "/client_script", timeout=30)
-        if dl.status_code != 200:
-            log_print(f"[AUTO-UPDATE] Download failed: HTTP {dl.status_code}")
+        temp_file = download_update(server_build, info)
+        if temp_file is None:
             return
 
-        new_code = dl.text
-
-        # Verify the downloaded file actually has the expected build number
-        if f"CLIENT_BUILD = {server_build}" not in new_code:
-            log_print(f"[AUTO-UPDATE] Verification failed - BUILD number mismatch in downloaded file")
-            return
+        if UPDATE_HANDOFF:
+            if start_update_bridge(temp_file, server_build) is None:
+                log_print(f"[AUTO-UPDATE] Build {server_build} failed its bridge health check - staying on {CLIENT_BUILD}")
+                _mark_bad_build(server_build)
+                _remove(temp_file)
+                return
+            log_print(f"[AUTO-UPDATE] Bridge on build {server_build} is probing our targets")
 
         current_script = os.path.abspath(__file__)
-        temp_file  = current_script + ".update"
         backup_file = current_script + ".backup"
 
-        # Write to temp file
-        with open(temp_file, "w", encoding="utf-8") as f:
-            f.write(new_code)
-
-        log_print(f"[AUTO-UPDATE] Downloaded {len(new_code)} bytes OK")
-
         # Backup current version
         if os.path.exists(backup_file):
             os.remove(backup_file)
         shutil.copy2(current_script, backup_file)
 
         # Replace with new version (Python already loaded itself into memory - safe to overwrite)
-        shutil.move(temp_file, current_script)
+        os.replace(temp_file, current_script)
+        state = _read_json(UPDATE_STATE_FILE, {})
+        state.update(build=server_build, previous=CLIENT_BUILD, status="pending", boots=0,
+                     script=current_script, pid=None)
+        _write_json(UPDATE_STATE_FILE, state)
+        _spawn_detached([sys.executable, backup_file, "--update-guard"], "update-guard")
 
         log_print(f"[AUTO-UPDATE] Applied build {server_build}. Restarting service...")
+        reporter.drain()
         os._exit(0)   # Force-kill entire process (sys.exit only kills the thread)
 
     except Exception as e:
+        ENDPOINT_ERRORS.inc("/client_version")
         log_print(f"[AUTO-UPDATE] Error: {e}")
 
+def run_update_bridge():
+    """--update-bridge: probe the handed-off targets until the new build's service process takes
+    over (creates <handoff>.stop) or UPDATE_BRIDGE_MAX runs out."""
+    global client_local_ip, client_public_ip, client_isp_name
+    handoff = _read_json(UPDATE_HANDOFF_FILE, None)
+    if not handoff:
+        os._exit(2)
+    identity = handoff.get("identity", {})
+    client_local_ip = identity.get("local_ip", client_local_ip)
+    client_public_ip = identity.get("public_ip", client_public_ip)
+    client_isp_name = identity.get("isp", client_isp_name)
+    # spool/ belongs to the old process and the restarted service (segment names and replay
+    # offsets assume one writer); the bridge runs for seconds and keeps nothing on disk
+    reporter.spool.max_bytes = 0
+    log_print(f"[AUTO-UPDATE] Bridge (build {CLIENT_BUILD}) probing {len(handoff['targets'])} targets")
+    scheduler = ProbeScheduler()
+    scheduler.set_targets(set(handoff["targets"]))
+    deadline = time.monotonic() + UPDATE_BRIDGE_MAX
+    ready = False
+    while time.monotonic() < deadline and not os.path.exists(UPDATE_HANDOFF_FILE + ".stop"):
+        if not ready and reporter.sent > 0:
+            _write_json(UPDATE_HANDOFF_FILE + ".ready", {"pid": os.getpid()})
+            ready = True
+        time.sleep(0.05)
+    scheduler.set_targets(set())
+    reporter.drain()
+    _remove(UPDATE_HANDOFF_FILE + ".stop")
+    os._exit(0)
+
+def run_update_guard():
+    """--update-guard, run from <script>.backup: wait for the pending build to mark itself ok (or
+    roll itself back); after UPDATE_GUARD_TIMEOUT restore this build and stop the new one. Needed
+    because a build that dies before check_update_boot() never counts its own boots."""
+    deadline = time.monotonic() + UPDATE_GUARD_TIMEOUT
+    while time.monotonic() < deadline:
+        if _read_json(UPDATE_STATE_FILE, {}).get("status") != "pending":
+            os._exit(0)
+        time.sleep(1)
+    state = _read_json(UPDATE_STATE_FILE, {})
+    if state.get("status") != "pending" or not state.get("script"):
+        os._exit(0)
+    script = state["script"]
+    log_print(f"[AUTO-UPDATE] Build {state.get('build')} not healthy after {UPDATE_GUARD_TIMEOUT}s - "
+              f"guard restores build {CLIENT_BUILD}")
+    shutil.copy2(os.path.abspath(__file__), script + ".rollback")
+    os.replace(script + ".rollback", script)
+    state["status"] = "rolled_back"
+    if not state.get("boots"):  # died before check_update_boot(); a build that booted may only lack a collector
+        state["bad_builds"] = sorted(set(state.get("bad_builds", [])) | {state.get("build")})
+    _write_json(UPDATE_STATE_FILE, state)
+    if state.get("pid"):
+        try:
+            proc = psutil.Process(state["pid"])
+            if any(script in part for part in proc.cmdline()):  # not a recycled pid
+                proc.kill()  # hung new build; the service manager restarts us
+        except psutil.Error:
+            pass
+    os._exit(0)
+
+def adopt_update_handoff():
+    """At service start: identity from a fresh handoff file (so detection needn't block), or None."""
+    global client_local_ip, client_public_ip, client_isp_name, _adopted_handoff
+    handoff = _read_json(UPDATE_HANDOFF_FILE, None)
+    if not handoff or time.time() - handoff.get("time", 0) > UPDATE_HANDOFF_MAX_AGE:
+        return None
+    _adopted_handoff = True
+    identity = handoff.get("identity", {})
+    client_local_ip = identity.get("local_ip", client_local_ip)
+    client_public_ip = identity.get("public_ip", client_public_ip)
+    client_isp_name = identity.get("isp", client_isp_name)
+    log_print(f"[AUTO-UPDATE] Taking over from build {handoff.get('from_build')} (bridge running)")
+    return handoff
+
+def release_update_bridge():
+    """Our own probes are running: tell the bridge we took over from to stop (no-op without one)."""
+    global _adopted_handoff
+    if _adopted_handoff:
+        _adopted_handoff = False
+        _write_json(UPDATE_HANDOFF_FILE + ".stop", {"pid": os.getpid()})
+        _remove(UPDATE_HANDOFF_FILE, UPDATE_HANDOFF_FILE + ".ready")
+
+def check_update_boot():
+    """Boot marker for a just-applied build: roll back after UPDATE_MAX_BOOTS starts, else watch
+    that the collector accepts a batch within UPDATE_HEALTH_TIMEOUT."""
+    state = _read_json(UPDATE_STATE_FILE, {})
+    if state.get("status") != "pending" or state.get("build") != CLIENT_BUILD:
+        return
+    state["boots"] = state.get("boots", 0) + 1
+    state["pid"] = os.getpid()  # for the guard, should we hang
+    _write_json(UPDATE_STATE_FILE, state)
+    if state["boots"] > UPDATE_MAX_BOOTS:
+        rollback_update(f"started {state['boots'] - 1} times without becoming healthy")
+
+    def watch():
+        deadline = time.monotonic() + UPDATE_HEALTH_TIMEOUT
+        while time.monotonic() < deadline:
+            if reporter.sent > 0:  # delivered, not just flushed (a spooled flush counts too)
+                current = _read_json(UPDATE_STATE_FILE, {})
+                if current.get("status") == "pending" and current.get("build") == CLIENT_BUILD:
+                    current.update(status="ok", boots=0)  # re-read: the guard may have rolled us back
+                    _write_json(UPDATE_STATE_FILE, current)
+                    log_print(f"[AUTO-UPDATE] Build {CLIENT_BUILD} is healthy")
+                return
+            time.sleep(0.5)
+        # the collector may just be unreachable: roll back, but let the build be tried again
+        rollback_update(f"no telemetry delivered within {UPDATE_HEALTH_TIMEOUT}s", bad_build=False)
+
+    threading.Thread(target=watch, name="update-health", daemon=True).start()
+
+def rollback_update(reason, bad_build=True):
+    """Put <script>.backup back and exit so the service manager starts the previous build.
+    bad_build: never install this build again on this PC (it crashed, not just went unheard)."""
+    current_script = os.path.abspath(__file__)
+    backup_file = current_script + ".backup"
+    state = _read_json(UPDATE_STATE_FILE, {})
+    log_print(f"[AUTO-UPDATE] Build {CLIENT_BUILD} {reason} - rolling back to {state.get('previous')}")
+    if not os.path.exists(backup_file):
+        log_print("[AUTO-UPDATE] No backup to roll back to - keeping this build")
+        return
+    shutil.copy2(backup_file, current_script + ".rollback")
+    os.replace(current_script + ".rollback", current_script)
+    state["status"] = "rolled_back"
+    if bad_build:
+        state["bad_builds"] = sorted(set(state.get("bad_builds", [])) | {CLIENT_BUILD})
+    _write_json(UPDATE_STATE_FILE, state)
+    reporter.drain()  # a bridge keeps probing until the previous build takes over
+    os._exit(1)
+
 
 def auto_update_loop():
     """Background thread: wait 5s on startup, then check every UPDATE_CHECK_INTERVAL seconds."""
@@ -673,7 +3525,7 @@ def auto_update_loop():
 
 # ---------------- Network Speed Monitoring ----------------
 def push_network_speed(download_mbps, upload_mbps):
-    """Send real-time network speed to server for InfluxDB storage."""
+    """Queue real-time network speed for the server (InfluxDB storage)."""
     try:
         isp_display = format_display_name(client_isp_name, "isp")
         payload = {
@@ -685,7 +3537,7 @@ def push_network_speed(download_mbps, upload_mbps):
             "upload_mbps": round(upload_mbps, 4),
             "timestamp": int(time.time())
         }
-        session.post(SERVER_URL.rstrip("/") + "/push_network_speed", json=payload, timeout=5)
+        reporter.submit("/push_network_speed", payload)
     except Exception:
         pass  # Silent - not critical
 
@@ -707,6 +3559,7 @@ def network_speed_loop():
             curr_io = psutil.net_io_counters(pernic=True)
             curr_time = time.perf_counter()
             elapsed = curr_time - prev_time
+            SCHEDULE_LAG.observe(max(0.0, elapsed - 1), "network_speed_loop")
 
             total_sent = 0
             total_recv = 0
@@ -755,6 +3608,7 @@ def _try_install_gputil():
     except ImportError:
         pass
     try:
+        SUBPROCESS_SPAWNS.inc("pip")
         subprocess.run(
             [sys.executable, "-m", "pip", "install", "gputil", "--quiet"],
             timeout=60, capture_output=True
@@ -777,6 +3631,7 @@ def _detect_gpu_name():
         pass
     # Method 2: WMI via PowerShell (AMD/Intel/all)
     try:
+        SUBPROCESS_SPAWNS.inc("powershell")
         result = subprocess.run(
             ["powershell", "-NoProfile", "-Command",
              "Get-WmiObject Win32_VideoController | Select-Object -ExpandProperty Name"],
@@ -790,12 +3645,181 @@ def _detect_gpu_name():
         pass
     return "unknown"
 
+# ---------------- GPU Samplers ----------------
+# GPU_SAMPLER: "auto" or a backend name from gpu_sampler_candidates()
+GPU_SAMPLER = get_env_from_registry("GPU_SAMPLER", "auto").lower()
+GPU_SAMPLE_INTERVAL = 3  # seconds
+# Optional custom backend: a long-running command printing one usage % per line
+GPU_SAMPLER_COMMAND = get_env_from_registry("GPU_SAMPLER_COMMAND", "")
+
+# PowerShell loop explanation (one persistent process, one line per sample):
+# - Queries ALL GPU engine types: 3D, VideoEncode, VideoDecode, Compute, etc.
+# - Groups counters by GPU index, sums each GPU's total engine usage
+# - Returns the maximum across all GPUs (handles multi-GPU systems correctly)
+# - Caps at 100.0 per GPU before reporting
+_PS_GPU_LOOP = (
+    "while($true){"
+    "$samples=(Get-Counter '\\GPU Engine(*)\\Utilization Percentage'"
+    " -ErrorAction SilentlyContinue).CounterSamples;"
+    "$byGpu=$samples|Group-Object{[regex]::Match($_.InstanceName,'luid.*?_phys_(\\d+)').Value};"
+    "$maxVal=($byGpu|ForEach-Object{"
+    "  [Math]::Min(100,($_.Group|Measure-Object CookedValue -Sum).Sum)"
+    "}|Measure-Object -Maximum).Maximum;"
+    "if([double]::IsNaN($maxVal) -or $maxVal -eq $null){0}else{[Math]::Round($maxVal,1)};"
+    "[Console]::Out.Flush();"
+    f"Start-Sleep -Seconds {GPU_SAMPLE_INTERVAL}"
+    "}"
+)
+
+class GpuSampler:
+    """
+    GPU usage backend.
+    - start() begins sampling, latest() returns the newest usage % (or None yet)
+    - healthy() is False once no sample arrived for stale_after seconds
+      (a grace period after start() counts as healthy)
+    """
+    name = "none"
+
+    def __init__(self, stale_after=GPU_SAMPLE_INTERVAL * 4):
+        self.stale_after = stale_after
+        self.samples = 0
+        self._value = None
+        self._last_sample = None
+        self._started = None
+
+    def start(self):
+        self._started = time.monotonic()
+
+    def stop(self):
+        pass
+
+    def latest(self):
+        return self._value
+
+    def healthy(self):
+        last = self._last_sample or self._started
+        return last is not None and time.monotonic() - last < self.stale_after
+
+    def _set(self, value):
+        self._value = value
+        self._last_sample = time.monotonic()
+        self.samples += 1
+
+class StreamingCommandSampler(GpuSampler):
+    """
+    One long-lived process emitting samples on stdout, read line by line by a reader thread.
+    parse_line(line) returns (key, usage) or None; latest() is the max over keys (one key per GPU).
+    """
+    def __init__(self, name, cmd, parse_line, stale_after=GPU_SAMPLE_INTERVAL * 4):
+        super().__init__(stale_after)
+        self.name = name
+        self.cmd = cmd
+        self.parse_line = parse_line
+        self.proc = None
+        self._per_key = {}
+
+    def start(self):
+        super().start()
+        SUBPROCESS_SPAWNS.inc(f"gpu-{self.name}")
+        self.proc = subprocess.Popen(
+            self.cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL,
+            text=True, bufsize=1,
+            creationflags=subprocess.CREATE_NO_WINDOW if platform.system().lower() == 'windows' else 0
+        )
+        threading.Thread(target=self._reader, args=(self.proc,), name=f"gpu-{self.name}", daemon=True).start()
+
+    def _reader(self, proc):
+        for line in proc.stdout:
+            try:
+                parsed = self.parse_line(line)
+            except (ValueError, IndexError):
+                continue
+            if parsed is not None:
+                key, usage = parsed
+                self._per_key[key] = usage
+                self._set(max(self._per_key.values()))
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                pass
+
+    def healthy(self):
+        return self.proc is not None and self.proc.poll() is None and super().healthy()
+
+class SysfsGpuSampler(GpuSampler):
+    """Linux amdgpu: /sys/class/drm/card*/device/gpu_busy_percent, read in-process (no child process)."""
+    name = "sysfs"
+
+    def __init__(self, stale_after=GPU_SAMPLE_INTERVAL * 4):
+        super().__init__(stale_after)
+        self.paths = sorted(
+            os.path.join("/sys/class/drm", card, "device", "gpu_busy_percent")
+            for card in (os.listdir("/sys/class/drm") if os.path.isdir("/sys/class/drm") else [])
+            if card.startswith("card") and "-" not in card
+        )
+        self.paths = [p for p in self.paths if os.path.exists(p)]
+
+    def latest(self):
+        values = []
+        for path in self.paths:
+            try:
+                with open(path) as f:
+                    values.append(float(f.read().strip()))
+            except (OSError, ValueError):
+                pass
+        if values:
+            self._set(max(values))
+        return self._value
+
+    def healthy(self):
+        self.latest()
+        return super().healthy()
+
+def _parse_single_value(line):
+    line = line.strip()
+    return (None, float(line)) if line else None
+
+def _parse_nvidia_dmon(line):
+    """nvidia-smi dmon -s u: "# gpu sm mem enc dec ..." header, then "0  35  12  48  0" per GPU."""
+    if line.startswith("#"):
+        return None
+    fields = line.split()
+    busy = [float(v) for v in fields[1:2] + fields[3:5] if v != "-"]  # sm, enc, dec (NVENC counts)
+    return (fields[0], max(busy)) if busy else None
+
+def gpu_sampler_candidates():
+    """Backend factories to try, best first."""
+    candidates = []
+    if GPU_SAMPLER_COMMAND:
+        cmd = GPU_SAMPLER_COMMAND if platform.system().lower() == 'windows' else shlex.split(GPU_SAMPLER_COMMAND)
+        candidates.append(("command", lambda: StreamingCommandSampler("command", cmd, _parse_single_value)))
+    if platform.system().lower() == 'windows':
+        candidates.append(("powershell", lambda: StreamingCommandSampler(
+            "powershell", ["powershell", "-NoProfile", "-NonInteractive", "-Command", _PS_GPU_LOOP],
+            _parse_single_value)))
+    if shutil.which("nvidia-smi"):
+        candidates.append(("nvidia-smi", lambda: StreamingCommandSampler(
+            "nvidia-smi", ["nvidia-smi", "dmon", "-s", "u", "-d", str(GPU_SAMPLE_INTERVAL)],
+            _parse_nvidia_dmon)))
+    if platform.system().lower() == 'linux' and SysfsGpuSampler().paths:
+        candidates.append(("sysfs", SysfsGpuSampler))
+    if GPU_SAMPLER != "auto":
+        candidates = [c for c in candidates if c[0] == GPU_SAMPLER]
+    return candidates
+
 def _gpu_monitor_loop():
     """
-    Background thread: detects GPU name once, then polls GPU usage every 3 seconds.
-    Uses Windows GPU Engine performance counters (all engine types) for accurate
-    GPU usage across NVIDIA/AMD/Intel — including NVENC, VideoDecode, 3D, Compute.
+    Background thread: detects GPU name once, then reports GPU usage every 3 seconds.
+    Usage comes from a long-lived sampler (see gpu_sampler_candidates) instead of a
+    fresh PowerShell per sample: on Windows the GPU Engine performance counters (all
+    engine types, NVIDIA/AMD/Intel — including NVENC, VideoDecode, 3D, Compute).
     GPUtil is kept only for name detection; NOT used for usage (it misses NVENC).
+    A sampler that stops producing samples is restarted; after 3 failed restarts the
+    next backend is tried.
     Runs separately so slow GPU queries never block the 1-second stats loop.
     """
     global _gpu_usage, _gpu_name
@@ -803,37 +3827,45 @@ def _gpu_monitor_loop():
     _gpu_name = _detect_gpu_name()
     log_print(f"[GPU] Detected: {_gpu_name}")
 
-    # PowerShell command explanation:
-    # - Queries ALL GPU engine types: 3D, VideoEncode, VideoDecode, Compute, etc.
-    # - Groups counters by GPU index, sums each GPU's total engine usage
-    # - Returns the maximum across all GPUs (handles multi-GPU systems correctly)
-    # - Caps at 100.0 per GPU before reporting
-    _PS_GPU_CMD = (
-        "$samples=(Get-Counter '\\GPU Engine(*)\\Utilization Percentage'"
-        " -ErrorAction SilentlyContinue).CounterSamples;"
-        "$byGpu=$samples|Group-Object{[regex]::Match($_.InstanceName,'luid.*?_phys_(\\d+)').Value};"
-        "$maxVal=($byGpu|ForEach-Object{"
-        "  [Math]::Min(100,($_.Group|Measure-Object CookedValue -Sum).Sum)"
-        "}|Measure-Object -Maximum).Maximum;"
-        "if([double]::IsNaN($maxVal) -or $maxVal -eq $null){0}else{[Math]::Round($maxVal,1)}"
-    )
-
+    candidates = gpu_sampler_candidates()
+    if not candidates:
+        log_print("[GPU] No usage sampler available on this host")
+        return
+    index, failures, sampler = 0, 0, None
+    last_tick = time.perf_counter()
     while True:
+        now = time.perf_counter()
+        SCHEDULE_LAG.observe(max(0.0, now - last_tick - GPU_SAMPLE_INTERVAL), "_gpu_monitor_loop")
+        last_tick = now
         try:
-            result = subprocess.run(
-                ["powershell", "-NoProfile", "-Command", _PS_GPU_CMD],
-                capture_output=True, text=True, timeout=10,
-                creationflags=subprocess.CREATE_NO_WINDOW
-            )
-            val = result.stdout.strip()
-            if val:
-                _gpu_usage = min(100.0, round(float(val), 1))
-        except Exception:
-            pass
-        time.sleep(3)
+            if sampler is None:
+                name, factory = candidates[index]
+                sampler = factory()
+                sampler.start()
+                log_print(f"[GPU] Usage sampler started: {name}")
+            elif not sampler.healthy():
+                sampler.stop()
+                failures += 1
+                log_print(f"[GPU] Sampler {sampler.name} unhealthy (failure {failures})")
+                sampler = None
+                if failures >= 3:
+                    index, failures = (index + 1) % len(candidates), 0
+                continue
+            else:
+                failures = 0 if sampler.samples else failures
+                value = sampler.latest()
+                if value is not None:
+                    _gpu_usage = min(100.0, round(value, 1))
+        except Exception as e:
+            log_print(f"[GPU] Sampler error: {e}")
+            if sampler is not None:
+                sampler.stop()
+            sampler = None
+            index = (index + 1) % len(candidates)
+        time.sleep(GPU_SAMPLE_INTERVAL)
 
 def push_system_stats(cpu_percent, mem_total_mb, mem_available_mb, mem_used_mb, mem_percent):
-    """Send CPU and memory stats to server for InfluxDB storage."""
+    """Queue CPU and memory stats for the server (InfluxDB storage)."""
     try:
         isp_display = format_display_name(client_isp_name, "isp")
         payload = {
@@ -850,7 +3882,7 @@ def push_system_stats(cpu_percent, mem_total_mb, mem_available_mb, mem_used_mb,
             "gpu_name": _gpu_name,
             "timestamp": int(time.time())
         }
-        session.post(SERVER_URL.rstrip("/") + "/push_system_stats", json=payload, timeout=5)
+        reporter.submit("/push_system_stats", payload)
     except Exception:
         pass  # Silent - not critical
 
@@ -863,10 +3895,14 @@ def system_stats_loop():
     """
     # First call initializes the CPU counter (returns 0.0, discard)
     psutil.cpu_percent(interval=None)
+    last_tick = time.perf_counter()
 
     while True:
         try:
             time.sleep(1)
+            now = time.perf_counter()
+            SCHEDULE_LAG.observe(max(0.0, now - last_tick - 1), "system_stats_loop")
+            last_tick = now
             cpu = psutil.cpu_percent(interval=None)   # non-blocking, delta since last call
             mem = psutil.virtual_memory()
             mem_total_mb     = round(mem.total     / (1024 * 1024), 1)
@@ -878,19 +3914,64 @@ def system_stats_loop():
             log_print(f"System stats error: {e}")
             time.sleep(5)
 
+# ---------------- Latest RTT Store ----------------
+class LatestRttStore:
+    """
+    Latest probe result per target. Every ping_loop probe writes here, so
+    push_client_info can report RTTs without probing anything itself.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest = {}  # target -> (success, rtt, wall time)
+
+    def record(self, target, success, rtt):
+        with self._lock:
+            self._latest[target] = (success, rtt, time.time())
+
+    def get(self, target, max_age=None):
+        """(success, rtt, timestamp) or None if the target has no result (or only one older than max_age)."""
+        with self._lock:
+            entry = self._latest.get(target)
+        if entry is None or (max_age is not None and time.time() - entry[2] > max_age):
+            return None
+        return entry
+
+    def discard(self, target):
+        with self._lock:
+            self._latest.pop(target, None)
+
+    def targets(self):
+        """Targets with a result, i.e. the ones ping_loop is probing."""
+        with self._lock:
+            return set(self._latest)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._latest)
+
+latest_rtts = LatestRttStore()
+# RTTs older than this are reported as 0.0 (target stalled or no longer probed)
+CLIENT_INFO_RTT_MAX_AGE = max(10, PING_INTERVAL * 3)
+
+def _latest_ping(target):
+    entry = latest_rtts.get(target, CLIENT_INFO_RTT_MAX_AGE)
+    if entry is None:
+        return 0.0
+    success, rtt, _ = entry
+    return rtt if success and rtt >= 0 else 0.0
+
 # ---------------- Push ISP info ----------------
 def push_client_info():
-    """Push client info to server using detected values."""
+    """Push client info to server using detected values. Reads snapshots only: the OBS fields
+    as detect_obs_streaming_data() last set them (startup, config changes, refresh) and the
+    targets ping_loop is probing, so a push neither re-reads the config nor logs it."""
     try:
         # Check if OBS is running
         obs_running = is_obs_running()
         
         if obs_running:
-            # Detect latest OBS streaming data before pushing
-            detect_obs_streaming_data()
-            
-            # Get current streaming servers from environment
-            streaming_servers = get_targets_from_env()
+            # Targets being probed right now (the ones ping_loop records RTTs for)
+            streaming_servers = sorted(latest_rtts.targets())
             
             # Separate os-origin server and youtube
             os_origin_server = "none"
@@ -899,17 +3980,15 @@ def push_client_info():
             youtube_ping = 0.0
             
             for target in streaming_servers:
-                # Do a quick ping to get latest RTT
-                success, rtt, _ = do_ping_once(target)
-                
+                # Latest RTT measured by the target's ping_loop (never probe from here)
                 # For os-origin servers
                 if target.lower().startswith("os-") or "ostream" in target.lower() or "origin" in target.lower():
                     os_origin_server = target
-                    os_origin_ping = rtt if success and rtt >= 0 else 0.0
+                    os_origin_ping = _latest_ping(target)
                 # For YouTube/RTMP servers
                 elif "youtube" in target.lower() or "rtmp" in target.lower():
                     youtube_server = target
-                    youtube_ping = rtt if success and rtt >= 0 else 0.0
+                    youtube_ping = _latest_ping(target)
         else:
             # OBS not running - send empty/unknown data
             os_origin_server = "none"
@@ -934,7 +4013,7 @@ def push_client_info():
             "youtube_ping": youtube_ping,
             "obs_running": obs_running
         }
-        session.post(SERVER_URL.rstrip("/") + "/push_client_info", json=payload, timeout=5)
+        post_json(session, "/push_client_info", payload, hedge=True)  # idempotent snapshot
         
         if obs_running:
             log_print(f"Client info pushed: {client_isp_name} ({client_public_ip}) | ICR: {obs_icr_code} | OStream: {os_origin_server} ({os_origin_ping}ms)")
@@ -942,35 +4021,431 @@ def push_client_info():
             log_print(f"Client info pushed: {client_isp_name} ({client_public_ip}) | OBS: NOT RUNNING - cleared data")
     except Exception as e:
         log_print(f"Failed to push client info: {e}")
+
+CLIENT_INFO_INTERVAL = int(get_env_from_registry("CLIENT_INFO_INTERVAL", "60"))  # seconds
+
+class ClientInfoScheduler:
+    """
+    The only caller of push_client_info once the agent is running.
+    - Pushes every CLIENT_INFO_INTERVAL seconds while any target is being probed
+    - request() pushes as soon as possible; requests arriving before that push
+      runs collapse into it, so N targets never mean N pushes
+    """
+    def __init__(self, interval=None, push=None):
+        self.interval = interval or CLIENT_INFO_INTERVAL
+        self.push = push or push_client_info
+        self.pushes = 0
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="client-info", daemon=True)
+            self._thread.start()
+
+    def request(self):
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        while not self._stopped:
+            requested = self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped:
+                break
+            if requested or len(latest_rtts):
+                self.push()
+                self.pushes += 1
+
+client_info_scheduler = ClientInfoScheduler()
  
 # ---------------- Ping Loop ----------------
-threads = {}
-stop_flags = {}
-client_info_counters = {}  # Track when to send client info
- 
-def ping_loop(target):
-    tf = stop_flags[target]
-    client_info_counters[target] = 0
-   
-    while not tf['stop']:
-        # Always try resolving IP / domain
-        success, rtt, raw = do_ping_once(target)
-        send_ping(target, rtt, success, raw)
-       
-        # Send client info only every 60 pings (approximately 1 minute if PING_INTERVAL=1)
-        client_info_counters[target] += 1
-        if client_info_counters[target] >= 60:
-            push_client_info()  # No argument needed
-            client_info_counters[target] = 0
-       
-        time.sleep(PING_INTERVAL)
- 
+PROBE_WORKERS = int(get_env_from_registry("PROBE_WORKERS", "16"))  # threads for blocking work (DNS, ping command, POSTs)
+
+async def async_ping_once(target, executor=None):
+    """Awaitable do_ping_once: native engine replies are awaited on the event loop, blocking work goes to executor."""
+    if "://" in target and parse_target_spec(target)[0] != "icmp":
+        return (await async_connect_probe(target, executor))[:3]
+    loop = asyncio.get_running_loop()
+    engine = get_icmp_engine() if PROBE_BACKEND not in _PING_COMMAND_BACKENDS else None
+    if engine is None:
+        if PROBE_BACKEND == "icmp":
+            return False, -10.0, "Native ICMP unavailable"
+        if use_continuous_ping():
+            return (await async_ping_continuous(target, executor))[-1]
+        return await loop.run_in_executor(executor, do_ping_subprocess, target)
+    timeout_ms, _ = _probe_timeouts(target)
+    ip = dns_cache.lookup(target_host(target)) or await loop.run_in_executor(executor, resolve_target_to_ip, target)
+    if not ip:
+        return False, -10.0, f"Could not resolve {target}"
+    return _min_rtt(await asyncio.wrap_future(engine.submit(ip, timeout_ms / 1000)))
+
+async def async_ping_burst(target, executor=None, count=None, spacing_ms=None, histogram=None):
+    """
+    Awaitable probe for one interval: (success, rtt, raw, stats); stats is None for single pings.
+    Every individual probe result is also recorded in histogram, if given.
+    """
+    if "://" in target and parse_target_spec(target)[0] != "icmp":
+        # One connection per interval: bursts of handshakes against an ingest server are not polite
+        success, rtt, raw, stats = await async_connect_probe(target, executor)
+        _record_results(histogram, [(success, rtt, raw)])
+        return success, rtt, raw, stats
+    if use_continuous_ping() and (PROBE_BACKEND == "continuous" or get_icmp_engine() is None):
+        # Long-running ping: one reply per interval; after a stall everything read since
+        # the last interval (including sequence-gap losses) is summarized like a burst
+        results = await async_ping_continuous(target, executor)
+        _record_results(histogram, results)
+        return results[0] + (None,) if len(results) == 1 else _burst_result(target_host(target), results)
+    count = count or PING_BURST_COUNT
+    spacing_ms = PING_BURST_SPACING_MS if spacing_ms is None else spacing_ms
+    if count <= 1:
+        result = await async_ping_once(target, executor)
+        _record_results(histogram, [result])
+        return result + (None,)
+    loop = asyncio.get_running_loop()
+    engine = get_icmp_engine() if PROBE_BACKEND not in _PING_COMMAND_BACKENDS else None
+    if engine is None:
+        if PROBE_BACKEND == "icmp":
+            _record_results(histogram, [(False, -10.0, "")] * count)
+            return False, -10.0, "Native ICMP unavailable", burst_stats([], count)
+        return await loop.run_in_executor(executor, do_ping_burst_subprocess, target, count, spacing_ms, histogram)
+    ip = dns_cache.lookup(target_host(target)) or await loop.run_in_executor(executor, resolve_target_to_ip, target)
+    if not ip:
+        _record_results(histogram, [(False, -10.0, "")] * count)
+        return False, -10.0, f"Could not resolve {target}", burst_stats([], count)
+    timeout_ms, _ = _probe_timeouts(target)
+    waiters = []
+    for i in range(count):
+        if i:
+            await asyncio.sleep(spacing_ms / 1000)
+        waiters.append(asyncio.wrap_future(engine.submit(ip, timeout_ms / 1000)))
+    results = await asyncio.gather(*waiters)
+    _record_results(histogram, results)
+    return _burst_result(ip, results)
+
+async def ping_loop(target, scheduler):
+    """
+    Per-target task: probe on fixed-rate deadlines (start + n * PING_INTERVAL).
+    The POST is handed off without waiting, so a slow server never shifts the cadence;
+    if a probe overruns its slot the missed slots are skipped instead of bursting.
+    In summary/both report modes every probe also goes into an RttHistogram that is
+    rolled up and reset every PING_SUMMARY_WINDOW seconds.
+    tcp:// and tls:// targets also get an RTMP handshake every RTMP_PROBE_INTERVAL
+    seconds; it runs as its own task (it can take seconds) and its rtmp_handshake_ms goes
+    on the first sample after it finished.
+    When the target degrades (DegradationDetector) a path trace runs in the
+    background, at most once per PATH_TRACE_MIN_INTERVAL.
+    """
+    loop = asyncio.get_running_loop()
+    next_deadline = loop.time()
+    pending_send = None  # at most one POST in flight per target, so a slow server can't pile up work
+    send_raw = PING_REPORT_MODE in ("raw", "both")
+    histogram = RttHistogram() if PING_REPORT_MODE in ("summary", "both") else None
+    window_start = time.time()
+    window_end = loop.time() + PING_SUMMARY_WINDOW
+    detector = DegradationDetector() if PATH_TRACE else None
+    trace_task = None
+    rtmp_task = None
+    next_trace = 0.0  # loop time before which no new path trace starts (PATH_TRACE_MIN_INTERVAL)
+    # RTMP handshake on connect targets, rate-limited (first one right away)
+    rtmp_due = loop.time() if RTMP_PROBE_INTERVAL > 0 and parse_target_spec(target)[0] != "icmp" else math.inf
+
+    try:
+        while True:
+            probe_started = loop.time()
+            success, rtt, raw, stats = await async_ping_burst(target, scheduler.executor, histogram=histogram)
+            PROBE_DURATION.observe(loop.time() - probe_started)
+            if rtmp_task is not None and rtmp_task.done():
+                stats = dict(stats or {}, **rtmp_task.result())
+                rtmp_task = None
+            if rtmp_task is None and loop.time() >= rtmp_due:
+                rtmp_due = loop.time() + RTMP_PROBE_INTERVAL
+                rtmp_task = loop.create_task(async_rtmp_handshake_probe(target, scheduler.executor))
+            latest_rtts.record(target, success, rtt)
+            if detector is not None:
+                reason = detector.observe(success, rtt)
+                if reason and loop.time() >= next_trace and (trace_task is None or trace_task.done()):
+                    next_trace = loop.time() + PATH_TRACE_MIN_INTERVAL
+                    trace_task = loop.create_task(run_path_trace(target, reason, scheduler.executor))
+            if send_raw:
+                if pending_send is None or pending_send.done():
+                    pending_send = loop.run_in_executor(scheduler.executor, send_ping, target, rtt, success, raw, stats)
+                else:
+                    reporter.record_dropped()  # the previous sample is still waiting for room (block policy)
+
+            if histogram is not None and loop.time() >= window_end:
+                now_wall = time.time()
+                rollup, histogram = histogram, RttHistogram()
+                loop.run_in_executor(scheduler.executor, send_ping_summary, target, rollup, window_start, now_wall - window_start)
+                window_start = now_wall
+                window_end = loop.time() + PING_SUMMARY_WINDOW
+
+            next_deadline += PING_INTERVAL
+            now = loop.time()
+            if next_deadline <= now:
+                next_deadline += ((now - next_deadline) // PING_INTERVAL + 1) * PING_INTERVAL
+            await asyncio.sleep(next_deadline - now)
+            SCHEDULE_LAG.observe(loop.time() - next_deadline, "ping_loop")
+    finally:
+        for task in (trace_task, rtmp_task):
+            if task is not None:
+                task.cancel()
+        stop_continuous_pinger(target)
+        latest_rtts.discard(target)
+        _target_contexts.pop(target, None)
+
+class ProbeScheduler:
+    """
+    Runs every target's ping_loop as a task on one asyncio event loop (one thread
+    for all targets instead of one thread per target).
+    set_targets() is called from manage_targets_loop; removed targets are cancelled at once.
+    """
+    def __init__(self, workers=None):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=workers or PROBE_WORKERS, thread_name_prefix="probe")
+        self.tasks = {}
+        self._thread = threading.Thread(target=self.loop.run_forever, name="probe-scheduler", daemon=True)
+        self._thread.start()
+
+    def set_targets(self, targets):
+        """Start tasks for new targets and cancel tasks for removed ones. Returns (started, stopped)."""
+        return asyncio.run_coroutine_threadsafe(self._apply(set(targets)), self.loop).result()
+
+    async def _apply(self, targets):
+        started = targets - self.tasks.keys()
+        stopped = self.tasks.keys() - targets
+        for t in started:
+            self.tasks[t] = self.loop.create_task(ping_loop(t, self))
+        for t in stopped:
+            self.tasks.pop(t).cancel()
+        return started, stopped
+
+    def stop(self):
+        self.set_targets(())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+        self.executor.shutdown(wait=False)
+
+# ---------------- Server Targets ----------------
+# /get_targets without re-downloading an unchanged list every POLL_INTERVAL:
+# - conditional GET: If-None-Match with the last ETag, 304 when nothing changed
+# - subscription, so changes arrive as they happen (TARGETS_SUBSCRIBE):
+#   sse:      GET /get_targets/stream (text/event-stream); each event is "id: <etag>" +
+#             "data: <same JSON list as /get_targets>"; ": comments" are keepalives
+#   longpoll: GET /get_targets?wait=N with If-None-Match; the server holds the request up to
+#             N s and answers 200 (changed) or 304, with an X-Long-Poll header
+#   auto tries sse, then longpoll; off = conditional polling only
+# Servers without them (404, or a plain answer without X-Long-Poll) get plain polling,
+# and the subscription is tried again after TARGETS_SUBSCRIBE_RETRY.
+TARGETS_SUBSCRIBE = get_env_from_registry("TARGETS_SUBSCRIBE", "auto").lower()
+TARGETS_LONGPOLL_WAIT = int(get_env_from_registry("TARGETS_LONGPOLL_WAIT", "30"))
+TARGETS_STREAM_TIMEOUT = 90    # s without a byte (event or keepalive) before the stream is reopened
+TARGETS_RESYNC_INTERVAL = 60   # s a live subscription may go quiet before a conditional GET double-checks
+TARGETS_SUBSCRIBE_RETRY = 600  # s before trying a subscription kind the server didn't have
+
+class TargetFeed:
+    """
+    Server-side target list for manage_targets_loop.
+    - get(): the subscribed list while a subscription is live and recently heard from,
+      otherwise a conditional GET; None if the server couldn't be asked
+    - set_active(): the subscription only runs while targets are wanted (OBS running)
+    - on_change(targets) is called from the subscriber thread when the list changes
+    """
+    def __init__(self, mode=None, on_change=None):
+        self.mode = mode or TARGETS_SUBSCRIBE
+        self.on_change = on_change
+        self.targets = None
+        self.etag = None
+        self.live = None  # "sse" / "longpoll" while subscribed
+        self.fetches = 0
+        self.not_modified = 0
+        self.events = 0
+        self._synced = 0.0
+        self._unsupported_until = {}
+        self._active = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.http = requests.Session()  # the subscriber's own connection
+
+    def get(self):
+        if self.live and self.targets is not None and time.monotonic() - self._synced < TARGETS_RESYNC_INTERVAL:
+            return self.targets
+        return self.fetch()
+
+    def fetch(self):
+        """Conditional GET /get_targets."""
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        try:
+            r = collectors.request(session, "GET", "/get_targets", timeout=5, headers=headers)
+        except Exception:
+            ENDPOINT_ERRORS.inc("/get_targets")
+            return None
+        self.fetches += 1
+        if r.status_code == 304 and self.targets is not None:
+            self.not_modified += 1
+            self._synced = time.monotonic()
+            return self.targets
+        if r.status_code != 200:
+            ENDPOINT_ERRORS.inc("/get_targets")
+            return None
+        try:
+            self._update(r.json(), r.headers.get("ETag"))
+        except (ValueError, TypeError, KeyError) as e:
+            log_print(f"[TARGETS] Unreadable /get_targets response ({e}) - keeping current targets")
+            ENDPOINT_ERRORS.inc("/get_targets")
+            return None
+        return self.targets
+
+    def _update(self, tlist, etag):
+        targets = {t["target"] for t in tlist}
+        with self._lock:
+            changed = self.targets is not None and targets != self.targets
+            self.targets, self.etag, self._synced = targets, etag, time.monotonic()
+        if changed and self.on_change is not None:
+            self.on_change(targets)
+
+    def set_active(self, active):
+        if self.mode == "off":
+            return
+        if active:
+            self._active.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="target-feed", daemon=True)
+                self._thread.start()
+        else:
+            self._active.clear()
+
+    def _kinds(self):
+        kinds = ("sse", "longpoll") if self.mode == "auto" else (self.mode,)
+        now = time.monotonic()
+        return [k for k in kinds if now >= self._unsupported_until.get(k, 0.0)]
+
+    def _run(self):
+        backoff = 1
+        while True:
+            self._active.wait()
+            kinds = self._kinds()
+            if not kinds:
+                time.sleep(max(0.1, min(60, min(self._unsupported_until.values()) - time.monotonic())))
+                continue
+            kind = kinds[0]
+            try:
+                supported = self._stream() if kind == "sse" else self._long_poll()
+                if not supported:
+                    log_print(f"[TARGETS] Server has no {kind} subscription - polling")
+                    self._unsupported_until[kind] = time.monotonic() + TARGETS_SUBSCRIBE_RETRY
+                backoff = 1
+            except Exception as e:
+                if self.live:
+                    log_print(f"[TARGETS] {kind} subscription lost ({e}) - polling until it's back")
+                self.live = None
+                ENDPOINT_ERRORS.inc("/get_targets/stream" if kind == "sse" else "/get_targets?wait")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+
+    def _subscribed(self, kind):
+        if self.live != kind:
+            log_print(f"[TARGETS] Subscribed to target changes ({kind})")
+            self.live = kind
+
+    def _stream(self):
+        """One SSE connection, until it ends or targets aren't wanted anymore. False if unsupported."""
+        headers = {"Accept": "text/event-stream", "Accept-Encoding": "identity"}
+        if self.etag:
+            headers["Last-Event-ID"] = self.etag
+        with self.http.get(collectors.url() + "/get_targets/stream", headers=headers, stream=True,
+                           timeout=(5, TARGETS_STREAM_TIMEOUT)) as r:
+            if r.status_code in (404, 405, 406, 501):
+                return False
+            if r.status_code != 200:
+                raise requests.HTTPError(f"HTTP {r.status_code}", response=r)
+            content_type = r.headers.get("Content-Type", "")
+            if not content_type.startswith("text/event-stream"):
+                # a proxy error page or similar, not a server without SSE - back off and retry
+                raise ValueError(f"unexpected Content-Type {content_type or 'none'}")
+            self._subscribed("sse")
+            event_id, data = None, []
+            try:
+                for line in _sse_lines(r.raw):
+                    self._synced = time.monotonic()
+                    if not self._active.is_set():
+                        break
+                    if not line:
+                        if data:
+                            self.events += 1
+                            self._update(json.loads("\n".join(data)), event_id)
+                        event_id, data = None, []
+                    elif not line.startswith(":"):
+                        field, _, value = line.partition(":")
+                        value = value[1:] if value.startswith(" ") else value
+                        if field == "data":
+                            data.append(value)
+                        elif field == "id":
+                            event_id = value
+            finally:
+                self.live = None
+        return True
+
+    def _long_poll(self):
+        """One long-poll request. False if the server answered without holding it."""
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        r = self.http.get(collectors.url() + "/get_targets", params={"wait": TARGETS_LONGPOLL_WAIT},
+                          headers=headers, timeout=(5, TARGETS_LONGPOLL_WAIT + 15))
+        if "X-Long-Poll" not in r.headers:
+            if r.status_code == 200:
+                self._update(r.json(), r.headers.get("ETag"))
+            return False
+        self._subscribed("longpoll")
+        if r.status_code == 200:
+            self.events += 1
+            self._update(r.json(), r.headers.get("ETag"))
+        elif r.status_code == 304:
+            self._synced = time.monotonic()
+        else:
+            self.live = None
+            raise requests.HTTPError(f"HTTP {r.status_code}", response=r)
+        return True
+
+def _sse_lines(raw):
+    """Lines of an event stream as they arrive (read1 returns what's there instead of filling a buffer)."""
+    read = getattr(raw, "read1", None) or (lambda n: raw.read(1))
+    buffer = b""
+    while True:
+        chunk = read(4096)
+        if not chunk:
+            return
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r").decode("utf-8", "replace")
+
 # ---------------- Manage Targets ----------------
+_targets_wakeup = threading.Event()  # set to re-evaluate targets before POLL_INTERVAL elapses
+target_feed = TargetFeed(on_change=lambda targets: _targets_wakeup.set())
+
+def _on_config_change(changed):
+    log_print(f"[CONFIG] Changed: {', '.join(sorted(changed))}")
+    if "OBS_STREAMING_SERVERS" in changed or "OBS_STREAM_PREVIEW" in changed:
+        _targets_wakeup.set()
+    detect_obs_streaming_data()
+
 def manage_targets_loop():
-    known_targets = set()
+    scheduler = ProbeScheduler()
     last_env_targets = set()
     last_obs_status = None
     
+    # React to OBS start/stop and to OBS rewriting its settings immediately instead of on the next poll
+    obs_watcher.add_listener(lambda running: _targets_wakeup.set())
+    obs_watcher.start()
+    config_source.subscribe(_on_config_change)
+    config_source.start()
+    
     while True:
         try:
             # Check if OBS is running
@@ -985,6 +4460,8 @@ def manage_targets_loop():
                     log_print("OBS detected - starting to monitor streaming servers")
                 else:
                     log_print("OBS not running - stopping all monitoring")
+                if last_obs_status is not None:
+                    client_info_scheduler.request()  # report the OBS change now, not on the next interval
                 last_obs_status = obs_running
             
             # Only monitor if OBS is running
@@ -1010,48 +4487,41 @@ def manage_targets_loop():
                     last_env_targets = set()
            
             # Also fetch targets from server (if any) - only if OBS is running
+            target_feed.set_active(obs_running)
             if obs_running:
-                try:
-                    r = session.get(SERVER_URL.rstrip("/") + "/get_targets", timeout=5)
-                    if r.status_code == 200:
-                        tlist = r.json()
-                        server_targets = set([t['target'] for t in tlist])
-                        new_targets.update(server_targets)
-                except:
-                    pass  # If server is unreachable, still use auto-detected targets
+                server_targets = target_feed.get()  # subscribed list, or a conditional GET
+                if server_targets is not None:  # If server is unreachable, still use auto-detected targets
+                    new_targets.update(server_targets)
            
-            # start new
-            for t in new_targets - known_targets:
-                stop_flags[t] = {'stop': False}
-                th = threading.Thread(target=ping_loop, args=(t,), daemon=True)
-                threads[t] = th
-                th.start()
+            # start new / cancel removed
+            started, stopped = scheduler.set_targets(new_targets)
+            release_update_bridge()  # after an update: our probes run, the old build's bridge can stop
+            for t in started:
                 log_print(f"Started monitoring target: {t}")
-           
-            # stop removed
-            for t in known_targets - new_targets:
-                stop_flags[t]['stop'] = True
-                threads.pop(t, None)
-                stop_flags.pop(t, None)
+            for t in stopped:
                 log_print(f"Stopped monitoring target: {t}")
-           
-            known_targets = new_targets
         except KeyboardInterrupt:
             log_print("[SHUTDOWN] Service stopping gracefully.")
             os._exit(0)
         except Exception as e:
             log_print(f"Polling error: {e}")
         try:
-            time.sleep(POLL_INTERVAL)
+            _targets_wakeup.wait(POLL_INTERVAL)
+            _targets_wakeup.clear()
         except KeyboardInterrupt:
             log_print("[SHUTDOWN] Service stopping gracefully.")
             os._exit(0)
  
 if __name__=="__main__":
+    if "--update-bridge" in sys.argv:
+        run_update_bridge()
+    if "--update-guard" in sys.argv:
+        run_update_guard()
+    check_update_boot()  # first: counts starts of a freshly applied build, rolls back one that keeps failing
     log_print("="*60)
     log_print("Agent starting:")
     log_print(f"  AGENT_NAME: {AGENT_NAME}")
-    log_print(f"  SERVER_URL: {SERVER_URL}")
+    log_print(f"  SERVER_URLS: {', '.join(SERVER_URLS)}")
     log_print(f"  SCRIPT_DIR: {SCRIPT_DIR}")
     log_print(f"  LOG_FILE: {LOG_FILE}")
     log_print(f"  POLL_INTERVAL: {POLL_INTERVAL} seconds")
@@ -1059,17 +4529,42 @@ if __name__=="__main__":
     log_print(f"  Smart monitoring: Only monitors when OBS is running")
     log_print("="*60)
     
-    # Detect client info at startup
-    log_print("Detecting network information...")
-    detect_client_info()
-    push_agent_version()   # Register this PC on /pc_versions dashboard
+    if METRICS_PORT:
+        try:
+            metrics.serve(METRICS_PORT, METRICS_BIND)
+            log_print(f"  Self metrics: http://{METRICS_BIND}:{METRICS_PORT}/metrics")
+        except OSError as e:
+            log_print(f"  Self metrics disabled: cannot listen on {METRICS_BIND}:{METRICS_PORT} ({e})")
+    if len(collectors.collectors) > 1:
+        collectors.start_health_checks()
+    if RELAY_MODE == "serve":
+        try:
+            relay_server.serve(RELAY_PORT, RELAY_BIND, RELAY_DISCOVERY_PORT)
+            log_print(f"  LAN relay: http://{RELAY_BIND}:{RELAY_PORT} (discovery on UDP {RELAY_DISCOVERY_PORT})")
+        except OSError as e:
+            log_print(f"  LAN relay disabled: cannot listen on {RELAY_BIND}:{RELAY_PORT} ({e})")
+    elif RELAY_URL:
+        log_print(f"  Relay: {RELAY_URL}")
+
+    # Client info: the previous build's (update handoff) or the last detected one right away;
+    # detection runs in the background so probing doesn't wait for the lookups
+    if not adopt_update_handoff():
+        load_identity_cache()
+
+    def startup_client_info():
+        log_print("Detecting network information...")
+        detect_client_info()
+        push_agent_version()   # Register this PC on /pc_versions dashboard
+        client_info_scheduler.request()  # initial client info push, with what was detected
+
+    threading.Thread(target=startup_client_info, name="startup-client-info", daemon=True).start()
     
     # Detect OBS streaming data at startup
     log_print("Detecting OBS streaming data...")
     detect_obs_streaming_data()
     
-    # Push client info to server initially
-    push_client_info()
+    # From here on only client_info_scheduler pushes client info
+    client_info_scheduler.start()
     
     # Start background thread to refresh client info every 5 minutes
     def refresh_client_info():
@@ -1077,7 +4572,7 @@ if __name__=="__main__":
             time.sleep(300)  # 5 minutes
             detect_client_info()
             detect_obs_streaming_data()  # Also refresh OBS data
-            push_client_info()
+            client_info_scheduler.request()
     
     refresh_thread = threading.Thread(target=refresh_client_info, daemon=True)
     refresh_thread.start()
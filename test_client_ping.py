@@ -0,0 +1,376 @@
+"""
+Regression tests for client_ping.py: the benchmarks in bench_client_ping.py with small
+parameters, asserting on what they measure.
+
+Usage:
+    python -m pytest -q test_client_ping.py
+"""
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+import requests
+
+import bench_client_ping as bench
+import client_ping
+
+
+def test_soak_threads_and_rss_stay_flat():
+    result = bench.bench_soak(duration=20, pool=100)
+    assert result["threads_end"] <= result["threads_start"] + 2, result
+    assert result["rss_mb_end"] - result["rss_mb_start"] < 20, result
+    assert result["reporter"]["dropped"] == 0, result
+
+
+def test_ping_loop_counts_samples_skipped_while_submit_blocks(tmp_path):
+    rep = client_ping.TelemetryReporter(maxsize=1, flush_interval=0.3, drop_policy="block",
+                                        spool=client_ping.TelemetrySpool(str(tmp_path), max_bytes=0))
+    rep._thread = threading.current_thread()  # no sender: after one sample every submit blocks, then drops
+    engine, probes = bench.FakeProbeEngine(), [0]
+    submit = engine.submit
+
+    def counting_submit(*args):
+        probes[0] += 1
+        return submit(*args)
+
+    engine.submit = counting_submit
+    with bench.patched(client_ping, reporter=rep, get_icmp_engine=lambda: engine, PING_INTERVAL=0.05,
+                       PING_REPORT_MODE="raw", PATH_TRACE=False):
+        scheduler = client_ping.ProbeScheduler()
+        try:
+            scheduler.set_targets(["127.0.0.1"])
+            time.sleep(1.5)
+            scheduler.set_targets(())
+        finally:
+            scheduler.stop()
+    time.sleep(0.4)  # let the last blocked submit give up
+    assert probes[0] >= 10
+    assert rep.enqueued == 1 and rep.enqueued + rep.dropped >= probes[0] - 1, (probes, rep.stats())
+
+
+def test_client_info_probe_rate_does_not_depend_on_target_count():
+    duration, info_interval = 4, 1
+    result = bench.bench_client_info(target_counts=(1, 20), duration=duration, info_interval=info_interval)
+    rates = [r["probes_per_target_per_min"] for r in result.values()]
+    for r in result.values():
+        expected = r["expected_per_target_per_min"]
+        assert abs(r["probes_per_target_per_min"] - expected) <= expected * 0.15, result
+        assert r["client_info_pushes"] <= duration / info_interval + 1, result  # one per interval, not per target
+        assert r["os_origin_server"] not in (None, "none"), result
+    assert max(rates) <= min(rates) * 1.15, result
+
+
+@pytest.mark.parametrize("output,expected", bench.PING_OUTPUT_CORPUS,
+                         ids=[out.splitlines()[-1][:40] for out, _ in bench.PING_OUTPUT_CORPUS])
+def test_parse_ping_output_corpus(output, expected):
+    assert client_ping.parse_ping_output(output) == expected
+    assert client_ping.parse_ping_output(output.encode("utf-8")) == expected
+
+
+def test_parse_ping_replies_extracts_seq():
+    output = ("PING 1.1.1.1 (1.1.1.1) 56(84) bytes of data.\n"
+              "64 bytes from 1.1.1.1: icmp_seq=1 ttl=57 time=12.3 ms\n"
+              "64 bytes from 1.1.1.1: icmp_seq=3 ttl=57 time=0.4 ms\n"  # seq 2 lost
+              "64 bytes from 8.8.8.8: seq=7 ttl=115 time=38,5 ms\n"  # BusyBox, comma decimal
+              "Reply from 8.8.8.8: bytes=32 time<1ms TTL=117\n"  # Windows: no sequence number
+              "Request timeout for icmp_seq 8\n")
+    assert client_ping.parse_ping_replies(output) == [(1, 12.3), (3, 0.4), (7, 38.5), (None, 1.0)]
+    assert client_ping.parse_ping_replies(b"") == []
+
+
+def test_histogram_percentiles_match_exact_within_precision():
+    result = bench.bench_histogram(samples=20000)
+    assert result["max_error_within_bound"], result
+    assert result["merge_equals_whole"], result
+
+
+def test_histogram_empty_and_loss():
+    empty = client_ping.RttHistogram()
+    assert empty.percentile(50) is None
+    assert empty.summary() == {"count": 0, "lost": 0, "loss_pct": 0.0, "rtt_min_ms": -10.0, "rtt_avg_ms": -10.0,
+                               "rtt_p50_ms": -10.0, "rtt_p90_ms": -10.0, "rtt_p99_ms": -10.0, "rtt_max_ms": -10.0}
+    h = client_ping.RttHistogram()
+    for rtt in (10.0, 20.0, 30.0):
+        h.record(rtt)
+    h.record_loss()
+    summary = h.merge(client_ping.RttHistogram()).summary()  # merging an empty one changes nothing
+    assert (summary["count"], summary["lost"], summary["loss_pct"]) == (3, 1, 25.0)
+    assert (summary["rtt_min_ms"], summary["rtt_avg_ms"], summary["rtt_max_ms"]) == (10.0, 20.0, 30.0)
+    all_lost = client_ping.RttHistogram()
+    all_lost.record_loss(4)
+    assert all_lost.summary()["loss_pct"] == 100.0 and all_lost.summary()["rtt_p50_ms"] == -10.0
+
+
+def test_outage_loses_nothing_and_replays_in_order():
+    result = bench.bench_outage(rate=50, duration=8, down_at=2, up_at=5)
+    assert result["lost"] == 0, result
+    assert result["duplicates"] == 0, result
+    assert result["timestamps_preserved"], result
+    assert result["replayed"] > 0, result
+    assert result["replay_in_order"], result
+
+
+def test_failover_delivers_every_push_once():
+    posts = 12
+    result = bench.bench_failover(posts=posts)
+    dead, dies = result["dead_primary"], result["primary_dies"]
+    assert dead["primary"], result  # failed over past refused, 503 and blackhole to the healthy one
+    assert dead["delivered"] == f"{posts}/{posts}" and dead["duplicates"] == 0, result
+    assert dies["on_a"] > 0 and dies["on_b"] > 0 and dies["sticky"], result
+    assert dies["delivered"] == f"{posts}/{posts}" and dies["duplicates"] == 0, result
+    assert result["latency_switch"]["primary_after_is_fast"], result
+
+
+def test_connect_probes_time_tcp_and_tls():
+    result = bench.bench_connect(count=20)
+    for kind in ("tcp", "tls"):
+        if "skipped" in result[kind]:
+            continue
+        assert result[kind]["success"] == "20/20", result
+        assert result[kind]["accepted_by_listener"] == 20, result
+    if "skipped" not in result["tls"]:
+        assert result["tls"]["avg_tls_handshake_ms"] > 0, result
+    assert not result["refused"]["success"], result
+
+
+def test_path_trace_reports_the_injected_hops():
+    result = bench.bench_path()
+    assert result["reached"], result
+    hops = {ttl: (ip, loss, rtt) for ttl, ip, loss, rtt in result["hops"]}
+    assert sorted(hops) == list(range(1, 9)), result
+    assert hops[1] == ("192.168.1.1", 0.0, 1.0), result
+    assert hops[3][0] == "*" and hops[3][1] == 100.0, result  # silent hop
+    assert hops[5][0] == "198.51.100.7" and 0 < hops[5][1] < 100, result  # lossy hop
+    assert hops[8] == ("203.0.113.9", 0.0, 21.0), result
+    assert result["duration_ms"] < result["sequential_estimate_ms"], result  # hops probed concurrently
+    assert result["trigger"]["path_reports"] == 2, result
+
+
+def test_rtmp_handshake_succeeds_and_times_the_server():
+    count = 20
+    result = bench.bench_rtmp(count=count, delay_ms=50)
+    for kind in ("tcp", "tls"):
+        if "skipped" in result[kind]:
+            continue
+        assert result[kind]["success"] == f"{count}/{count}" and result[kind]["errors"] == [], result
+        assert 0 < result[kind]["avg_handshake_ms"] < 50, result  # loopback, no server delay
+    assert 50 <= result["delayed"]["min_handshake_ms"] <= result["delayed"]["max_handshake_ms"] < 150, result
+    assert result["not_rtmp"]["rtmp_handshake_ms"] == -10.0 and result["not_rtmp"]["rtmp_error"], result
+    loop = result["ping_loop"]
+    assert loop["with_rtmp_handshake"] >= 1 and loop["first_with_rtmp"]["rtmp_handshake_ms"] >= 1000, result
+    assert loop["samples"] >= loop["expected_samples"] - 2, result  # the slow handshake cost no probe slots
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeResolver:
+    """resolver(host) -> (ip, ttl); answers[host] is a tuple or an exception to raise."""
+    def __init__(self, **answers):
+        self.answers = answers
+        self.calls = []
+
+    def __call__(self, host):
+        self.calls.append(host)
+        answer = self.answers[host]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+def wait_for(condition, timeout=2.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "timed out"
+        time.sleep(0.005)
+
+
+def test_dns_cache_clamps_ttl():
+    clock = FakeClock()
+    cache = client_ping.DnsCache(FakeResolver(short=("10.0.0.1", 1), long=("10.0.0.2", 10**6), none=("10.0.0.3", None)), clock)
+    for host in ("short", "long", "none"):
+        cache.resolve(host)
+    expires = {host: entry["expires"] - clock.now for host, entry in cache._entries.items()}
+    assert expires == {"short": client_ping.DNS_MIN_TTL, "long": client_ping.DNS_MAX_TTL,
+                       "none": client_ping.DNS_DEFAULT_TTL}
+
+
+def test_dns_cache_refreshes_ahead_of_expiry():
+    clock, resolver = FakeClock(), FakeResolver(host=("10.0.0.1", 100))
+    cache = client_ping.DnsCache(resolver, clock)
+    assert cache.resolve("host") == "10.0.0.1"
+    clock.now += 100 * client_ping.DNS_REFRESH_AHEAD - 1
+    assert cache.lookup("host") == "10.0.0.1" and len(resolver.calls) == 1
+    resolver.answers["host"] = ("10.0.0.2", 100)
+    clock.now += 1
+    assert cache.lookup("host") == "10.0.0.1"  # served at once, refreshed in the background
+    wait_for(lambda: cache.peek("host") == "10.0.0.2")
+    assert len(resolver.calls) == 2 and cache.stale_served == 0
+
+
+def test_dns_cache_serves_stale_and_retries_when_resolver_fails():
+    clock, resolver = FakeClock(), FakeResolver(host=("10.0.0.1", 10))
+    cache = client_ping.DnsCache(resolver, clock)
+    cache.resolve("host")
+    resolver.answers["host"] = OSError("SERVFAIL")
+    clock.now += 11
+    assert cache.lookup("host") == "10.0.0.1" and cache.stale_served == 1
+    wait_for(lambda: cache.failures == 1)
+    assert cache.lookup("host") == "10.0.0.1"
+    time.sleep(0.05)
+    assert len(resolver.calls) == 2  # no new attempt before DNS_RETRY_INTERVAL
+    clock.now += client_ping.DNS_RETRY_INTERVAL
+    resolver.answers["host"] = ("10.0.0.2", 10)
+    assert cache.lookup("host") == "10.0.0.1"
+    wait_for(lambda: cache.peek("host") == "10.0.0.2")
+    assert len(resolver.calls) == 3
+
+
+def test_dns_cache_evicts_idle_names():
+    clock = FakeClock()
+    cache = client_ping.DnsCache(FakeResolver(used=("10.0.0.1", 3600), idle=("10.0.0.2", 3600)), clock)
+    cache.resolve("used")
+    cache.resolve("idle")
+    clock.now += client_ping.DNS_IDLE_EVICT - 1
+    cache.lookup("used")
+    clock.now += client_ping.DNS_EVICT_SWEEP + 1
+    assert cache.lookup("used") == "10.0.0.1"
+    assert cache.peek("idle") is None and cache.stats()["evictions"] == 1
+
+
+def test_dns_cache_stats_count_hits_misses_and_failures():
+    cache = client_ping.DnsCache(FakeResolver(host=("10.0.0.1", 60), gone=OSError("NXDOMAIN")), FakeClock())
+    assert cache.resolve("host") == "10.0.0.1"
+    assert cache.resolve("host") == "10.0.0.1"
+    assert cache.resolve("192.0.2.1") == "192.0.2.1"  # IP literals never touch the cache
+    assert cache.resolve("gone") is None
+    stats = cache.stats()
+    assert {k: stats[k] for k in ("entries", "hits", "misses", "stale_served", "failures", "evictions")} == \
+        {"entries": 1, "hits": 1, "misses": 2, "stale_served": 0, "failures": 1, "evictions": 0}
+
+
+def _echo_reply(seq, ip_header=False):
+    icmp = struct.pack("!BBHHH", client_ping.ICMP_ECHO_REPLY, 0, 0, 0x1234, seq) + client_ping.ICMP_PAYLOAD
+    if not ip_header:
+        return icmp
+    return struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(icmp), 0, 0, 57, 1, 0,
+                       bytes([192, 0, 2, 1]), bytes([10, 0, 0, 2])) + icmp
+
+
+def test_icmp_engine_matches_replies_with_and_without_ip_header():
+    engine = object.__new__(client_ping._IcmpSocketEngine)  # no socket: feed packets to _handle_packet
+    engine.kind, engine.ident, engine._lock = "dgram", 0x1234, threading.Lock()
+    futures = {seq: Future() for seq in (1, 2)}
+    engine._pending = {seq: [fut, "192.0.2.1", 0, 0] for seq, fut in futures.items()}
+    engine._handle_packet(_echo_reply(1), "192.0.2.1", 2_000_000)  # Linux datagram socket: ICMP only
+    engine._handle_packet(_echo_reply(2, ip_header=True), "192.0.2.1", 3_000_000)  # raw / macOS datagram
+    assert futures[1].result(0)[:2] == (True, 2.0)
+    assert futures[2].result(0)[:2] == (True, 3.0) and "TTL=57" in futures[2].result(0)[2]
+    assert engine._pending == {}
+
+
+def test_gpu_streaming_sampler_goes_unhealthy_when_killed():
+    result = bench.bench_gpu(duration=1)
+    assert result["samples_streamed"] >= 5, result
+    assert result["healthy_while_running"] and not result["healthy_after_kill"], result
+
+
+def test_gpu_streaming_sampler_parses_dmon_lines():
+    script = ("import time\n"
+              "print('# gpu    sm   mem   enc   dec', flush=True)\n"
+              "print('# Idx     %     %     %     %', flush=True)\n"
+              "print('    0    35    12    48     0', flush=True)\n"
+              "print('    1    90     -     -     -', flush=True)\n"
+              "time.sleep(30)")
+    sampler = client_ping.StreamingCommandSampler("fake-dmon", [sys.executable, "-c", script],
+                                                  client_ping._parse_nvidia_dmon, stale_after=10)
+    sampler.start()
+    try:
+        wait_for(lambda: sampler.samples == 2, timeout=10)
+        assert sampler.latest() == 90.0 and sampler._per_key == {"0": 48.0, "1": 90.0}
+        assert sampler.healthy()
+    finally:
+        sampler.stop()
+    assert not sampler.healthy()
+
+
+def test_parse_nvidia_dmon():
+    parse = client_ping._parse_nvidia_dmon
+    assert parse("# gpu    sm   mem   enc   dec") is None
+    assert parse("    0    35    12    48     0") == ("0", 48.0)  # NVENC busier than SM
+    assert parse("    1    20     -     5     -") == ("1", 20.0)
+    assert parse("    0     -     -     -     -") is None
+
+
+class FakeGpuSampler(client_ping.GpuSampler):
+    def __init__(self, name, healthy, created):
+        super().__init__()
+        self.name, self._healthy, self.latest_calls = name, healthy, 0
+        created.append(name)
+
+    def healthy(self):
+        return self._healthy
+
+    def latest(self):
+        self.latest_calls += 1
+        if self.latest_calls > 1:
+            threading.Event().wait()  # park the loop thread: it has no stop, and the test is done
+        return 55.0
+
+
+def test_gpu_monitor_moves_to_next_sampler_after_three_failures():
+    created, good = [], []
+
+    def make_good():
+        good.append(FakeGpuSampler("good", True, created))
+        return good[-1]
+
+    candidates = [("bad", lambda: FakeGpuSampler("bad", False, created)), ("good", make_good)]
+    with bench.patched(client_ping, GPU_SAMPLE_INTERVAL=0.01, gpu_sampler_candidates=lambda: candidates,
+                       _try_install_gputil=lambda: None, _detect_gpu_name=lambda: "Fake GPU",
+                       _gpu_usage=0.0, _gpu_name="unknown"):
+        threading.Thread(target=client_ping._gpu_monitor_loop, daemon=True).start()
+        wait_for(lambda: good and good[0].latest_calls > 1)
+        assert created == ["bad", "bad", "bad", "good"]
+        assert client_ping._gpu_usage == 55.0
+
+
+def test_relay_loses_nothing_and_agents_fall_back_when_it_dies():
+    result = bench.bench_relay(agents=2, targets=3, duration=10)
+    relay = result["relay"]
+    assert relay["agents"] == 3 and relay["max_loss_pct"] == 0, result  # relay + 2 agents
+    assert relay["collector_posts_per_sec"] < result["direct"]["collector_posts_per_sec"], result
+    assert relay["after_relay_killed"] == {"max_loss_pct": 0, "agents_reporting": 2}, result
+
+
+def test_relay_server_requires_token_and_rejects_when_full(tmp_path):
+    rep = client_ping.TelemetryReporter(maxsize=3, spool=client_ping.TelemetrySpool(str(tmp_path), max_bytes=0))
+    rep._thread = threading.current_thread()  # no sender: the queue only fills up
+    server = client_ping.RelayServer(rep, token="site-token", allow="127.0.0.0/8").serve(0, host="127.0.0.1")
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    batch = {"computer_name": "agent0", "items": [
+        {"endpoint": "/push_ping", "payload": {"target": "10.0.0.1", "timestamp": 1}},
+        {"endpoint": "/push_ping", "payload": {"target": "10.0.0.2", "timestamp": 1}}]}
+    good = {"X-Relay-Token": "site-token"}
+    try:
+        assert requests.post(url + "/push_batch", json=batch, timeout=5).status_code == 401
+        assert requests.post(url + "/push_batch", json=batch, headers={"X-Relay-Token": "guess"},
+                             timeout=5).status_code == 401
+        assert rep.stats()["queue_depth"] == 0
+        assert requests.post(url + "/push_batch", json=batch, headers=good, timeout=5).status_code == 200
+        assert requests.post(url + "/push_batch", json=batch, headers=good, timeout=5).status_code == 503
+        assert rep.stats()["queue_depth"] == 2 and rep.dropped == 0  # nothing of the rejected batch queued
+        assert requests.post(url + "/push_ping", json={"target": "10.0.0.3", "timestamp": 1}, headers=good,
+                             timeout=5).status_code == 200
+        assert rep.stats()["queue_depth"] == 3
+    finally:
+        server.shutdown()
+        server.server_close()